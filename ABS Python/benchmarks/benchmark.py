@@ -0,0 +1,237 @@
+'''
+Benchmark harness for the amortization, LoanPool, waterfall and simulation code
+Every benchmark runs at each pool size (200, 1,500, 15,000 and 150,000 loans by default) with warmup runs and
+timed repeats, and reports the median and 95th percentile times. The results are saved as JSON, and a saved run can be
+used as the baseline of a later one: any benchmark whose median got slower than the threshold is flagged as a regression
+The pools are synthetic tapes fitted to Loans.csv (see LoanTapeGenerator), from a fixed seed, or the first rows of a
+saved tape (see generateTape.py). Run from the 'ABS Python' folder, like the main programs:
+    python -m benchmarks.benchmark --output baseline.json
+    python -m benchmarks.benchmark --compare baseline.json
+'''
+
+from package.Loan import Loan
+from package.LoanTape import LoanTape
+from package.LoanTapeGenerator import LoanTapeGenerator
+from package.StructuredSecuritiesABS import StructuredSecurities
+from package.Tranche import StandardTranche
+import argparse, contextlib, json, math, os, platform, sys, time, numpy
+
+
+# Loan tape the synthetic pools are fitted to
+tapeFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mainPrograms', 'Loans.csv')
+
+defaultSizes = [200, 1500, 15000, 150000]
+
+
+class BenchmarkContext(object):
+    # Everything a benchmark needs for 1 pool size, built once (outside the timings) and shared by the benchmarks
+    # nLoans: number of loans in the pool. nSims: number of simulations of the simulation benchmarks
+    # tape: path of a saved tape to take the first nLoans loans of. Default is a synthetic tape fitted to Loans.csv
+    def __init__(self, nLoans, nSims=5, seed=2020, tape=None):
+        self.nLoans = nLoans
+        self.nSims = nSims
+        if tape is None:
+            self.tape = LoanTapeGenerator.fit(tapeFile, seed=seed).generate(nLoans)
+        else:
+            self.tape = LoanTape.read(tape, nRows=nLoans)
+            if len(self.tape) < nLoans:
+                raise ValueError(f'{tape} only has {len(self.tape)} loans, {nLoans} are needed')
+
+        self.ABS = StructuredSecurities(self.tape.toLoanPool(seed=seed))
+        self.ABS.addTranche(StandardTranche, 0.8, 0.05, 'A')
+        self.ABS.addTranche(StandardTranche, 0.2, 0.08, 'B')
+        self.rates = [tranche.rate for tranche in self.ABS]
+
+    @property
+    def loanPool(self):
+        return self.ABS.loanPool
+
+    # Put back the tranche rates, which runMonteSequential changes
+    def resetRates(self):
+        for tranche, rate in zip(self.ABS, self.rates):
+            tranche.rate = rate
+
+
+##### Benchmarks: function(context) running the code to time, and optionally a setup(context) run before each repeat
+def calcBalance(context):
+    # Object-level balance formula of every loan, 1 year in
+    for term, rate, face in zip(context.tape.term.tolist(), context.tape.rate.tolist(), context.tape.face.tolist()):
+        Loan.calcBalance(term / 12, rate, face, 12)
+
+
+def schedule(context):
+    # Vectorized amortization schedule of the whole pool, every period
+    tape = context.tape
+    Loan.calcSchedule((tape.term / 12)[:, None], tape.rate[:, None], tape.face[:, None], numpy.arange(tape.term.max() + 2))
+
+
+def poolAggregates(context):
+    # Every pool total, for every period of the pool's life
+    for period in range(1, int(context.tape.term.max()) + 1):
+        context.loanPool.periodCashflow(period)
+
+
+def weightedAverages(context):
+    context.loanPool.calcWAM(12)
+    context.loanPool.calcWAR(12)
+
+
+def doWaterfallSequential(context):
+    context.ABS.doWaterfallSequential()
+
+
+def simulateWaterfallSequential(context):
+    context.ABS.simulateWaterfallSequential(context.nSims)
+
+
+def simulateWaterfallBatched(context):
+    context.ABS.simulateWaterfallBatched(context.nSims, seed=1)
+
+
+def runMonteSequential(context):
+    context.ABS.runMonteSequential(context.nSims, 0.01)
+
+
+# name: (function, setup, largest pool it is run on). calcWAM/calcWAR recompute the pool total for every loan,
+# so they are quadratic in the number of loans
+benchmarks = {
+    'calcBalance': (calcBalance, None, None),
+    'schedule': (schedule, None, None),
+    'poolAggregates': (poolAggregates, lambda context: context.ABS.reset(), None),
+    'weightedAverages': (weightedAverages, None, 15000),
+    'doWaterfallSequential': (doWaterfallSequential, lambda context: context.ABS.reset(), None),
+    'simulateWaterfallSequential': (simulateWaterfallSequential, None, None),
+    'simulateWaterfallBatched': (simulateWaterfallBatched, None, None),
+    'runMonteSequential': (runMonteSequential, lambda context: context.resetRates(), None),
+}
+
+
+def percentile(times, q):
+    # Nearest-rank percentile
+    ordered = sorted(times)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def measure(function, context, setup=None, warmup=1, repeats=5):
+    '''
+    Time a benchmark
+    :param function: function(context) to time
+    :param context: BenchmarkContext
+    :param setup: function(context) run before every run, outside the timing
+    :param warmup: number of untimed runs first (caches, memoization, lazy arrays)
+    :param repeats: number of timed runs
+    :return: dictionary with keys 'median', 'p95', 'min', 'mean' (seconds), 'repeats' and 'times'
+    '''
+    times = []
+    # runMonteSequential prints every iteration: keep it out of the report (the writes are still timed)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for run in range(warmup + repeats):
+            if setup is not None:
+                setup(context)
+            start = time.perf_counter()
+            function(context)
+            elapsed = time.perf_counter() - start
+            if run >= warmup:
+                times.append(elapsed)
+    return {'median': percentile(times, 50) if len(times) % 2 else float(numpy.median(times)), 'p95': percentile(times, 95),
+            'min': min(times), 'mean': sum(times) / len(times), 'repeats': repeats, 'times': times}
+
+
+def run(sizes=None, names=None, warmup=1, repeats=5, nSims=5, tape=None, log=print):
+    '''
+    Run the benchmarks
+    :param sizes: pool sizes. Default is defaultSizes
+    :param names: benchmarks to run. Default is all of them
+    :param warmup: number of untimed runs of each benchmark
+    :param repeats: number of timed runs of each benchmark
+    :param nSims: number of simulations of the simulation benchmarks
+    :param tape: path of a saved tape to build the pools from. Default is a synthetic tape fitted to Loans.csv
+    :param log: function printing the progress
+    :return: dictionary with keys 'meta' (machine and settings) and 'results' ('name/size': measure() dictionary)
+    '''
+    sizes = defaultSizes if sizes is None else sizes
+    names = list(benchmarks) if names is None else names
+    unknown = [name for name in names if name not in benchmarks]
+    if unknown:
+        raise ValueError(f'Unknown benchmark(s) {unknown}. Options include: {list(benchmarks)}')
+
+    results = {}
+    for nLoans in sizes:
+        start = time.perf_counter()
+        context = BenchmarkContext(nLoans, nSims, tape=tape)
+        log(f'{nLoans} loans: pool built in {time.perf_counter() - start:.2f} seconds')
+        for name in names:
+            function, setup, maxLoans = benchmarks[name]
+            if maxLoans is not None and nLoans > maxLoans:
+                log(f'  {name:<30} skipped: only run up to {maxLoans} loans')
+                continue
+            result = measure(function, context, setup, warmup, repeats)
+            results[f'{name}/{nLoans}'] = result
+            log(f'  {name:<30} median {result["median"]:.4f} s   p95 {result["p95"]:.4f} s')
+
+    meta = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(), 'numpy': numpy.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'warmup': warmup, 'repeats': repeats,
+            'nSims': nSims, 'tape': tape or 'synthetic'}
+    return {'meta': meta, 'results': results}
+
+
+def compare(baseline, current, threshold=0.1):
+    '''
+    Compare the medians of 2 runs
+    :param baseline: run() dictionary (i.e. loaded from a saved JSON) to compare against
+    :param current: run() dictionary
+    :param threshold: relative slowdown of the median that counts as a regression, i.e. 0.1 for 10%
+    :return: list of (benchmark, baseline median, current median, ratio, status) with status 'regression',
+    'improvement' or 'ok', for the benchmarks in both runs
+    '''
+    rows = []
+    for key, result in current['results'].items():
+        if key not in baseline['results']:
+            continue
+        before, after = baseline['results'][key]['median'], result['median']
+        ratio = after / before if before > 0 else math.inf
+        status = 'regression' if ratio > 1 + threshold else 'improvement' if ratio < 1 / (1 + threshold) else 'ok'
+        rows.append((key, before, after, ratio, status))
+    return rows
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the ABS valuation model')
+    parser.add_argument('--sizes', type=int, nargs='+', default=defaultSizes, help='pool sizes, in loans')
+    parser.add_argument('--benchmarks', nargs='+', default=None, choices=list(benchmarks), help='benchmarks to run (default: all)')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed runs before the timed ones')
+    parser.add_argument('--repeats', type=int, default=5, help='timed runs')
+    parser.add_argument('--nSims', type=int, default=5, help='simulations of the simulation benchmarks')
+    parser.add_argument('--tape', help='saved tape (.csv or .npy) to build the pools from (default: synthetic)')
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON file of a saved run to compare the results against')
+    parser.add_argument('--current', help='JSON file of a saved run to compare instead of running the benchmarks')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown flagged as a regression')
+    arguments = parser.parse_args(arguments)
+
+    if arguments.current is not None:
+        with open(arguments.current) as file:
+            current = json.load(file)
+    else:
+        current = run(arguments.sizes, arguments.benchmarks, arguments.warmup, arguments.repeats, arguments.nSims, arguments.tape)
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as file:
+            json.dump(current, file, indent=2)
+        print(f'Results written to {arguments.output}')
+
+    if arguments.compare is None:
+        return 0
+    with open(arguments.compare) as file:
+        baseline = json.load(file)
+    rows = compare(baseline, current, arguments.threshold)
+    print(f'\n{"Benchmark":<40}{"Baseline (s)":>14}{"Current (s)":>14}{"Ratio":>8}  Status')
+    for key, before, after, ratio, status in rows:
+        print(f'{key:<40}{before:>14.4f}{after:>14.4f}{ratio:>8.2f}  {status}')
+    regressions = [row for row in rows if row[-1] == 'regression']
+    print(f'\n{len(regressions)} regression(s) over {arguments.threshold:.0%}')
+    # Non-zero exit code when something got slower, so the comparison can gate a change
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,31 @@
+'''
+Write a synthetic loan tape fitted to Loans.csv (see LoanTapeGenerator), for the benchmarks and stress tests
+Run from the 'ABS Python' folder, like the main programs:
+    python -m benchmarks.generateTape tape.npy --rows 10000000 --seed 2020 --mortgageShare 0.2
+'''
+
+from package.LoanTapeGenerator import LoanTapeGenerator
+from benchmarks.benchmark import tapeFile
+import argparse, time
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Synthetic loan tape generator')
+    parser.add_argument('fileName', help='output file: .csv (Loans.csv layout) or .npy (structured array)')
+    parser.add_argument('--rows', type=int, default=100000, help='number of loans')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the tape (default: random)')
+    parser.add_argument('--mortgageShare', type=float, default=0., help='fraction of mortgages mixed in')
+    parser.add_argument('--vacationShare', type=float, default=0.25, help='fraction of the mortgages on a vacation home')
+    parser.add_argument('--chunkSize', type=int, default=100000, help='loans held in memory at once')
+    parser.add_argument('--source', default=tapeFile, help='tape the distributions are fitted to')
+    arguments = parser.parse_args(arguments)
+
+    start = time.perf_counter()
+    generator = LoanTapeGenerator.fit(arguments.source, seed=arguments.seed, mortgageShare=arguments.mortgageShare,
+                                      vacationShare=arguments.vacationShare)
+    nRows = generator.write(arguments.fileName, arguments.rows, arguments.chunkSize)
+    print(f'{nRows} loans written to {arguments.fileName} in {time.perf_counter() - start:.2f} seconds')
+
+
+if __name__ == '__main__':
+    main()
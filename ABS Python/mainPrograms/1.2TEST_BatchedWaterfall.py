@@ -0,0 +1,69 @@
+'''
+1.2) Test program: the batched waterfall (poolCollectionsBatched + doWaterfallBatched, see WaterfallKernel.py) must
+reproduce the object waterfall (doWaterfallSequential + makePayments) exactly, quirks included (i.e. a tranche that is
+not paid takes all the cash left). Both run on the SAME default periods, with 3 tranches, sequential and pro-rata,
+and every Tranche field, the RIY and the AL are compared period by period
+Run it after any change to makePayments or to the kernel
+'''
+
+from package.StructuredSecuritiesABS import StructuredSecurities
+from package.Tranche import Tranche, StandardTranche
+from package.LoanPool import LoanPool
+from package.LoanTape import LoanTape
+from package.DefaultModel import CDRDefaultModel
+from package.DefaultSampler import DefaultSampler
+import math, numpy
+
+
+def checkPaths(security, sequential, nPaths):
+    # Object waterfall of each path, keeping the default periods that reset() drew for it
+    defaults, objectWaterfalls = [], []
+    for path in range(nPaths):
+        security.reset()
+        defaults.append(security.loanPool.defaultPeriods.copy())
+        security.doWaterfallSequential(sequential)
+        # The property columns are reused by the next path: copy them
+        objectWaterfalls.append([({field: tranche.properties.column(field).copy() for field in Tranche.fields},
+                                   tranche.IRR(), tranche.AL()) for tranche in security])
+
+    # Batched waterfall of all the paths at once, on the same default periods
+    waterfall = security.doWaterfallBatched(security.poolCollectionsBatched(numpy.array(defaults)), sequential)
+    RIY, AL, IRR = security.batchMetrics(waterfall, withIRR=True)
+
+    for path, tranches in enumerate(objectWaterfalls):
+        for index, (columns, objectIRR, objectAL) in enumerate(tranches):
+            name = f'{"sequential" if sequential else "pro-rata"} path {path} tranche {security.trancheList[index].subordination}'
+            for field, column in columns.items():
+                batched = waterfall[field][index, path, :len(column)]
+                assert numpy.allclose(column, batched, rtol=1e-9, atol=1e-6), f'{name}: {field} differs'
+                # After the object waterfall's last period, the batched one must not move any more cash
+                rest = waterfall[field][index, path, len(column):]
+                if field.endswith('payment') and len(rest):
+                    assert numpy.allclose(rest, 0., atol=1e-6), f'{name}: {field} paid after the waterfall ended'
+            objectIRR = -12. if math.isnan(objectIRR) else objectIRR
+            assert math.isclose(objectIRR, IRR[index, path], abs_tol=1e-4), f'{name}: IRR differs'
+            assert round((security.trancheList[index].rate - objectIRR) * 10000) == RIY[index, path], f'{name}: RIY differs'
+            if objectAL is None:
+                assert math.isnan(AL[index, path]), f'{name}: AL differs (not paid down)'
+            else:
+                assert math.isclose(objectAL, AL[index, path], rel_tol=1e-9), f'{name}: AL differs'
+    print(f'{"Sequential" if sequential else "Pro-rata"}: {nPaths} paths x {len(security.trancheList)} tranches match')
+
+
+def main():
+    print('=== 1.2 Test) Batched waterfall versus object waterfall')
+    loansList = LoanTape.read('Loans.csv', nRows=200).toLoans()
+    # Heavy defaults, so the junior tranches take losses and the shortfall paths of the waterfall are exercised
+    loanPool = LoanPool(loansList, defaultSampler=DefaultSampler(defaultModel=CDRDefaultModel(0.3)), seed=2020)
+    security = StructuredSecurities(loanPool)
+    security.addTranche(StandardTranche, 0.6, 0.05, 'A')
+    security.addTranche(StandardTranche, 0.25, 0.07, 'B')
+    security.addTranche(StandardTranche, 0.15, 0.09, 'C')
+
+    for sequential in (True, False):
+        checkPaths(security, sequential, 20)
+    print('Batched waterfall: OK')
+
+
+if __name__ == '__main__':
+    main()
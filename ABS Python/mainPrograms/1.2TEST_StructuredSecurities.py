@@ -22,9 +22,6 @@ def main():
     loanPool = LoanPool([loan1, loan2])
     security = StructuredSecurities(loanPool)
 
-    # Toggle to pro-rata by passing in False for setSequential() method:
-    security.setSequential(True)
-
 
     ##### LIABILITIES SIDE
     # Append a senior, 6% rate, and 80% notional StandardTranche A to the security
@@ -37,7 +34,8 @@ def main():
     print(security.trancheList)
 
     # Do waterfall and print it out by Loans (Assets) and Tranches (Liabilities)
-    security.doWaterfallSequential()
+    # Toggle to pro-rata by passing in sequential=False
+    security.doWaterfallSequential(sequential=True)
 
     print('\n=== ASSETS SIDE: Waterfall of the total loanPool and broken down by loans:')
     # LoanPool waterfall
@@ -4,37 +4,27 @@ Main program to test our StructuredSecurities class with a random component adde
 
 from package.StructuredSecuritiesABS import StructuredSecurities
 from package.Tranche import StandardTranche
-from package.LoanPool import Loan, LoanPool
-from package.Auto import Car
-import time, numpy
+from package.LoanPool import LoanPool
+from package.LoanTape import LoanTape
+from package.WaterfallWriter import AssetWaterfallWriter, LiabilityWaterfallWriter
+from package.Profiler import profiler
+import os, time, numpy
 
 
 
 def main():
 
+    # Set the ABS_PROFILE environment variable to time every stage of the waterfalls and simulations below.
+    # The report is written at the end (machine-specific timings: not for committing)
+    profile = bool(os.environ.get('ABS_PROFILE'))
+    if profile:
+        profiler.enable()
+
     print('=== WATERFALL')
     start = time.time()
 
-    # Initialize a blank list to append 1,500 loans and later pass into the loanPool object
-    loansList = []
-
-    with open('Loans.csv', 'r') as file:
-
-        # Skip the header row
-        next(file)
-
-        # Iterate over all rows/loans and split them by comma
-        for row in file:
-
-            # Store the values
-            temp = row.split(',')
-            asset = eval(f'{temp[5]}({(temp[6])})')
-            # Parse necessary data and instantiate the loans
-            loan = Loan(int(temp[4]), float(temp[3]), float(temp[2]), asset)
-            # Append
-            loansList.append(loan)
-            if len(loansList) == 200:
-                break
+    # Read the first 200 loans of the tape. Asset types are looked up in the LoanTape registry, and every bad row is reported at once
+    loansList = LoanTape.read('Loans.csv', nRows=200).toLoans()
 
     print('Appending loans: done')
 
@@ -49,60 +39,15 @@ def main():
 
 
     # Do waterfall (will take a while - 1,500 loans)
-    ABS.doWaterfallSequential()
+    # Both sides of the waterfall are streamed to the csv files as each period is produced
+    # The liabilities columns are built from the trancheList: 1 set of columns per tranche, in order of seniority
+    with AssetWaterfallWriter('13AssetWaterfall.csv') as assetWriter, \
+            LiabilityWaterfallWriter('13LiabilitiesWaterfall.csv', ABS.trancheList) as liabilityWriter:
+        ABS.doWaterfallSequential(writers=(assetWriter, liabilityWriter))
 
     print('ABS Waterfall: done')
 
-    ##### Assets
-    # Write the LoanPool Waterfall to the AssetWaterfall.csv file
-    with open('13AssetWaterfall.csv', 'w') as file:
-
-        # Write the header row
-        file.write('Period,Principal,Interest,Total,Balance\n')
-
-        # Loop through all the periods and write the LoanPool record into the csv file
-        for period, waterfall in ABS.loanPool.properties.items():
-
-            # period is key, waterfall is value. waterfall is the dictionary that holds the record for each period
-            file.write('{0},{1},{2},{3},{4}\n'.format(period, waterfall['Principal'], waterfall['Interest'], waterfall['Total'], waterfall['Balance']))
-
-
-    print('Writing asset waterfall to csv: done')
-
-
-    ##### Liabilities
-    # Write the Tranches Waterfall to the LiabilitiesWaterfall.csv file
-    with open('13LiabilitiesWaterfall.csv', 'w') as file:
-
-        # Write the header row
-        file.write('Period,Recoveries,TotalCollections(+ Reco + Reserve),A Interest Due,A Interest Paid,A Interest Shortfall,B Interest Due,'
-                   'B Interest Paid,B Interest Shortfall,A Prin Due,A Prin Paid,A Prin Shortfall,Cash Reserve,'
-                   'B Prin Due,B Prin Paid,B Prin Shortfall,A Balance,B Balance,Cash Reserve\n')
-
-        # Loop through the periods of the LoanPool and write the record for the tranches into the csv file
-        for period in ABS.loanPool.properties:
-
-            ### Hardcode: assuming our ABS will only have 2 tranches. Will not work with variable length trancheList.
-            trancheA = ABS.trancheList[0].properties[period]
-            trancheB = ABS.trancheList[1].properties[period]
-
-            file.write('{0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10},{11},{12},{13},{14},{15},{16},{17},{18}\n'.format(
-                period, ABS.loanPool.properties[period]['Recoveries'],
-                ABS.loanPool.properties[period]['Total'] + ABS.loanPool.properties[period]['Recoveries'] + ABS.trancheList[1].properties[period - 1]['Cash reserve'],
-                trancheA['Interest due'], trancheA['Interest payment'],
-                trancheA['Interest shortfall'], trancheB['Interest due'],
-                trancheB['Interest payment'],
-                trancheB['Interest shortfall'], trancheA['Principal due'],
-                trancheA['Principal payment'],
-                trancheA['Principal shortfall'], trancheA['Cash reserve'],
-                trancheB['Principal due'],
-                trancheB['Principal payment'], trancheB['Principal shortfall'],
-                trancheA['Notional balance'],
-                trancheB['Notional balance'], trancheB['Cash reserve']
-            ))
-
-
-    print('Writing liabilities waterfall to csv: done')
+    print('Writing asset and liabilities waterfalls to csv: done')
 
 
     end = time.time()
@@ -152,58 +97,33 @@ def main():
     '''
     Part 4: Simulations with multiprocessing
     '''
-    print('\n=== Part 4: Simulations with multiprocessing: 5 simulations with 5 sub-processes'
-    inputQ = mp.Queue()
-    outputQ = mp.Queue()
+    print('\n=== Part 4: Simulations with multiprocessing: 5 simulations with 5 sub-processes')
     nProcesses = 5
     start = time.time()
 
-    # 5 simulations total
-    for i in range(5):
-        inputQ.put((ABS.runMonteSequential, (nSims/nProcesses, monteTolerance) ))
-
-    processes = [mp.Process(target=doWork, args=(inputQ, outputQ) ) for i in range(nProcesses)]
-
-    for process in processes:
-        process.start()
-
-    # join() to ensure main will not proceed until all sub-processes are done
-    for process in processes:
-        process.join()
-
-
-    result = {}
-    # [Weighted RIY, Weighted AL, Fair rate]
-    result['A'] = [0, 0, 0]
-    result['B'] = [0, 0, 0]
+    # The chunks of simulations are spread over 5 persistent worker processes, each with its own random stream
+    # Same seed => same results, whatever the number of processes
+    weightedMetricsDict = ABS.simulateWaterfallParallel(nSims, nWorkers=nProcesses, seed=2020, chunkSize=1)
+    for tranche, metrics in weightedMetricsDict.items():
+        print(f'{tranche} (Weighted RIY, Weighted AL): {metrics}')
 
-    while True:
-        try:
-            r = outputQ.get(timeout=1)
-            for tranche, metricsTuple in r.items():
-                # Aggregate resulting tranche metrics and average them
-                result[tranche.subordination][0] += (r[tranche][0]) / nSims
-                result[tranche.subordination][1] += (r[tranche][1]) / nSims
-                result[tranche.subordination][2] += (r[tranche][2]) / nSims
-        except Empty:
-            break
+    # Every iteration of the Monte Carlo reuses the same worker processes
+    monteDict = ABS.runMonteSequential(nSims, monteTolerance, nWorkers=nProcesses, seed=2020)
+    for tranche, metrics in monteDict.items():
+        print(f'{tranche} (Weighted RIY, Weighted AL, Fair rate): {metrics}')
 
-    print(f'Results: {result}')
+    # Shut down the worker processes
+    ABS.closeWorkers()
 
     end = time.time()
 
     print(f'{nSims} simulations with {nProcesses} processes time taken: {end - start} seconds')
 
-def doWork(inputQ, outputQ):
-    while True:
-        try:
-            function, args = inputQ.get(timeout=1)
-            result = function(*args)
-            # Put a dictionary with key = tranche, value = 3-items-tuples (weighted RIY, weighted AL, fair rate)
-            outputQ.put(result)
-        except:
-            print('A doWork sub-process has finished')
-            break
+    # The worker processes have their own profilers: the report covers the work done in this process
+    if profile:
+        profiler.report('13Profile.txt')
+        profiler.report('13Profile.json', format='json')
+        print('Profile report written to 13Profile.txt and 13Profile.json')
 
 if __name__ == '__main__':
     main()
@@ -3,6 +3,7 @@ Asset class from Level 5
 '''
 
 import logging
+from package.Decorators import memoize
 
 
 class Asset(object):
@@ -50,6 +51,9 @@ class Asset(object):
     def monthlyDepreciation(self):
         return self.depreciation/12
 
+    # Cached on the asset's class, value and depreciation rather than on the asset itself, so the cache stays right
+    # if they change and doesn't keep the assets alive
+    @memoize(maxSize=4096, key=lambda asset, t: (type(asset), asset.value, asset.depreciation, t))
     def currentValue(self, t):
         # The current value of a given asset at period t = initial value * total depreciation at time t
         # We implement this in code
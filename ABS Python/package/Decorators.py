@@ -2,7 +2,8 @@
 Decorator functions from 5.2.1 and 5.2.2
 '''
 
-import time
+import sys, threading, time
+from collections import OrderedDict
 from functools import wraps
 
 '5.2.1: Timer'
@@ -24,29 +25,113 @@ def Timer(function):
 
     return timedFunction
 
+# Decorator profiling function: quiet twin of Timer for the hot paths. Every call is a span of the package's
+# profiler (see Profiler.py), reported with the others instead of printed. Costs 1 check per call while it is disabled
+# name: name of the span. Default is the function's qualified name
+def profiled(function=None, name=None):
+    if function is None:
+        return lambda function: profiled(function, name)
+    # Imported here so the decorators without a profiler keep working when this file is imported on its own
+    from package.Profiler import profiler
+    spanName = name if name is not None else function.__qualname__
+
+    @wraps(function)
+    def profiledFunction(*args, **kwargs):
+        if not profiler.enabled:
+            return function(*args, **kwargs)
+        with profiler.span(spanName):
+            return function(*args, **kwargs)
+
+    return profiledFunction
+
 '5.2.2: Memoization'
 
-# Empty cache dictionary for appending purposes
-dictionary = {}
+# Separates the positional from the keyword arguments in the cache keys. Also marks a cache miss
+_keywordMarker = object()
+
+# Decorator memoization function. Use as @memoize, or @memoize(maxSize=..., ...) to set the options
+# Every decorated function gets its OWN cache, bounded in number of entries (maxSize) and/or in bytes (maxBytes):
+# when full, the Least Recently Used entry is evicted, so the cache never grows past its bound in a long-running process
+# floatDigits: round the float arguments to this many decimals in the key, so values that only differ by
+# floating-point noise share an entry. Default None: exact values
+# key: function(*args, **kwargs) building the cache key instead of the arguments, i.e. to key an object method on
+# the attributes it reads rather than on the object itself (which would also keep the object alive)
+# The cache is locked, so the decorated function can be called from several threads
+def memoize(function=None, maxSize=1024, maxBytes=None, floatDigits=None, key=None):
+    if function is None:
+        return lambda function: memoize(function, maxSize, maxBytes, floatDigits, key)
+
+    cache = OrderedDict()
+    # Bytes of each entry, for the maxBytes bound
+    sizes = {}
+    # The function itself always runs outside the lock, so a plain Lock is enough, even for recursive functions
+    lock = threading.Lock()
+    # hits, misses, evictions, calls whose arguments can't be keys (i.e. numpy arrays), bytes held
+    counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'uncached': 0, 'bytes': 0}
+
+    # Float normalization: round, and fold -0.0 into 0.0. numpy.float64 values are floats too
+    def normalize(value):
+        if isinstance(value, float):
+            return round(value, floatDigits) + 0.
+        if isinstance(value, tuple):
+            return tuple(normalize(item) for item in value)
+        return value
 
-# Decorator memoization function
-def memoize(function):
     @wraps(function)
     def memoizedFunction(*args, **kwargs):
-        # Variable to store the key of the cache dictionary in a tuple
-        parameterTuple = (args, tuple(kwargs.values()))
-        # If the passed-in arguments tuple is not a key in the dictionary
-        if parameterTuple not in dictionary.keys():
-            # Then run the process-intensive function, and store that value in a newly created key in the dictionary
-            dictionary[parameterTuple] = function(*args, **kwargs)
-        # Return the value corresponding with the tuple of arguments
-        return dictionary[parameterTuple]
+        # Key of the cache: positional arguments, then the keyword arguments BY NAME, so their order doesn't matter
+        if key is not None:
+            cacheKey = key(*args, **kwargs)
+        elif kwargs:
+            cacheKey = args + (_keywordMarker,) + tuple(sorted(kwargs.items()))
+        else:
+            cacheKey = args
+        if floatDigits is not None:
+            cacheKey = normalize(cacheKey)
+        try:
+            with lock:
+                result = cache.get(cacheKey, _keywordMarker)
+                if result is not _keywordMarker:
+                    cache.move_to_end(cacheKey)
+                    counters['hits'] += 1
+                    return result
+        except TypeError:
+            # Unhashable arguments: nothing to cache
+            with lock:
+                counters['uncached'] += 1
+            return function(*args, **kwargs)
 
-    return memoizedFunction
+        # Run the process-intensive function OUTSIDE the lock, so other threads (or recursive calls) aren't blocked
+        result = function(*args, **kwargs)
+        size = sys.getsizeof(cacheKey) + sys.getsizeof(result) if maxBytes is not None else 0
+        with lock:
+            counters['misses'] += 1
+            if cacheKey not in cache:
+                cache[cacheKey] = result
+                counters['bytes'] += size
+                sizes[cacheKey] = size
+            # Evict the least recently used entries until the cache is back within its bounds
+            while cache and ((maxSize is not None and len(cache) > maxSize) or
+                             (maxBytes is not None and counters['bytes'] > maxBytes)):
+                oldKey, _ = cache.popitem(last=False)
+                counters['bytes'] -= sizes.pop(oldKey)
+                counters['evictions'] += 1
+        return result
+
+    # Dictionary of the cache statistics, for monitoring
+    def cacheInfo():
+        with lock:
+            return dict(counters, size=len(cache), maxSize=maxSize, maxBytes=maxBytes)
 
-    # Dictionary keys will consist of tuples of 2 sub-tuples: 1st is positional *args and 2nd is **kwargs
-    # Dictionary values will consist of integers
-    # print(dictionary)
+    def cacheClear():
+        with lock:
+            cache.clear()
+            sizes.clear()
+            counters.update(hits=0, misses=0, evictions=0, uncached=0, bytes=0)
+
+    memoizedFunction.cacheInfo = cacheInfo
+    memoizedFunction.cacheClear = cacheClear
+    return memoizedFunction
 
     # Regular functions for Test 2 in 5.2.2
 def searchExt(treeStructure, extension=''):
@@ -0,0 +1,165 @@
+'''
+DefaultModel classes: the default assumptions of the Monte Carlo, separated from the waterfall
+Every model returns the per-period default probability (hazard) of every loan in the pool as ONE (loans x periods)
+array, so the credit assumptions can be swapped without touching the LoanPool or the waterfall
+'''
+
+import numpy
+
+
+class DefaultModel(object):
+    # lastPeriod: last period covered by the model. Loans can't default after it
+    # uniform: True if every loan gets the same hazards, so the DefaultSampler can use a single curve for the whole pool
+    uniform = False
+
+    def __init__(self, lastPeriod):
+        self.lastPeriod = lastPeriod
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {self.lastPeriod} periods'
+
+    def hazards(self, loanArrays):
+        '''
+        :param loanArrays: LoanArrays of the pool
+        :return: (loans x periods) array of the probability of defaulting in each period, given no default before.
+        Column index = period, from 0 to lastPeriod. Period 0 never defaults
+        '''
+        raise NotImplementedError('Derived DefaultModel classes must implement hazards()')
+
+    # Hazards shared by all the loans, for the uniform models
+    def curve(self):
+        raise NotImplementedError('Only uniform DefaultModel classes have a single hazard curve')
+
+
+class UniformDefaultModel(DefaultModel):
+    # Base class of the models where the hazard only depends on the period: derived classes implement curve()
+    uniform = True
+
+    def hazards(self, loanArrays):
+        # Same row for every loan, without copying it
+        curve = self.curve()
+        return numpy.broadcast_to(curve, (len(loanArrays), len(curve)))
+
+
+class TableDefaultModel(UniformDefaultModel):
+    '''
+    Default table of the final project:
+
+    Period range    Default probability
+    1-10            0.0005
+    11-60           0.001
+    61-120          0.002
+    121-180         0.004
+    181-210         0.002
+    211-360         0.001
+    '''
+    defaultTable = {range(1, 11): 0.0005, range(11, 61): 0.001, range(61, 121): 0.002,
+                    range(121, 181): 0.004, range(181, 211): 0.002, range(211, 361): 0.001}
+
+    # defaultTable: dictionary with key = range of periods, value = probability of a loan defaulting in EACH period of the range
+    def __init__(self, defaultTable=None):
+        if defaultTable is None:
+            defaultTable = TableDefaultModel.defaultTable
+        for Range, probability in defaultTable.items():
+            if not 0 <= probability < 1:
+                raise ValueError(f'Default probability {probability} for periods {Range} must be in [0, 1)')
+        self.defaultTable = defaultTable
+        super(TableDefaultModel, self).__init__(max(Range[-1] for Range in defaultTable))
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {len(self.defaultTable)} ranges-{self.lastPeriod} periods'
+
+    def curve(self):
+        hazards = numpy.zeros(self.lastPeriod + 1)
+        for Range, probability in self.defaultTable.items():
+            hazards[Range.start:Range.stop] = probability
+        return hazards
+
+
+class CDRDefaultModel(UniformDefaultModel):
+    # cdr: constant ANNUAL default rate, i.e. 0.02 for 2 CDR. lastPeriod: number of periods covered
+    def __init__(self, cdr, lastPeriod=360):
+        if not 0 <= cdr < 1:
+            raise ValueError(f'CDR {cdr} must be in [0, 1)')
+        self.cdr = cdr
+        super(CDRDefaultModel, self).__init__(lastPeriod)
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {self.cdr}-{self.lastPeriod} periods'
+
+    # Monthly default rate equivalent to an annual rate
+    @staticmethod
+    def monthlyRate(cdr):
+        return 1 - (1 - cdr) ** (1 / 12)
+
+    def curve(self):
+        hazards = numpy.full(self.lastPeriod + 1, CDRDefaultModel.monthlyRate(self.cdr))
+        hazards[0] = 0.
+        return hazards
+
+
+class SDADefaultModel(UniformDefaultModel):
+    '''
+    Standard Default Assumption curve, by loan age in months, at 100% speed:
+    CDR rises by 0.02% a month to 0.60% at month 30, stays at 0.60% until month 60,
+    falls by 0.0095% a month to 0.03% at month 120, and stays at 0.03% after that
+    '''
+    # speed: percentage of the standard curve, i.e. 200 for twice the standard defaults
+    def __init__(self, speed=100, lastPeriod=360):
+        if speed < 0:
+            raise ValueError(f'SDA speed {speed} must be positive')
+        self.speed = speed
+        super(SDADefaultModel, self).__init__(lastPeriod)
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {self.speed}% SDA-{self.lastPeriod} periods'
+
+    def curve(self):
+        age = numpy.arange(self.lastPeriod + 1)
+        cdr = numpy.where(age <= 30, 0.0002 * age, numpy.where(age <= 60, 0.006, numpy.maximum(0.006 - 0.000095 * (age - 60), 0.0003)))
+        cdr = numpy.minimum(cdr * self.speed / 100, 0.999999)
+        return CDRDefaultModel.monthlyRate(cdr)
+
+
+class LoanLevelDefaultModel(DefaultModel):
+    '''
+    Proportional hazards on top of a uniform base curve: each loan's risk is scaled by
+    exp(rateSensitivity * (rate - referenceRate) + ltvSensitivity * (LTV - 1)) * asset class multiplier
+    where LTV = balance / current asset value (= 1 - Loan.equity / Asset.currentValue) at each period
+    '''
+    # baseModel: uniform DefaultModel for an average loan. Default is the final project table
+    # rateSensitivity: risk increase per unit of rate above referenceRate (i.e. 10 -> +10% risk for 1% more rate)
+    # ltvSensitivity: risk increase per unit of LTV above 100%
+    # assetClassMultipliers: dictionary of risk multipliers by asset class name (i.e. {'Lamborghini': 0.5}). Default 1
+    # referenceRate: rate of an average loan. Default is the pool's face-weighted average rate
+    def __init__(self, baseModel=None, rateSensitivity=0., ltvSensitivity=0., assetClassMultipliers=None, referenceRate=None):
+        self.baseModel = baseModel if baseModel is not None else TableDefaultModel()
+        if not self.baseModel.uniform:
+            raise TypeError('The base model of a LoanLevelDefaultModel must be a uniform DefaultModel')
+        self.rateSensitivity = rateSensitivity
+        self.ltvSensitivity = ltvSensitivity
+        self.assetClassMultipliers = dict(assetClassMultipliers or {})
+        self.referenceRate = referenceRate
+        super(LoanLevelDefaultModel, self).__init__(self.baseModel.lastPeriod)
+
+    def hazards(self, loanArrays):
+        periods = numpy.arange(self.lastPeriod + 1)
+
+        # Balance going INTO each period, from the pool amortization (0 after the schedule ends)
+        # A loan that hasn't prepaid still owes its scheduled balance, so prepayments don't change its LTV
+        balance = numpy.zeros((len(loanArrays), self.lastPeriod + 1))
+        scheduled = loanArrays.amortization()['Balance'][:, :self.lastPeriod]
+        balance[:, 1:scheduled.shape[1] + 1] = scheduled
+        value = loanArrays.assetValue[:, None] * (1 - loanArrays.depreciation[:, None] / 12) ** periods
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            LTV = numpy.where(value > 0, balance / value, 0.)
+
+        referenceRate = self.referenceRate
+        if referenceRate is None:
+            referenceRate = numpy.average(loanArrays.rate, weights=loanArrays.face) if loanArrays.face.sum() > 0 else 0.
+        classMultiplier = numpy.array([self.assetClassMultipliers.get(assetClass, 1.) for assetClass in loanArrays.assetClass])
+        multiplier = numpy.exp(self.rateSensitivity * (loanArrays.rate[:, None] - referenceRate) + self.ltvSensitivity * (LTV - 1))
+        multiplier *= classMultiplier[:, None]
+
+        # Scale the cumulative hazard (-log of survival) so the probabilities stay in [0, 1)
+        return -numpy.expm1(multiplier * numpy.log1p(-self.baseModel.curve()))
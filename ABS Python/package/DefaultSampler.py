@@ -0,0 +1,151 @@
+'''
+DefaultSampler class for the Monte Carlo default model
+A loan can only default once, so instead of drawing a random number for every loan in every period,
+we draw each loan's default period ONCE per simulation by inverting the cumulative default probability
+The default probabilities themselves come from a DefaultModel (see DefaultModel.py)
+'''
+
+import numpy
+
+from package.DefaultModel import TableDefaultModel
+
+
+class DefaultSampler(object):
+    # Default table of the final project. See TableDefaultModel
+    defaultTable = TableDefaultModel.defaultTable
+
+    # defaultTable: dictionary with key = range of periods, value = probability of a loan defaulting in EACH period of the range
+    # defaultModel: DefaultModel to use instead of a table, i.e. SDADefaultModel(200) or a LoanLevelDefaultModel
+    def __init__(self, defaultTable=None, defaultModel=None):
+        self.defaultModel = defaultModel if defaultModel is not None else TableDefaultModel(defaultTable)
+        self.defaultTable = getattr(self.defaultModel, 'defaultTable', None)
+
+        # Last period covered by the model. Loans can't default after it
+        self.lastPeriod = self.defaultModel.lastPeriod
+
+        # Uniform models: per-period default probability (hazard) shared by every loan, index = period. Period 0 never defaults
+        # Cumulative hazard: -log of the probability of surviving up to and including each period
+        # A loan defaults in the first period where the cumulative hazard exceeds an exponential draw, which gives
+        # exactly the same distribution as flipping a coin with the period's probability in every period
+        if self.defaultModel.uniform:
+            self.hazards = self.defaultModel.curve()
+            self.cumulativeHazard = numpy.cumsum(-numpy.log1p(-self.hazards))
+        else:
+            self.hazards = self.cumulativeHazard = None
+
+        # Loan-level models: (loans x periods) cumulative hazards of the last pool, computed once per pool
+        self._poolCache = (None, None)
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {self.defaultModel}'
+
+    # Default period for loans that never default: 1 past the end of the model, so 'defaultPeriod <= period' is always False
+    @property
+    def noDefault(self):
+        return self.lastPeriod + 1
+
+    def cumulativeHazards(self, loanArrays=None):
+        '''
+        :param loanArrays: LoanArrays of the pool. Only needed for the models that are not uniform
+        :return: cumulative hazard by period, 1-D for uniform models, (loans x periods) for loan-level models
+        '''
+        if self.defaultModel.uniform:
+            return self.cumulativeHazard
+        if loanArrays is None:
+            raise TypeError(f'{self.defaultModel} needs the LoanArrays of the pool. The loans must be vectorizable.')
+        cachedArrays, cumulative = self._poolCache
+        if cachedArrays is not loanArrays:
+            cumulative = numpy.cumsum(-numpy.log1p(-self.defaultModel.hazards(loanArrays)), axis=1)
+            self._poolCache = (loanArrays, cumulative)
+        return cumulative
+
+    def fromUniforms(self, uniforms, loanArrays=None):
+        '''
+        Inverse-CDF of the default model
+        :param uniforms: array of uniform [0, 1) numbers, one per loan (last axis)
+        :param loanArrays: LoanArrays of the pool, for the models that are not uniform
+        :return: integer array of default periods, noDefault for the loans that never default
+        '''
+        with numpy.errstate(divide='ignore'):
+            exponentials = -numpy.log1p(-numpy.asarray(uniforms, dtype=float))
+        cumulative = self.cumulativeHazards(loanArrays)
+        if cumulative.ndim == 1:
+            return numpy.searchsorted(cumulative, exponentials, side='right').astype(numpy.int64)
+        # Each loan searches its own row
+        rows = numpy.broadcast_to(numpy.arange(cumulative.shape[0]), exponentials.shape)
+        return _rowSearch(cumulative, exponentials, rows, 1000.)
+
+    def sample(self, nLoans, rng, loanArrays=None, antithetic=False):
+        '''
+        :param nLoans: number of loans in the pool, or a (paths, loans) shape to draw a block of paths at once
+        :param rng: numpy.random.Generator
+        :param loanArrays: LoanArrays of the pool, for the models that are not uniform
+        :param antithetic: True to draw the paths in antithetic pairs: path 2k + 1 uses 1 - the uniforms of path 2k,
+        so a path with early defaults is paired with one with late defaults. Needs a (paths, loans) shape
+        :return: integer array of default periods, one per loan (and per path)
+        '''
+        if not antithetic:
+            return self.fromUniforms(rng.random(nLoans), loanArrays)
+        nPaths, nLoans = nLoans
+        uniforms = rng.random(((nPaths + 1) // 2, nLoans))
+        pairs = numpy.stack([uniforms, 1 - uniforms], axis=1).reshape(-1, nLoans)
+        return self.fromUniforms(pairs[:nPaths], loanArrays)
+
+    def periodProbabilities(self, nPeriods, loanArrays=None):
+        '''
+        :param nPeriods: number of periods, starting at period 0
+        :param loanArrays: LoanArrays of the pool, for the models that are not uniform
+        :return: nPeriods + 1 probabilities: defaulting in each period, and last, not defaulting before nPeriods.
+        1-D for uniform models, 1 row per loan otherwise
+        '''
+        # Probability of surviving through each period. Past the end of the model nobody defaults anymore
+        cumulative = self.cumulativeHazards(loanArrays)
+        survival = numpy.ones(cumulative.shape[:-1] + (nPeriods + 1,))
+        survival[..., 1:] = numpy.exp(-cumulative[..., numpy.minimum(numpy.arange(nPeriods), self.lastPeriod)])
+        return numpy.concatenate([survival[..., :-1] - survival[..., 1:], survival[..., -1:]], axis=-1)
+
+    def sampleCounts(self, counts, rng, nPeriods, nPaths=None, loanArrays=None):
+        '''
+        Default draws for rep lines: how many of each line's loans default in each period, i.e. a multinomial draw over
+        periodProbabilities(). Sampled as the number of defaulted loans per line (binomial), then a default period
+        for each of those loans only, so the cost scales with the number of defaults rather than lines x periods
+        :param counts: number of loans in each rep line
+        :param rng: numpy.random.Generator
+        :param nPeriods: number of periods to return, starting at period 0. Later defaults are dropped
+        :param nPaths: number of paths to draw at once. Default is a single path
+        :param loanArrays: LoanArrays of the rep lines, for the models that are not uniform
+        :return: integer array (lines x periods), or (paths x lines x periods)
+        '''
+        counts = numpy.asarray(counts, dtype=numpy.int64)
+        shape = counts.shape if nPaths is None else (nPaths, len(counts))
+        probabilities = self.periodProbabilities(nPeriods, loanArrays)
+        defaultProbability = 1 - probabilities[..., -1]
+
+        # Number of loans of each line defaulting before nPeriods
+        nDefaults = rng.binomial(numpy.broadcast_to(counts, shape), numpy.clip(defaultProbability, 0., 1.))
+        if not nDefaults.any():
+            return numpy.zeros(shape + (nPeriods,), dtype=numpy.int64)
+
+        # Period of each of these defaults: inverse-CDF of the default period, given that the loan defaults before nPeriods
+        cells = numpy.repeat(numpy.arange(nDefaults.size), nDefaults.reshape(-1))
+        uniforms = rng.random(len(cells))
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            cumulative = numpy.cumsum(probabilities[..., :-1], axis=-1) / defaultProbability[..., None]
+        if cumulative.ndim == 1:
+            periods = numpy.searchsorted(cumulative, uniforms, side='right')
+        else:
+            periods = _rowSearch(numpy.nan_to_num(cumulative), uniforms, cells % len(counts), 2.)
+        periods = numpy.minimum(periods, nPeriods - 1)
+
+        # Count the defaults per (path, line, period) cell
+        return numpy.bincount(cells * nPeriods + periods, minlength=nDefaults.size * nPeriods).reshape(shape + (nPeriods,))
+
+
+# INTERNAL FUNCTION: searchsorted of each value in its own row of a matrix with increasing rows, all in one call
+# The rows are laid end to end, each shifted by a multiple of scale, which must be larger than any value that matters
+def _rowSearch(matrix, values, rows, scale):
+    cap = scale / 2
+    nColumns = matrix.shape[1]
+    flat = (numpy.minimum(matrix, cap) + numpy.arange(matrix.shape[0])[:, None] * scale).reshape(-1)
+    shifted = numpy.minimum(values, cap) + rows * scale
+    return (numpy.searchsorted(flat, shifted, side='right') - rows * nColumns).astype(numpy.int64)
@@ -0,0 +1,114 @@
+'''
+Vectorized IRR engine for tranche cash flows
+numpy.irr was removed in numpy 1.20, and it solved a polynomial root problem that costs O(periods^3) per cash flow.
+Here we solve NPV(r) = 0 with Newton's method for ALL the paths at once, and fall back to a bracketed Brent search
+for the few paths where Newton does not converge
+'''
+
+import numpy
+
+
+def solveIRR(cashFlows, guess=None, tolerance=1e-12, maxIterations=50):
+    '''
+    :param cashFlows: (paths x periods) array of cash flows, period 0 first. A 1-D array is treated as a single path
+    :param guess: warm start: a periodic rate, or an array with 1 rate per path (i.e. the tranche coupon / 12)
+    :param tolerance: Newton stops when the rate moves by less than this
+    :param maxIterations: maximum number of Newton iterations before falling back to Brent
+    :return: array of PERIODIC IRRs, 1 per path. nan where the NPV never crosses 0 (i.e. nothing is paid back)
+    '''
+    cashFlows = numpy.atleast_2d(numpy.asarray(cashFlows, dtype=float))
+    nPaths, nPeriods = cashFlows.shape
+    periods = numpy.arange(nPeriods)
+
+    rates = numpy.full(nPaths, 0.01) if guess is None else numpy.broadcast_to(numpy.asarray(guess, dtype=float), (nPaths,)).copy()
+    converged = numpy.zeros(nPaths, dtype=bool)
+    failed = numpy.zeros(nPaths, dtype=bool)
+
+    with numpy.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        for iteration in range(maxIterations):
+            todo = ~(converged | failed)
+            if not todo.any():
+                break
+            # NPV and its derivative for the paths still being solved
+            discount = (1 + rates[todo, None]) ** -periods
+            NPV = (cashFlows[todo] * discount).sum(axis=1)
+            derivative = (-periods * cashFlows[todo] * discount / (1 + rates[todo, None])).sum(axis=1)
+            step = NPV / derivative
+            newRates = rates[todo] - step
+
+            # Newton fails if it jumps to a rate of -100% or below, or the derivative vanishes
+            bad = ~numpy.isfinite(newRates) | (newRates <= -1)
+            rates[todo] = numpy.where(bad, rates[todo], newRates)
+            indices = numpy.flatnonzero(todo)
+            failed[indices[bad]] = True
+            converged[indices[~bad & (numpy.abs(step) < tolerance)]] = True
+
+    # Bracketed Brent fallback for the paths where Newton failed or ran out of iterations
+    for path in numpy.flatnonzero(~converged):
+        rates[path] = _brentIRR(cashFlows[path], tolerance)
+
+    return rates
+
+
+def annualIRR(cashFlows, guess=None, periodsPerYear=12):
+    '''
+    Same as solveIRR, with monthly -> annual conversion by multiplying by 12 like Tranche.IRR
+    :param guess: warm start as an ANNUAL rate (i.e. the tranche coupon), or an array of them
+    :return: array of ANNUAL IRRs, 1 per path
+    '''
+    monthlyGuess = None if guess is None else numpy.asarray(guess, dtype=float) / periodsPerYear
+    return solveIRR(cashFlows, monthlyGuess) * periodsPerYear
+
+
+# INTERNAL FUNCTION to find the IRR of 1 cash flow with Brent's method. nan if no bracket can be found
+def _brentIRR(cashFlows, tolerance):
+    periods = numpy.arange(len(cashFlows))
+
+    def NPV(rate):
+        return float((cashFlows * (1 + rate) ** -periods).sum())
+
+    # Bracket the root between a rate close to -100% and a rate that we widen until the NPV changes sign
+    a, b = -0.99, 1.
+    with numpy.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        fa, fb = NPV(a), NPV(b)
+        while fa * fb > 0 and b < 1e6:
+            b *= 10
+            fb = NPV(b)
+        if not (numpy.isfinite(fa) and numpy.isfinite(fb)) or fa * fb > 0:
+            return numpy.nan
+
+        # Brent's method: inverse quadratic interpolation / secant, with bisection as the safety net
+        c, fc = a, fa
+        d = e = b - a
+        for iteration in range(200):
+            if fb * fc > 0:
+                c, fc = a, fa
+                d = e = b - a
+            if abs(fc) < abs(fb):
+                a, b, c = b, c, b
+                fa, fb, fc = fb, fc, fb
+            tol = 2 * numpy.finfo(float).eps * abs(b) + tolerance / 2
+            middle = (c - b) / 2
+            if abs(middle) <= tol or fb == 0:
+                return b
+            if abs(e) >= tol and abs(fa) > abs(fb):
+                s = fb / fa
+                if a == c:
+                    p, q = 2 * middle * s, 1 - s
+                else:
+                    q, r = fa / fc, fb / fc
+                    p = s * (2 * middle * q * (q - r) - (b - a) * (r - 1))
+                    q = (q - 1) * (r - 1) * (s - 1)
+                if p > 0:
+                    q = -q
+                p = abs(p)
+                if 2 * p < min(3 * middle * q - abs(tol * q), abs(e * q)):
+                    e, d = d, p / q
+                else:
+                    d = e = middle
+            else:
+                d = e = middle
+            a, fa = b, fb
+            b += d if abs(d) > tol else (tol if middle > 0 else -tol)
+            fb = NPV(b)
+    return b
@@ -4,7 +4,8 @@ scroll to bottom for Monte Carlo ABS Loan default methods
 '''
 
 from package.Asset import Asset
-import logging
+from package.Decorators import memoize
+import logging, numpy
 
 
 class Loan(object):
@@ -13,6 +14,9 @@ class Loan(object):
         # rate: ANNUAL rate
         # face: face value
 
+        # Cached amortization schedule, built the first time any period is queried. See schedule() below
+        self._schedule = None
+
         # if term is not a positive integer, we log the error and raise an exception
         if not isinstance(term, int) or term < 0:
             logging.error('User inputs {term} which is of type "{type}". The parameter term expects a positive integer'.format(term=term, type=type(term).__name__))
@@ -77,6 +81,8 @@ class Loan(object):
     @term.setter
     def term(self, iterm):
         self._term = iterm
+        # The cached schedule is stale once term/rate/face change
+        self._schedule = None
 
     @property
     def rate(self):
@@ -84,6 +90,7 @@ class Loan(object):
     @rate.setter
     def rate(self, irate):
         self._rate = irate
+        self._schedule = None
 
     @property
     def face(self):
@@ -91,6 +98,16 @@ class Loan(object):
     @face.setter
     def face(self, iface):
         self._face = iface
+        self._schedule = None
+
+    # Method to lazily build and cache the full amortization schedule of the loan, from period 0 to term + 1
+    # All the per-period FORMULA methods below become lookups into these arrays
+    def schedule(self):
+        if self._schedule is None:
+            self._schedule = Loan.calcSchedule(self.term, self.rate, self.face, numpy.arange(self._term + 2))
+            # The monthly payment is the same for every period before maturity, so cache it as well
+            self._schedule['Monthly payment'] = Loan.calcMonthlyPmt(self.term, self.rate, self.face)
+        return self._schedule
 
     @property
     def type(self):
@@ -109,7 +126,7 @@ class Loan(object):
         # When the loan matures OR it is defaulted, it shouldnt produce any more monthly payment. Cap it at 0
         if self.isDefault or period > self.term * 12:
             return 0
-        return Loan.calcMonthlyPmt(self.term, self.rate, self.face)
+        return self.schedule()['Monthly payment']
         # # Implement the formula to determine periodic payment
         # numerator = self.rate * self.face * (1 + self.rate) ** (self.term)
         # denominator = (1 + self.rate) ** self.term - 1
@@ -153,6 +170,9 @@ class Loan(object):
     def interestDueFormula(self, period):
         # Object level method so we must adjust for self.rate which is originally in annual terms
         if self.isDefault == False:
+            # O(1) lookup in the cached schedule. Periods outside of the schedule go through the formula
+            if 0 <= period <= self._term + 1:
+                return self.schedule()['Interest'][period]
             return self.rate/12 * self.balanceFormula(period - 1)
         else:
             return 0
@@ -167,6 +187,9 @@ class Loan(object):
     def balanceFormula(self, period):
         # If the loan is not defaulted, return the value
         if self.isDefault == False:
+            # O(1) lookup in the cached schedule. Periods outside of the schedule go through the class-level method
+            if 0 <= period <= self._term + 1:
+                return self.schedule()['Balance'][period]
             return Loan.calcBalance(self.term, self.rate, self.face, period)
         # If it is defaulted, return 0 for the balance
         else:
@@ -178,7 +201,10 @@ class Loan(object):
     # It's important to get the class-level method right, because all the object-level methods delegate to them
     # It's OK to have a messy formulas in the class-level methods, it is way more important to centralize
     # the action so it's easier to debug.
+    # Called for every period of every loan by calcBalance and the object waterfall, always with the same few
+    # (term, rate, face) triples: cached, with a bound so a long-running process doesn't pile them up
     @classmethod
+    @memoize(maxSize=4096)
     def calcMonthlyPmt(cls, term, rate, face):
         # Convert annual to monthly to clean up formulas implementation
         term *= 12
@@ -212,6 +238,39 @@ class Loan(object):
         # Cap the FLOOR of the balance at 0, can't have a negative balance!
         return result if result > 0.1 else 0
 
+    @classmethod
+    def calcSchedule(cls, term, rate, face, periods):
+        '''
+        Vectorized twin of calcBalance/monthlyPayment/interestDueFormula/principalDueFormula for a NON-defaulted loan.
+        term, rate and face can be scalars OR column arrays (one row per loan), so a whole pool is done in one pass
+        :param term: ANNUAL term (same convention as calcBalance)
+        :param rate: ANNUAL rate
+        :param face: face value
+        :param periods: 1-D array of periods
+        :return: dictionary of arrays with keys 'Balance', 'Interest', 'Principal', 'Payment', shaped (loans x periods)
+        '''
+        term = numpy.asarray(term, dtype=float)
+        rate = numpy.asarray(rate, dtype=float)
+        face = numpy.asarray(face, dtype=float)
+        periods = numpy.asarray(periods)
+
+        # Same steps as calcMonthlyPmt, but on arrays
+        monthlyRate = rate / 12
+        numerator = monthlyRate * face * (1 + monthlyRate) ** (term * 12)
+        denominator = (1 + monthlyRate) ** (term * 12) - 1
+        pmt = numerator / denominator
+
+        # Same formula as calcBalance, including the floor of 0 for tiny/negative balances
+        def balance(period):
+            growth = (1 + monthlyRate) ** period
+            result = face * growth - pmt * ((growth - 1) / monthlyRate)
+            return numpy.where(result > 0.1, result, 0.)
+
+        # Same rules as the object-level methods: no payment once the loan matures, interest is on last period's balance
+        payment = numpy.where(periods > term * 12, 0., pmt)
+        interest = monthlyRate * balance(periods - 1)
+        return {'Balance': balance(periods), 'Interest': interest, 'Principal': payment - interest, 'Payment': payment}
+
     '''
     Exercise 2.1.5: Static-level methods    
     '''
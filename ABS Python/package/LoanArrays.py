@@ -0,0 +1,267 @@
+'''
+LoanArrays class: struct-of-arrays representation of a LoanPool
+Instead of looping over 1,500 Loan objects every period, we hold each loan attribute as a numpy column
+and compute the whole (loans x periods) amortization schedule in one vectorized pass
+'''
+
+import numpy
+
+from package.Loan import Loan
+
+
+class LoanArrays(object):
+    # term: MONTHLY terms, rate: ANNUAL rates, face: face values, assetValue: initial asset values,
+    # depreciation: ANNUAL depreciation rates, assetClass: asset class names (i.e. 'Car', 'Civic')
+    # count: number of loans each row stands for. Default is 1 loan per row. A row with count > 1 is a rep line
+    # (see compress()): its face and assetValue are the SUMS over its loans
+    def __init__(self, term, rate, face, assetValue, depreciation, assetClass, count=None):
+        self.term = numpy.asarray(term, dtype=numpy.int64)
+        self.rate = numpy.asarray(rate, dtype=float)
+        self.face = numpy.asarray(face, dtype=float)
+        self.assetValue = numpy.asarray(assetValue, dtype=float)
+        self.depreciation = numpy.asarray(depreciation, dtype=float)
+        self.assetClass = numpy.asarray(assetClass, dtype=object)
+        self.count = numpy.ones(len(self.term), dtype=numpy.int64) if count is None else numpy.asarray(count, dtype=numpy.int64)
+
+        # All the columns must describe the same loans
+        for column in (self.rate, self.face, self.assetValue, self.depreciation, self.assetClass, self.count):
+            if column.shape != self.term.shape:
+                raise ValueError('LoanArrays columns must all have the same length. Please create new.')
+        if (self.count < 1).any():
+            raise ValueError('LoanArrays count must be at least 1 loan per row. Please create new.')
+
+        # Aggregation error of a compressed pool versus the full pool. None if the rows are not the result of compress()
+        self.aggregationError = None
+
+        # Voluntary prepayment assumption (see PrepaymentModel.py), applied to schedule(). None means no prepayment
+        self._prepaymentModel = None
+
+        # The schedules are computed lazily and cached, because the terms/rates/faces never change for a given pool
+        self._amortization = None
+        self._schedule = None
+        # (loans x periods) fraction of each row that hasn't prepaid at the start of each period. None without prepayment
+        self._outstanding = None
+
+    def __len__(self):
+        return len(self.term)
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {len(self)} loans-{self.horizon} periods'
+
+    # Method to tell if a Loan object can be represented by the arrays
+    # Derived classes that override the payment formulas (i.e. MortgageMixin and its PMI) or variable rate loans
+    # can't be vectorized with the plain amortization formula
+    @staticmethod
+    def isVectorizable(loan):
+        loanClass = type(loan)
+        return (loanClass.monthlyPayment is Loan.monthlyPayment
+                and loanClass.balanceFormula is Loan.balanceFormula
+                and loanClass.interestDueFormula is Loan.interestDueFormula
+                and loanClass.principalDueFormula is Loan.principalDueFormula
+                and isinstance(loan.rate, float))
+
+    @classmethod
+    def fromLoans(cls, loansList, count=None):
+        '''
+        Factory method to build the arrays from a list of Loan objects
+        :param loansList: list of Loan objects
+        :param count: number of loans each Loan object stands for (rep lines). Default is 1 each
+        :return: LoanArrays object, or None if any loan can't be vectorized
+        '''
+        if not all(cls.isVectorizable(loan) for loan in loansList):
+            return None
+        return cls([loan._term for loan in loansList], [loan.rate for loan in loansList],
+                   [loan.face for loan in loansList], [loan.asset.value for loan in loansList],
+                   [loan.asset.depreciation for loan in loansList],
+                   [type(loan.asset).__name__ for loan in loansList], count)
+
+    # True if some rows stand for more than 1 loan, in which case defaults are drawn as counts per row
+    @property
+    def isCompressed(self):
+        return bool(len(self)) and int(self.count.max()) > 1
+
+    def compress(self, rateTolerance=0., balanceBucket=None):
+        '''
+        Aggregate the loans into representative lines. Loans are merged when they have the same term, asset class and
+        depreciation, and their rates (and balances, if balanceBucket is given) fall in the same bucket
+        :param rateTolerance: width of the rate buckets. 0 merges only loans with exactly the same rate (exact compression)
+        :param balanceBucket: width of the face value buckets, so that big and small loans default separately. Default is no buckets
+        :return: (LoanArrays of the rep lines, array with the rep line of every loan).
+        The rep lines' aggregationError is filled in, see aggregationErrorVersus()
+        '''
+        rateKey = self.rate if rateTolerance == 0 else numpy.floor(self.rate / rateTolerance)
+        faceKey = numpy.zeros(len(self)) if balanceBucket is None else numpy.floor(self.face / balanceBucket)
+        classNames, classKey = numpy.unique(self.assetClass.astype(str), return_inverse=True)
+        keys = numpy.column_stack([self.term, rateKey, faceKey, self.depreciation, classKey.reshape(-1)])
+        _, first, line = numpy.unique(keys, axis=0, return_index=True, return_inverse=True)
+        line = line.reshape(-1)
+
+        # Sum the face and asset values of each line. The rate is the face-weighted average of the line's rates
+        face = numpy.bincount(line, weights=self.face)
+        rateFace = numpy.bincount(line, weights=self.rate * self.face)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            rate = numpy.where(face > 0, rateFace / face, self.rate[first])
+        compressed = LoanArrays(self.term[first], rate, face, numpy.bincount(line, weights=self.assetValue),
+                                self.depreciation[first], self.assetClass[first],
+                                numpy.bincount(line, weights=self.count).astype(numpy.int64))
+        # The rep lines prepay like the loans they stand for
+        compressed.prepaymentModel = self._prepaymentModel
+        compressed.aggregationError = compressed.aggregationErrorVersus(self)
+        return compressed, line
+
+    def aggregationErrorVersus(self, other):
+        '''
+        :param other: LoanArrays of the full pool
+        :return: dictionary with key = schedule field, value = largest error of the pool total over all the periods,
+        relative to the largest pool total of that field. 0 means the rep lines reproduce the full pool exactly
+        '''
+        mine, full = self.schedule(), other.schedule()
+        nColumns = max(mine['Balance'].shape[1], full['Balance'].shape[1])
+        errors = {}
+        for field in ('Balance', 'Interest', 'Principal', 'Payment'):
+            totals = [numpy.pad(schedule[field].sum(axis=0), (0, nColumns - schedule[field].shape[1])) for schedule in (mine, full)]
+            scale = numpy.abs(totals[1]).max() if len(other) else 0.
+            errors[field] = float(numpy.abs(totals[0] - totals[1]).max() / scale) if scale > 0 else 0.
+        return errors
+
+    # Last period where any loan in the pool still has a payment due
+    @property
+    def horizon(self):
+        return int(self.term.max()) if len(self) else 0
+
+    @property
+    def prepaymentModel(self):
+        return self._prepaymentModel
+    @prepaymentModel.setter
+    def prepaymentModel(self, model):
+        # The schedule depends on the prepayments, so it must be rebuilt
+        self._prepaymentModel = model
+        self._schedule = self._outstanding = None
+
+    def amortization(self):
+        '''
+        Whole pool scheduled amortization, default-free and prepayment-free. Column index = period, from 0 to horizon + 1
+        (horizon + 1 is all zeros and is kept so that the period after the last payment can be read directly)
+        :return: dictionary of (loans x periods) matrices with keys 'Balance', 'Interest', 'Principal', 'Payment'
+        '''
+        if self._amortization is None:
+            periods = numpy.arange(self.horizon + 2)
+            # Divide by 12 exactly like the Loan.term getter so the maturity comparisons are identical
+            self._amortization = Loan.calcSchedule((self.term / 12)[:, None], self.rate[:, None], self.face[:, None], periods)
+        return self._amortization
+
+    def schedule(self):
+        '''
+        Whole pool schedule used by the waterfall: the amortization, with the prepaymentModel's prepayments if there is one.
+        Default-free: each row is the expected cashflow of the row's loans as long as they don't default
+        :return: dictionary of (loans x periods) matrices with keys 'Balance', 'Interest', 'Principal', 'Payment'.
+        'Principal' includes the prepayments. With a prepaymentModel, also 'Scheduled principal' and 'Prepaid principal'
+        '''
+        if self._schedule is None:
+            if self._prepaymentModel is None:
+                self._schedule = self.amortization()
+            else:
+                projection = self.project()
+                # The defaults of the Monte Carlo only hit the part of each row that hasn't prepaid yet
+                smm = self._prepaymentModel.smm(self, projection['Balance'].shape[1])
+                self._outstanding = numpy.ones(smm.shape)
+                self._outstanding[:, 1:] = numpy.cumprod(1 - smm[:, :-1], axis=1)
+                self._schedule = {'Balance': projection['Balance'], 'Interest': projection['Interest'],
+                                  'Principal': projection['Scheduled principal'] + projection['Prepaid principal'],
+                                  'Payment': projection['Payment'],
+                                  'Scheduled principal': projection['Scheduled principal'],
+                                  'Prepaid principal': projection['Prepaid principal']}
+        return self._schedule
+
+    def project(self, prepaymentModel=None, defaultModel=None, aggregate=False):
+        '''
+        Vectorized pool projection with prepayments and defaults applied together: in every period, the loans that
+        default stop paying (and recover), and the survivors pay their scheduled principal and interest, then a
+        fraction SMM of what's left prepays. Each row keeps the factor of its original balance that is still performing,
+        f(t) = f(t - 1) * (1 - MDR(t)) * (1 - SMM(t)), so the whole projection is a cumulative product and a few products
+        of (loans x periods) matrices, whatever the number of loans
+        :param prepaymentModel: PrepaymentModel. Default is the arrays' prepaymentModel (no prepayment if None)
+        :param defaultModel: DefaultModel for the expected defaults (MDR = its hazards). Default is no default
+        :param aggregate: True to sum over the loans and return 1-D pool totals by period
+        :return: dictionary of (loans x periods) matrices, or 1-D arrays if aggregate, with keys 'Balance', 'Interest',
+        'Scheduled principal', 'Prepaid principal', 'Payment', 'Defaulted balance', 'Recoveries'. Column index = period
+        '''
+        amortization = self.amortization()
+        nLoans, nColumns = amortization['Balance'].shape
+        prepaymentModel = self._prepaymentModel if prepaymentModel is None else prepaymentModel
+
+        smm = numpy.zeros((nLoans, nColumns)) if prepaymentModel is None else prepaymentModel.smm(self, nColumns)
+        mdr = numpy.zeros((nLoans, nColumns))
+        if defaultModel is not None:
+            hazards = defaultModel.hazards(self)[:, :nColumns]
+            mdr[:, :hazards.shape[1]] = hazards
+        # Loans that are already paid off can't default
+        previousBalance = numpy.zeros((nLoans, nColumns))
+        previousBalance[:, 1:] = amortization['Balance'][:, :-1]
+        mdr[previousBalance <= 0.] = 0.
+
+        # Factor of the original loans still performing at the end of each period, and at the start of each period
+        factor = numpy.cumprod((1 - mdr) * (1 - smm), axis=1)
+        startFactor = numpy.ones((nLoans, nColumns))
+        startFactor[:, 1:] = factor[:, :-1]
+        # Performing loans pay their schedule in the period, then part of them prepays the balance left
+        performing = startFactor * (1 - mdr)
+        defaulted = startFactor * mdr
+
+        projection = {'Balance': factor * amortization['Balance'],
+                      'Interest': performing * amortization['Interest'],
+                      'Scheduled principal': performing * amortization['Principal'],
+                      'Prepaid principal': performing * smm * amortization['Balance']}
+        projection['Payment'] = projection['Interest'] + projection['Scheduled principal'] + projection['Prepaid principal']
+        projection['Defaulted balance'] = defaulted * previousBalance
+        projection['Recoveries'] = defaulted * (self.assetValue[:, None] * (1 - self.depreciation[:, None] / 12) ** numpy.arange(nColumns) * 0.6)
+        if aggregate:
+            return {field: matrix.sum(axis=0) for field, matrix in projection.items()}
+        return projection
+
+    def lifetime(self):
+        # Number of periods with a positive balance for each loan: a loan is active in periods 0 to lifetime - 1
+        return numpy.count_nonzero(self.schedule()['Balance'] > 0., axis=1)
+
+    # Position of the first loan that still has anything due at the period. Only valid when the loans are sorted by term,
+    # which LoanPool guarantees: every loan before it has matured, so the pool aggregates can skip them
+    def liveStart(self, period):
+        return int(numpy.searchsorted(self.term, period, side='left'))
+
+    def endPeriodCounts(self, defaultCounts):
+        '''
+        Period when each loan stops being active (paid off or defaulted, whichever comes first), counted per row
+        :param defaultCounts: (..., rows x periods) number of loans of each row defaulting in each period
+        :return: (..., rows x periods) number of loans of each row ending in each period
+        '''
+        nColumns = defaultCounts.shape[-1]
+        lifetime = self.lifetime()
+        # Loans that default before they are paid off end at their default period. The others end when they are paid off
+        defaultsBefore = defaultCounts * (numpy.arange(nColumns) < lifetime[:, None])
+        ends = defaultsBefore.copy()
+        ends[..., numpy.arange(len(self)), lifetime] += self.count - defaultsBefore.sum(axis=-1)
+        return ends
+
+    def recoveryValue(self, period, loans=None):
+        '''
+        Vectorized Loan.recoveryValue: 60% of the current value of every asset at the given period
+        With prepayments, only the part of each row that hasn't prepaid before the period is left to default and recover
+        :param period: period, or a (1 x periods) row to get a (loans x periods) matrix
+        :param loans: row indices, to get the recovery of these loans only, each at its own period (same shape as period)
+        :return: recovery value of every loan (or of the given loans)
+        '''
+        if loans is not None:
+            value = self.assetValue[loans] * (1 - self.depreciation[loans] / 12) ** period * 0.6
+        elif numpy.ndim(period) == 2:
+            value = self.assetValue[:, None] * (1 - self.depreciation[:, None] / 12) ** period * 0.6
+        else:
+            value = self.assetValue * (1 - self.depreciation / 12) ** period * 0.6
+
+        self.schedule()
+        if self._outstanding is None:
+            return value
+        # Loans can default after the schedule ends (see DefaultSampler): nothing else prepays by then
+        column = numpy.minimum(period, self._outstanding.shape[1] - 1)
+        if loans is not None:
+            return value * self._outstanding[loans, column]
+        return value * self._outstanding[:, column.reshape(-1) if numpy.ndim(period) == 2 else column]
@@ -2,17 +2,49 @@
 LoanPool class from Level 4
 '''
 
-import numpy, random
+import numpy
 
 # When you run this class program you get a ModuleNotFoundError, but your main program still works well. WTF?
 from package.Loan import Loan
+from package.LoanArrays import LoanArrays
+from package.DefaultSampler import DefaultSampler
+from package.SobolSequence import SobolSequence
+from package.PeriodStore import PeriodStore
+from package.Profiler import profiler
+from package.Decorators import profiled
 # For lambda use
 import functools, logging
 
+
+class PoolPeriodCashflow(object):
+    # Snapshot of everything the loanPool pays in 1 period, computed ONCE by LoanPool.periodCashflow()
+    # and passed through the waterfall, instead of every step asking the loanPool for its totals again
+    def __init__(self, period, principal, interest, payment, balance, recoveries, activeLoans):
+        self.period = period
+        self.principal = principal
+        self.interest = interest
+        self.payment = payment
+        self.balance = balance
+        self.recoveries = recoveries
+        self.activeLoans = activeLoans
+
+    def __repr__(self):
+        return f'{type(self).__name__}: period {self.period}-{self.payment}-{self.recoveries}'
+
+    # Cash collected from the loanPool in the period: scheduled payments + recoveries from the defaulted loans
+    @property
+    def collections(self):
+        return self.payment + self.recoveries
+
+
 class LoanPool(object):
     # Because we don't know how many loans are in a given LoanPool/portfolio, we will have a default parameter blank list
     # Easier to work with .csv files than *args
-    def __init__(self, loansList = []):
+    # defaultSampler: DefaultSampler that draws the default period of every loan, from its DefaultModel. Defaults to the final project table
+    # seed: seed of the numpy random Generator used for the default draws, for reproducible simulations
+    # counts: number of loans each Loan object stands for, when the loans are rep lines (see compress()). Default is 1 each
+    # prepaymentModel: PrepaymentModel of the voluntary prepayments (i.e. CPRPrepaymentModel(0.06)). Default is no prepayment
+    def __init__(self, loansList = [], defaultSampler=None, seed=None, counts=None, prepaymentModel=None):
 
         # if user did not put in any list of Loan objects for the argument
         if not loansList:
@@ -21,38 +53,230 @@ class LoanPool(object):
         # loop through the loans in the loan list, and check if they are of type Loan. If yes, store in attribute
         for loan in loansList:
             if isinstance(loan, Loan):
-                self._loansList = loansList
+                self._loans = loansList
             else:
                 logging.error('User inputs {loan} in the list which is of type {type}. The LoanPool expects a list of '
                               'Loan objects'.format(loan=loan, type=type(loan)))
 
                 raise TypeError('ERROR: LoanPool object must have a list of Loan objects. Please create new.')
 
+        # Keep the loans sorted by maturity and build the arrays. See _layout() below
+        self._prepaymentModel = prepaymentModel
+        self._layout(counts)
+
+        # Default model: each loan's default period is drawn once per simulation in reset()
+        self.defaultSampler = defaultSampler if defaultSampler is not None else DefaultSampler()
+        self.rng = numpy.random.default_rng(seed)
+
+        # properties attribute: columnar store that records all the payments of each period. Used to display Waterfall on the Assets side
+        # Allocated once and wiped by reset(), which also sizes it to the horizon of the next waterfall
+        self.properties = PeriodStore(['Principal', 'Interest', 'Total', 'Balance', 'Recoveries'])
+
         self.reset()
 
 ##############################################
     # True __init__ function and reset mechanism to period 0 for multiple simulations
     def reset(self):
 
-        # properties attribute is a dictionary that records all the payments of each period. Used to display Waterfall on the Assets side
-        # initialize with period 0
-        self.properties = {0: {'Principal': 0, 'Interest': 0, 'Total': 0, 'Balance': self.totalBalance(0), 'Recoveries': 0}}
+        # Fraction of each row's loans that haven't defaulted: 1 or 0 for single loans. Multiplied into the schedule matrices
+        if self.loanArrays is not None:
+            self._alive = numpy.ones(len(self.loanArrays))
+
+        if self.isCompressed:
+            # Rep lines: draw how many loans of each line default in each period
+            self.defaultCounts = self.sampleDefaults(1, self.rng)[0]
+            self.defaultPeriods = None
+            # A loan stops being active when it is paid off or when it defaults, whichever comes first
+            # Expanded to 1 end period per loan and sorted, so activeLoans() is a binary search and the last period of the waterfall is known up front
+            endCounts = self.loanArrays.endPeriodCounts(self.defaultCounts).sum(axis=0)
+            self._sortedEndPeriods = numpy.repeat(numpy.arange(len(endCounts)), endCounts)
+        else:
+            # Draw the default period of every loan for the next simulation, and sort them
+            # so that checkDefaultsReturnRecovery() can find the loans defaulting in a period with a binary search
+            self.defaultPeriods = self.sampleDefaults(1, self.rng)[0]
+            self.defaultCounts = None
+            self._defaultOrder = numpy.argsort(self.defaultPeriods, kind='stable')
+            self._sortedDefaultPeriods = self.defaultPeriods[self._defaultOrder]
+
+            # A loan stops being active when it is paid off or when it defaults, whichever comes first
+            # Sorted, so activeLoans() is a binary search and the last period of the waterfall is known up front
+            self._sortedEndPeriods = numpy.sort(numpy.minimum(self._lifetimes, self.defaultPeriods))
+
+        # Wipe the properties of the previous simulation, size them for this one and initialize with period 0
+        self.properties.clear()
+        self.properties.reserve(self.horizon() + 1)
+        self.properties.openPeriod(0)
+        self.properties.record(0, {'Principal': 0, 'Interest': 0, 'Total': 0, 'Balance': self.totalBalance(0), 'Recoveries': 0})
 
         # Loop through underlying Loans and reset them too
         for loan in self:
             loan.reset()
 
     def __iter__(self):
-        # Loop over the loan tuple and yield the individual loans
-        for loan in self._loansList:
+        # Loop over the loan tuple and yield the individual loans, in the order the user gave them
+        for loan in self._loans:
             yield loan
 
     @property
     def loansList(self):
-        return self._loansList
+        return self._loans
     @loansList.setter
     def loansList(self, ituple):
-        self._loansList = ituple
+        self._loans = ituple
+        # Re-sort the new loans and rebuild the arrays so that they describe them, then draw new defaults
+        # The new loans are single loans, not rep lines
+        self._layout()
+        self.reset()
+
+    @property
+    def prepaymentModel(self):
+        return self._prepaymentModel
+    @prepaymentModel.setter
+    def prepaymentModel(self, model):
+        # Prepayments change the schedule and when the loans are paid off, so the defaults are drawn again
+        self._prepaymentModel = model
+        self._layout(self._counts)
+        self.reset()
+
+    # INTERNAL METHOD to sort the loans by maturity (term) and build the arrays from the sorted loans
+    # Sorted loans mean that the loans still paying at any period are a suffix of the list,
+    # so the aggregates only touch that live slice (see LoanArrays.liveStart())
+    # The sorted copy (_loansList) is internal: the user's list (_loans) and its order are left untouched.
+    # counts: number of loans of each Loan object, in the user's order
+    def _layout(self, counts=None):
+        order = sorted(range(len(self._loans)), key=lambda index: self._loans[index]._term)
+        self._loansList = [self._loans[index] for index in order]
+        self._counts = counts
+
+        # Struct-of-arrays copy of the loans, used by the aggregate methods instead of looping over the Loan objects
+        # None if any loan can't be vectorized (i.e. mortgages with PMI), in which case we loop over the objects
+        self.loanArrays = LoanArrays.fromLoans(self._loansList, None if counts is None else numpy.asarray(counts)[order])
+        if counts is not None and self.loanArrays is None:
+            raise TypeError('Rep line counts need loans that can be vectorized. Please create new.')
+
+        # Prepayments are only projected on the arrays: the Loan objects keep their scheduled amortization
+        if self._prepaymentModel is not None:
+            if self.loanArrays is None:
+                raise TypeError('Prepayments need loans that can be vectorized. Please create new.')
+            self.loanArrays.prepaymentModel = self._prepaymentModel
+
+        # Number of periods each loan has a positive balance for, default-free
+        if self.loanArrays is not None:
+            self._lifetimes = self.loanArrays.lifetime()
+        else:
+            self._lifetimes = numpy.array([sum(1 for period in range(loan._term + 2) if loan.balanceFormula(period) > 0.)
+                                           for loan in self._loansList], dtype=numpy.int64)
+
+    # True if the loans are rep lines standing for several loans each. Their defaults are drawn as counts
+    @property
+    def isCompressed(self):
+        return self.loanArrays is not None and self.loanArrays.isCompressed
+
+    # Aggregation error of the rep lines versus the full pool they were compressed from. None if not compressed
+    @property
+    def aggregationError(self):
+        return None if self.loanArrays is None else self.loanArrays.aggregationError
+
+    @profiled(name='default draw')
+    def sampleDefaults(self, nPaths, rng, antithetic=False):
+        '''
+        Draw the defaults of nPaths simulations at once
+        :param nPaths: number of paths
+        :param rng: numpy random Generator
+        :param antithetic: True to draw the paths in antithetic pairs (see DefaultSampler.sample()).
+        Rep lines draw counts, which have no antithetic counterpart, so they ignore it
+        :return: (paths x loans) integer array of default periods, or for rep lines,
+        (paths x lines x periods) integer array of the number of loans of each line defaulting in each period
+        '''
+        if self.isCompressed:
+            if antithetic:
+                logging.warning('Rep line defaults are drawn as counts: antithetic draws are not available')
+            nColumns = self.loanArrays.schedule()['Payment'].shape[1]
+            defaults = self.defaultSampler.sampleCounts(self.loanArrays.count, rng, nColumns, nPaths, self.loanArrays)
+        else:
+            defaults = self.defaultSampler.sample((nPaths, len(self._loansList)), rng, self.loanArrays, antithetic)
+
+        if profiler.enabled:
+            profiler.count('loans', nPaths * int(self.loanArrays.count.sum()) if defaults.ndim == 3 else defaults.size)
+        return defaults
+
+    def sobolReplicates(self, nReplicates, seed=None):
+        '''
+        Independent scrambled Sobol sequences to pass to sampleDefaults() instead of a numpy random Generator,
+        for quasi-Monte Carlo default scenarios. The largest loans get the first (most uniform) Sobol dimensions
+        :param nReplicates: number of replicates. The spread of the replicates' results gives the error estimate
+        :param seed: seed of the scrambling
+        :return: list of nReplicates SobolSequence objects, 1 coordinate per loan
+        '''
+        if self.isCompressed:
+            raise TypeError('Rep line defaults are drawn as counts: Sobol scenarios need 1 loan per Loan object')
+        faces = numpy.array([loan.face for loan in self._loansList])
+        return SobolSequence.replicates(len(self._loansList), nReplicates, seed, numpy.argsort(-faces, kind='stable'))
+
+    # INTERNAL METHOD: scheduled balance of every loan going into each period, with 1 extra column of 0 for the loans
+    # defaulting after the schedule ends (or never defaulting)
+    def _balanceBeforePeriod(self):
+        balance = self.loanArrays.schedule()['Balance']
+        before = numpy.zeros((balance.shape[0], balance.shape[1] + 1))
+        before[:, 1:-1] = balance[:, :-1]
+        return before
+
+    def scheduledLossAtDefault(self, defaults):
+        '''
+        Control variate of the simulations: scheduled balance that the defaulted loans stop paying, read straight from
+        the default-free schedule, so its exact expected value is known (see expectedScheduledLossAtDefault())
+        :param defaults: (paths x loans) default periods, or (paths x lines x periods) counts, from sampleDefaults()
+        :return: 1 value per path
+        '''
+        before = self._balanceBeforePeriod()
+        if defaults.ndim == 3:
+            # Each defaulted loan of a rep line stands for 1 / count of the line's balance
+            return numpy.einsum('plt,lt->p', defaults, before[:, :defaults.shape[2]] / self.loanArrays.count[:, None])
+        periods = numpy.where(defaults < self.defaultSampler.noDefault, numpy.minimum(defaults, before.shape[1] - 1), before.shape[1] - 1)
+        return before[numpy.arange(defaults.shape[1]), periods].sum(axis=1)
+
+    def expectedScheduledLossAtDefault(self):
+        # Exact expected value of scheduledLossAtDefault() under the default model: no simulation needed
+        before = self._balanceBeforePeriod()[:, :-1]
+        probabilities = self.defaultSampler.periodProbabilities(before.shape[1], self.loanArrays)[..., :-1]
+        return float((numpy.broadcast_to(probabilities, before.shape) * before).sum())
+
+    def compress(self, rateTolerance=0., balanceBucket=None, seed=None):
+        '''
+        Aggregate the loans into representative lines, so the simulations cost scales with the number of lines
+        :param rateTolerance: width of the rate buckets. 0 only merges loans with exactly the same term and rate (exact)
+        :param balanceBucket: width of the face value buckets. Default is no buckets
+        :param seed: seed of the compressed pool's random Generator
+        :return: new LoanPool of rep lines, with the same default model. Its aggregationError reports
+        the largest error of the default-free pool totals versus this pool (see LoanArrays.aggregationErrorVersus())
+        '''
+        if self.loanArrays is None:
+            raise TypeError('Only loans that can be vectorized can be compressed into rep lines.')
+        compressed, line = self.loanArrays.compress(rateTolerance, balanceBucket)
+
+        # 1 Loan object per line, built like the line's first loan with the line's summed face and asset value
+        first = numpy.unique(line, return_index=True)[1]
+        repLines = []
+        for index, loanIndex in enumerate(first):
+            loan = self._loansList[loanIndex]
+            asset = type(loan.asset)(float(compressed.assetValue[index]), loan.asset.depreciation)
+            repLines.append(type(loan)(int(compressed.term[index]), float(compressed.rate[index]), float(compressed.face[index]), asset))
+
+        pool = LoanPool(repLines, self.defaultSampler, seed, compressed.count, self._prepaymentModel)
+        pool.loanArrays.aggregationError = compressed.aggregationError
+        return pool
+
+    # INTERNAL METHOD to read a pool aggregate from the vectorized schedule
+    # :return: the live slice of the schedule column for the period, multiplied by the alive flags, or None if we must use the objects
+    def _scheduleColumn(self, field, period):
+        if self.loanArrays is None or period < 0:
+            return None
+        schedule = self.loanArrays.schedule()[field]
+        # After the last column every loan has matured, so everything is 0
+        if period >= schedule.shape[1]:
+            return numpy.zeros(0)
+        start = self.loanArrays.liveStart(period)
+        return schedule[start:, period] * self._alive[start:]
 
 
     '''
@@ -69,6 +293,9 @@ class LoanPool(object):
     # This method will throw an error if there is a variable rate loan in the mix, because variableLoan.rate == None
     # I will not handle this error case, because the course focuses on fixed loans, but I have no doubt I can solve it
     def totalBalance(self, period=0):
+        column = self._scheduleColumn('Balance', period)
+        if column is not None:
+            return float(column.sum())
         return sum(loan.balanceFormula(period) for loan in self._loansList)
 
     '''
@@ -76,23 +303,31 @@ class LoanPool(object):
     '''
 
     def totalPrincipalDue(self, period=0):
+        column = self._scheduleColumn('Principal', period)
+        if column is not None:
+            return float(column.sum())
         return sum(loan.principalDueFormula(period) for loan in self._loansList)
     
     def totalInterestDue(self, period=0):
+        column = self._scheduleColumn('Interest', period)
+        if column is not None:
+            return float(column.sum())
         return sum(loan.interestDueFormula(period) for loan in self._loansList)
 
     def totalPaymentDue(self, period=1):
         if period == 0:
             return 0
+        column = self._scheduleColumn('Payment', period)
+        if column is not None:
+            return float(column.sum())
         return sum(loan.monthlyPayment(period) for loan in self._loansList)
 
     '''
     2.2.5d)
     '''
     def activeLoans(self, period):
-        # Loop through all the individual loans in the tuple, access their outstanding balance at period t
-        # and append them to a list
-        return len([loan.balanceFormula(period) for loan in self._loansList if loan.balanceFormula(period) > 0.])
+        # Binary search: the loans that are still active are the ones that end (pay off or default) after the period
+        return len(self._sortedEndPeriods) - int(numpy.searchsorted(self._sortedEndPeriods, period, side='right'))
         # for loan in self._loansList:
         #     loanBalanceList.append(loan.balanceFormula(period))
         # # If-else to remove any loan that has a balance of <= 0.001, because
@@ -104,6 +339,57 @@ class LoanPool(object):
         # return len([balance for balance in loanBalanceList if balance > 0.1])
 
 
+    def periodCashflow(self, period, recoveries=0):
+        '''
+        Every pool total for the period in a single pass over the (live) loans
+        :param period: period of the loanPool. Call after checkDefaultsReturnRecovery() so the defaulted loans are excluded
+        :param recoveries: total recovery of the loans defaulting in the period, returned by checkDefaultsReturnRecovery()
+        :return: PoolPeriodCashflow object
+        '''
+        if self.loanArrays is not None and period >= 0:
+            schedule = self.loanArrays.schedule()
+            if period < schedule['Payment'].shape[1]:
+                start = self.loanArrays.liveStart(period)
+                alive = self._alive[start:]
+                principal, interest, payment, balance = (float(schedule[field][start:, period] @ alive)
+                                                         for field in ('Principal', 'Interest', 'Payment', 'Balance'))
+            else:
+                principal = interest = payment = balance = 0.
+        else:
+            principal = interest = payment = balance = 0
+            for loan in self._loansList:
+                principal += loan.principalDueFormula(period)
+                interest += loan.interestDueFormula(period)
+                payment += loan.monthlyPayment(period)
+                balance += loan.balanceFormula(period)
+
+        # Same as totalPaymentDue(): nothing is paid at period 0
+        if period == 0:
+            payment = 0
+        return PoolPeriodCashflow(period, principal, interest, payment, balance, recoveries, self.activeLoans(period))
+
+    def project(self, aggregate=True):
+        '''
+        Expected cashflows of the pool, with the pool's prepayment and default models applied together
+        See LoanArrays.project()
+        :param aggregate: False to get (loans x periods) matrices instead of the pool totals by period
+        :return: dictionary of arrays with keys 'Balance', 'Interest', 'Scheduled principal', 'Prepaid principal',
+        'Payment', 'Defaulted balance', 'Recoveries'. Column index = period
+        '''
+        if self.loanArrays is None:
+            raise TypeError('Only loans that can be vectorized can be projected.')
+        return self.loanArrays.project(defaultModel=self.defaultSampler.defaultModel, aggregate=aggregate)
+
+    # Number of loans that default before the end of the waterfall for the current default draws
+    def defaultCount(self):
+        if self.isCompressed:
+            return int(self.defaultCounts[:, :self.horizon() + 1].sum())
+        return int(numpy.count_nonzero(self.defaultPeriods <= self.horizon()))
+
+    # Last period of the waterfall for the current default draws: the period after which no loan is active
+    def horizon(self):
+        return int(self._sortedEndPeriods[-1]) if len(self._sortedEndPeriods) else 0
+
     '''
     2.2.5e) Lambda is unreadable. Not using that.
     '''
@@ -158,13 +444,14 @@ class LoanPool(object):
     '''
     # Method to record the total payments, both principal and interest, and balance of the LoanPool and each individual loans
     # for the passed in period
-    def getWaterfall(self, period):
-        self.properties[period] = {}
-        # Recording recoveries code is in the checkDefaultsReturnRecovery() method
-        self.properties[period]['Principal'] = self.totalPrincipalDue(period)
-        self.properties[period]['Interest'] = self.totalInterestDue(period)
-        self.properties[period]['Total'] = self.totalInterestDue(period) + self.totalPrincipalDue(period)
-        self.properties[period]['Balance'] = self.totalBalance(period)
+    # cashflow: the PoolPeriodCashflow of the period, if the waterfall already has it. Computed here otherwise
+    def getWaterfall(self, period, cashflow=None):
+        if cashflow is None:
+            cashflow = self.periodCashflow(period)
+        self.properties.openPeriod(period)
+        self.properties.record(period, {'Principal': cashflow.principal, 'Interest': cashflow.interest,
+                                        'Total': cashflow.interest + cashflow.principal, 'Balance': cashflow.balance,
+                                        'Recoveries': cashflow.recoveries})
 
         ##### Disabled
 
@@ -183,15 +470,7 @@ class LoanPool(object):
     1) income-to-loan ratio: lower ratio means more likely to default
     '''
     '''
-    Default table:
-    
-    Period range    Default probability
-    1-10            0.0005
-    11-60           0.001
-    61-120          0.002
-    121-180         0.004
-    181-210         0.002
-    211-360         0.001
+    Default table: see the TableDefaultModel class. Other default models in DefaultModel.py
     '''
 
 
@@ -200,24 +479,31 @@ class LoanPool(object):
     :return: total cumulative recovery value of all the defaulted loans in the loanPool in that period
     '''
     def checkDefaultsReturnRecovery(self, period):
-        defaultDictionary = {range(1, 11): 0.0005, range(11, 61): 0.001, range(61, 121): 0.002,
-                             range(121, 181): 0.004, range(181, 211): 0.002, range(211, 361): 0.001}
+        # Rep lines: part of a line defaults. Its recovery is the defaulted fraction of the line's asset value
+        if self.isCompressed:
+            if not 0 <= period < self.defaultCounts.shape[1]:
+                return 0
+            fractions = self.defaultCounts[:, period] / self.loanArrays.count
+            self._alive -= fractions
+            return float(fractions @ self.loanArrays.recoveryValue(period))
 
         # Initialize total recovery for the period
         totalRecovery = 0
 
-        # Range = 1/default probability so that the odds of picking a number in that range
-        # is equal to the odds of a loan defaulting in that period
-        for Range in defaultDictionary:
-            if period in Range:
-                upperBound = 1 / defaultDictionary[Range] - 1  # -1 because we start at 0
-
-        for loan in self:
-            # the odds of picking a number in this range is equal to the odds of a loan defaulting in that period
-            randomNum = random.randint(0, upperBound)
-            # checkDefaultReturnRecovery method in the Loan class will pass in the parameters to register if the loan defaults
-            # It also return the recovery value of any defaulted loan in the period and we sum those up
-            loanRecovery = loan.checkDefaultReturnRecovery(randomNum, period)
-            totalRecovery += loanRecovery
-
-        return totalRecovery
\ No newline at end of file
+        # The default periods were drawn in reset(), so we only need the slice of loans defaulting in this period
+        start = numpy.searchsorted(self._sortedDefaultPeriods, period, side='left')
+        end = numpy.searchsorted(self._sortedDefaultPeriods, period, side='right')
+
+        for index in self._defaultOrder[start:end]:
+            # checkDefaultReturnRecovery method in the Loan class registers the default when passed in 0
+            # It also return the recovery value of the defaulted loan and we sum those up
+            recovery = self._loansList[index].checkDefaultReturnRecovery(0, period)
+            # Keep the alive flags in sync so the vectorized aggregates drop the defaulted loan
+            if self.loanArrays is not None:
+                self._alive[index] = 0.
+                # With prepayments, only the part of the loan that hasn't prepaid recovers
+                if self._prepaymentModel is not None:
+                    recovery = float(self.loanArrays.recoveryValue(numpy.array([period]), numpy.array([index]))[0])
+            totalRecovery += recovery
+
+        return totalRecovery
@@ -0,0 +1,187 @@
+'''
+LoanTape class: reads a loan tape (i.e. Loans.csv) into numpy columns
+The tape is parsed with the csv module, asset types are looked up in a registry instead of eval()-ing the tape,
+and every column is validated at once so that ALL the bad rows are reported together
+'''
+
+import csv, itertools, logging, operator, numpy
+
+from package.Loan import Loan
+from package.LoanArrays import LoanArrays
+from package.LoanPool import LoanPool
+from package.Auto import Car, Civic, Lamborghini, Lexus
+from package.Mortgage import PrimaryHome, VacationHome
+
+
+class LoanTapeError(ValueError):
+    # errors: list of messages, 1 per bad row/column, so the user can fix the whole tape in one go
+    def __init__(self, errors):
+        self.errors = list(errors)
+        super(LoanTapeError, self).__init__('{n} error(s) in the loan tape:\n{errors}'.format(
+            n=len(self.errors), errors='\n'.join(self.errors)))
+
+
+class LoanTape(object):
+    # Registry of the asset types that can appear in the 'Asset' column of a tape. Key = name on the tape, value = Asset class
+    # Use registerAssetType() to add more
+    assetTypes = {'Car': Car, 'Civic': Civic, 'Lamborghini': Lamborghini, 'Lexus': Lexus,
+                  'PrimaryHome': PrimaryHome, 'VacationHome': VacationHome}
+
+    # Header of the tape column -> LoanTape attribute
+    headers = {'Balance': 'face', 'Rate': 'rate', 'Term': 'term', 'Asset': 'assetType', 'Asset Value': 'assetValue'}
+    # Structured dtype of the binary (.npy) tapes, 1 field per header. Asset type names are at most 16 characters
+    binaryDtype = [('Balance', '<f8'), ('Rate', '<f8'), ('Term', '<i8'), ('Asset', '<U16'), ('Asset Value', '<f8')]
+
+    # term: MONTHLY terms, rate: ANNUAL rates, face: face values, assetType: asset type names, assetValue: initial asset values
+    # All columns are assumed valid; use read() or validate() to build a LoanTape from raw data
+    def __init__(self, term, rate, face, assetType, assetValue):
+        self.term = numpy.asarray(term, dtype=numpy.int64)
+        self.rate = numpy.asarray(rate, dtype=float)
+        self.face = numpy.asarray(face, dtype=float)
+        self.assetType = numpy.asarray(assetType, dtype=object)
+        self.assetValue = numpy.asarray(assetValue, dtype=float)
+
+    def __len__(self):
+        return len(self.term)
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {len(self)} loans-{len(set(self.assetType))} asset types'
+
+    @classmethod
+    def registerAssetType(cls, name, assetClass):
+        # Asset classes must be constructible from a value only, i.e. Civic(value), so they need a default depreciation
+        cls.assetTypes = {**cls.assetTypes, name: assetClass}
+
+    @classmethod
+    def read(cls, fileName, nRows=None):
+        '''
+        Factory method to read a loan tape from a .csv file, or a .npy file of binaryDtype records (i.e. a synthetic tape
+        from LoanTapeGenerator)
+        :param fileName: path of the .csv file. The header row must contain Balance, Rate, Term, Asset and Asset Value
+        :param nRows: only read the first nRows rows of the tape. Default is the whole tape
+        :return: LoanTape object. Raises LoanTapeError listing every bad row if the tape is invalid
+        '''
+        if fileName.lower().endswith('.npy'):
+            return cls.readBinary(fileName, nRows)
+
+        # utf-8-sig drops the byte order mark that Excel writes at the start of the file
+        with open(fileName, 'r', newline='', encoding='utf-8-sig') as file:
+            reader = csv.reader(file)
+            header = [name.strip() for name in next(reader)]
+
+            missing = [name for name in cls.headers if name not in header]
+            if missing:
+                logging.error('Loan tape {fileName} has no {missing} column(s)'.format(fileName=fileName, missing=missing))
+                raise LoanTapeError([f'missing column: {name}' for name in missing])
+            positions = [header.index(name) for name in cls.headers]
+            width = max(positions) + 1
+
+            # Keep the tape line numbers (header = line 1) so errors point at the right row; skip blank lines
+            lines, rows = [], []
+            pick = operator.itemgetter(*positions)
+            for line, row in enumerate(itertools.islice(reader, nRows), start=2):
+                # Only rows that are short or start with an empty field can be blank, so the full check is rare
+                if len(row) < width or not row[positions[0]]:
+                    if not any(field.strip() for field in row):
+                        continue
+                    row = row + [''] * (width - len(row))
+                lines.append(line)
+                rows.append(pick(row))
+
+        columns = dict(zip(cls.headers.values(), zip(*rows))) if rows else {name: () for name in cls.headers.values()}
+        return cls.validate(lines=lines, **columns)
+
+    @classmethod
+    def readBinary(cls, fileName, nRows=None):
+        '''
+        Factory method to read a loan tape from a .npy file of binaryDtype records. The file is memory-mapped, so only
+        the first nRows rows are loaded
+        :param fileName: path of the .npy file
+        :param nRows: only read the first nRows rows of the tape. Default is the whole tape
+        :return: LoanTape object. Raises LoanTapeError listing every bad row if the tape is invalid
+        '''
+        records = numpy.load(fileName, mmap_mode='r')
+        missing = [name for name in cls.headers if name not in (records.dtype.names or ())]
+        if missing:
+            logging.error('Loan tape {fileName} has no {missing} field(s)'.format(fileName=fileName, missing=missing))
+            raise LoanTapeError([f'missing column: {name}' for name in missing])
+        records = records[:nRows]
+
+        # Same checks as the .csv tapes, on the numbers as they are
+        return cls.validate(**{attribute: numpy.asarray(records[header]) for header, attribute in cls.headers.items()})
+
+    @classmethod
+    def validate(cls, term, rate, face, assetType, assetValue, lines=None):
+        '''
+        Validate raw (i.e. string) columns of a tape with vectorized checks
+        :param lines: line number of each loan, used in the error messages. Default is the position in the columns
+        :return: LoanTape object. Raises LoanTapeError listing every bad row
+        '''
+        lines = numpy.arange(len(term)) if lines is None else numpy.asarray(lines)
+        errors = {}
+
+        def report(bad, message):
+            for line in lines[bad]:
+                errors.setdefault(int(line), []).append(message)
+
+        term, badTerm = cls._toFloat(term)
+        rate, badRate = cls._toFloat(rate)
+        face, badFace = cls._toFloat(face)
+        assetValue, badValue = cls._toFloat(assetValue)
+        # Only strip each distinct asset name once
+        names = {name: str(name).strip() for name in set(assetType)}
+        assetType = numpy.array([names[name] for name in assetType], dtype=object)
+
+        # Same rules as the Loan and Asset constructors. inf passes the comparisons but would corrupt the pool
+        with numpy.errstate(invalid='ignore'):
+            report(badTerm | ~numpy.isfinite(term) | ~(term >= 0) | (term != numpy.floor(term)), 'Term must be a positive integer')
+            report(badRate | ~numpy.isfinite(rate) | ~(rate <= 1), 'Rate must be a <= 1 float')
+            report(badFace | ~numpy.isfinite(face) | ~(face >= 0), 'Balance must be a positive number')
+            report(badValue | ~numpy.isfinite(assetValue) | ~(assetValue >= 0), 'Asset Value must be a positive number')
+        report(~numpy.isin(assetType, list(cls.assetTypes)), 'Asset must be one of {types}'.format(types=list(cls.assetTypes)))
+
+        if errors:
+            messages = [f'line {line}: ' + ', '.join(lineErrors) for line, lineErrors in sorted(errors.items())]
+            logging.error('Loan tape has {n} bad row(s)'.format(n=len(messages)))
+            raise LoanTapeError(messages)
+
+        return cls(term.astype(numpy.int64), rate, face, assetType, assetValue)
+
+    # INTERNAL METHOD to convert a column of strings to floats in one go. Only loops over the column to find the bad entries
+    @staticmethod
+    def _toFloat(column):
+        # Numeric arrays (i.e. from a binary tape) need no parsing
+        if isinstance(column, numpy.ndarray) and column.dtype.kind in 'fiub':
+            return column.astype(float), numpy.zeros(len(column), dtype=bool)
+        try:
+            values = numpy.fromiter(map(float, column), dtype=float, count=len(column))
+            return values, numpy.zeros(len(values), dtype=bool)
+        except (TypeError, ValueError):
+            values = numpy.full(len(column), numpy.nan)
+            bad = numpy.zeros(len(column), dtype=bool)
+            for index, value in enumerate(column):
+                try:
+                    values[index] = float(value)
+                except (TypeError, ValueError):
+                    bad[index] = True
+            return values, bad
+
+    # Default ANNUAL depreciation of every loan's asset, taken from the registered Asset classes
+    def depreciation(self):
+        names, inverse = numpy.unique(self.assetType.astype(str), return_inverse=True)
+        defaults = numpy.array([self.assetTypes[name](1.).depreciation for name in names], dtype=float)
+        return defaults[inverse.reshape(-1)] if len(self) else numpy.zeros(0)
+
+    def toLoanArrays(self):
+        # Struct-of-arrays pool straight from the tape, without building any Loan object
+        return LoanArrays(self.term, self.rate, self.face, self.assetValue, self.depreciation(), self.assetType)
+
+    def toLoans(self):
+        # List of Loan objects, one per row, with the registered Asset class. Python scalars, as the Loan checks expect
+        return [Loan(term, rate, face, self.assetTypes[assetType](assetValue))
+                for term, rate, face, assetType, assetValue
+                in zip(self.term.tolist(), self.rate.tolist(), self.face.tolist(), self.assetType.tolist(), self.assetValue.tolist())]
+
+    def toLoanPool(self, **kwargs):
+        # LoanPool of the tape's loans. kwargs are passed to LoanPool, i.e. defaultSampler, seed
+        return LoanPool(self.toLoans(), **kwargs)
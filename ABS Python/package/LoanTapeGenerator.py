@@ -0,0 +1,259 @@
+'''
+LoanTapeGenerator class: synthetic loan tapes of any size, drawn from the empirical distributions of a real tape
+Loans.csv only has 1,500 auto loans, but the scaling problems of LoanPool and StructuredSecurities only show at production
+sizes. The generator fits a smoothed bootstrap (multivariate Gaussian kernel density) to the balance, rate and asset
+value of each asset type of the tape, so the marginals AND their dependence (i.e. asset value vs. balance) are kept.
+The term is discrete (a few standard terms): it is bootstrapped with its row, without any noise. The generator
+can also mix in mortgages on PrimaryHome/VacationHome assets from a parametric profile, since the tape has none.
+Rows are generated in fixed blocks, each from its own seed spawned from the generator's seed: the same seed always gives
+the same tape, whatever the chunk size it is streamed with
+LoanTapeWriter class: streams the chunks of a tape to a .csv (same layout as Loans.csv) or .npy (structured array) file
+'''
+
+import os, struct, numpy
+
+from package.LoanTape import LoanTape
+
+
+class LoanTapeGenerator(object):
+    # Number of rows drawn from each spawned seed. Changing it changes the tapes
+    blockSize = 65536
+
+    # Parametric profile of the mortgages mixed in: there are none in Loans.csv to fit
+    # terms: MONTHLY terms and their probabilities. rate: mean, std and (min, max) of the ANNUAL rates
+    # balance: median and log-std of the lognormal balances. LTV: (min, max) of the uniform loan-to-value at origination
+    mortgageProfile = {'terms': ([180, 240, 360], [0.2, 0.1, 0.7]), 'rate': (0.045, 0.01, (0.02, 0.1)),
+                       'balance': (250000., 0.5), 'LTV': (0.6, 0.95)}
+
+    # Rows of _columns() the kernel noise is added to: all but the term
+    continuous = [0, 1, 3]
+
+    # tape: LoanTape the distributions are fitted to
+    # seed: seed of the synthetic tapes. Default is a fresh random seed
+    # mortgageShare: fraction of the rows that are mortgages from mortgageProfile, on top of whatever the tape holds
+    # vacationShare: fraction of those mortgages on a VacationHome (the rest are on a PrimaryHome)
+    # bandwidth: scale of the kernel around each tape row, relative to the columns' covariance. Default is Silverman's rule
+    def __init__(self, tape, seed=None, mortgageShare=0., vacationShare=0.25, bandwidth=None):
+        if not len(tape):
+            raise ValueError('Cannot fit a LoanTapeGenerator to an empty tape. Please create new.')
+        if not 0 <= mortgageShare <= 1 or not 0 <= vacationShare <= 1:
+            raise ValueError('mortgageShare and vacationShare must be between 0 and 1. Please create new.')
+        self.tape = tape
+        self.mortgageShare = mortgageShare
+        self.vacationShare = vacationShare
+        self.seedSequence = seed if isinstance(seed, numpy.random.SeedSequence) else numpy.random.SeedSequence(seed)
+
+        # 1 kernel density per asset type, picked in proportion to its rows in the tape
+        self.assetTypes, counts = numpy.unique(tape.assetType.astype(str), return_counts=True)
+        self.weights = counts / counts.sum()
+        self.kernels = [self._fit(self._columns(tape)[:, tape.assetType.astype(str) == assetType], bandwidth)
+                        for assetType in self.assetTypes]
+        # (index, LoanTape) of the last block drawn
+        self._lastBlock = None
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {len(self.tape)} loans fitted-{self.assetTypes.tolist()}-{self.mortgageShare:.0%} mortgages'
+
+    @classmethod
+    def fit(cls, fileName, **kwargs):
+        '''
+        Factory method to fit a generator to a loan tape file
+        :param fileName: path of the tape, i.e. Loans.csv
+        :param kwargs: passed to LoanTapeGenerator, i.e. seed, mortgageShare
+        :return: LoanTapeGenerator object
+        '''
+        return cls(LoanTape.read(fileName), **kwargs)
+
+    # INTERNAL METHOD: (4 x loans) columns the kernels live in. Balances and asset values on a log scale, so they stay
+    # positive and their skew is kept
+    @staticmethod
+    def _columns(tape):
+        return numpy.vstack([numpy.log1p(tape.face), tape.rate, tape.term, numpy.log1p(tape.assetValue)])
+
+    # INTERNAL METHOD: rows, Cholesky factor of the kernel covariance of the continuous columns, and their range, of 1 asset type
+    @staticmethod
+    def _fit(columns, bandwidth):
+        continuous = columns[LoanTapeGenerator.continuous]
+        nColumns, nRows = continuous.shape
+        if bandwidth is None:
+            bandwidth = (4 / (nColumns + 2)) ** (1 / (nColumns + 4)) * nRows ** (-1 / (nColumns + 4))
+        covariance = numpy.cov(continuous) if nRows > nColumns else numpy.zeros((nColumns, nColumns))
+        # Columns that never vary (i.e. a single rate) would make the covariance singular
+        factor = numpy.linalg.cholesky(bandwidth ** 2 * covariance + 1e-12 * numpy.eye(nColumns))
+        return {'rows': columns, 'factor': factor, 'low': continuous.min(axis=1), 'high': continuous.max(axis=1)}
+
+    # Seed of 1 block: the block-th child of the generator's seed, without spawning the ones before it
+    def _blockSeed(self, block):
+        return numpy.random.SeedSequence(self.seedSequence.entropy, spawn_key=self.seedSequence.spawn_key + (block,))
+
+    def block(self, block):
+        '''
+        Rows block * blockSize to (block + 1) * blockSize of the synthetic tape
+        :param block: index of the block
+        :return: LoanTape object
+        '''
+        nRows = LoanTapeGenerator.blockSize
+        rng = numpy.random.default_rng(self._blockSeed(block))
+        columns = numpy.empty((4, nRows))
+        assetType = numpy.empty(nRows, dtype=object)
+
+        isMortgage = rng.random(nRows) < self.mortgageShare
+        kernel = rng.choice(len(self.kernels), nRows, p=self.weights)
+        for index, fitted in enumerate(self.kernels):
+            rows = numpy.flatnonzero((kernel == index) & ~isMortgage)
+            # Smoothed bootstrap: a random tape row plus Gaussian noise shaped like the tape's covariance
+            # The term stays the picked row's, so the pool keeps the tape's standard terms
+            picks = fitted['rows'][:, rng.integers(0, fitted['rows'].shape[1], len(rows))]
+            columns[:, rows] = picks
+            noise = fitted['factor'] @ rng.standard_normal((len(LoanTapeGenerator.continuous), len(rows)))
+            # Keep every column within the range of the tape, i.e. rates don't go past what was observed
+            columns[numpy.ix_(LoanTapeGenerator.continuous, rows)] = numpy.clip(
+                picks[LoanTapeGenerator.continuous] + noise, fitted['low'][:, None], fitted['high'][:, None])
+            assetType[rows] = self.assetTypes[index]
+
+        rows = numpy.flatnonzero(isMortgage)
+        if len(rows):
+            columns[:, rows], assetType[rows] = self._mortgages(len(rows), rng)
+
+        face, rate, term, assetValue = columns
+        return LoanTape(numpy.rint(term).astype(numpy.int64), rate, numpy.expm1(face), assetType, numpy.expm1(assetValue))
+
+    # INTERNAL METHOD: (4 x nRows) columns and asset types of mortgages drawn from mortgageProfile
+    def _mortgages(self, nRows, rng):
+        profile = LoanTapeGenerator.mortgageProfile
+        terms, probabilities = profile['terms']
+        meanRate, stdRate, (minRate, maxRate) = profile['rate']
+        medianBalance, logStd = profile['balance']
+        minLTV, maxLTV = profile['LTV']
+
+        term = rng.choice(terms, nRows, p=probabilities)
+        rate = numpy.clip(rng.normal(meanRate, stdRate, nRows), minRate, maxRate)
+        face = medianBalance * numpy.exp(logStd * rng.standard_normal(nRows))
+        assetValue = face / rng.uniform(minLTV, maxLTV, nRows)
+        assetType = numpy.where(rng.random(nRows) < self.vacationShare, 'VacationHome', 'PrimaryHome').astype(object)
+        return numpy.vstack([numpy.log1p(face), rate, term, numpy.log1p(assetValue)]), assetType
+
+    def rows(self, start, stop):
+        '''
+        Rows start to stop of the synthetic tape
+        :param start: first row
+        :param stop: row after the last one
+        :return: LoanTape object
+        '''
+        blockSize = LoanTapeGenerator.blockSize
+        first, last = start // blockSize, max(start, stop - 1) // blockSize
+        tapes = []
+        for block in range(first, last + 1):
+            # Consecutive chunks usually share a block: keep the last one instead of drawing it again
+            if self._lastBlock is None or self._lastBlock[0] != block:
+                self._lastBlock = (block, self.block(block))
+            tapes.append(self._lastBlock[1])
+        return _slice(_concatenate(tapes), start - first * blockSize, stop - first * blockSize)
+
+    def chunks(self, nRows, chunkSize=100000):
+        '''
+        Stream the first nRows rows of the synthetic tape
+        :param nRows: number of loans
+        :param chunkSize: number of loans per chunk. Does not change the tape, only how much of it is in memory at once
+        :return: generator of LoanTape objects
+        '''
+        for start in range(0, nRows, chunkSize):
+            yield self.rows(start, min(start + chunkSize, nRows))
+
+    def generate(self, nRows):
+        # Whole synthetic tape of nRows loans in memory, i.e. to build a LoanPool
+        return self.rows(0, nRows)
+
+    def write(self, fileName, nRows, chunkSize=100000):
+        '''
+        Stream a synthetic tape to a file
+        :param fileName: path of the file. .csv for the Loans.csv layout, .npy for a structured array (see LoanTape.read())
+        :param nRows: number of loans
+        :param chunkSize: number of loans held in memory at once
+        :return: number of loans written
+        '''
+        with LoanTapeWriter(fileName) as writer:
+            for tape in self.chunks(nRows, chunkSize):
+                writer.writeTape(tape)
+        return writer.nRows
+
+
+class LoanTapeWriter(object):
+    # Number of bytes reserved for the .npy header, rewritten with the final shape when the file is closed
+    _npyHeaderSize = 256
+    # Name on the 'Loan Type' column of the .csv files, by asset type. Other asset types are auto loans
+    loanTypes = {'PrimaryHome': 'Mortgage Loan', 'VacationHome': 'Mortgage Loan'}
+
+    # fileName: path of the output file. The format comes from the extension: .csv or .npy
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.nRows = 0
+        self.format = os.path.splitext(fileName)[1].lower()
+        if self.format == '.csv':
+            self._file = open(fileName, 'w', newline='')
+            self._file.write('Loan #,Loan Type,' + ','.join(LoanTape.headers) + '\n')
+        elif self.format == '.npy':
+            self._file = open(fileName, 'wb')
+            self._file.write(self._npyHeader(0))
+        else:
+            raise ValueError(f'Unknown loan tape file format "{self.format}". Options include: ".csv" or ".npy"')
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {self.fileName}-{self.nRows} loans'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def writeTape(self, tape):
+        '''
+        Append the loans of a tape to the file
+        :param tape: LoanTape object
+        :return: None
+        '''
+        if self.format == '.csv':
+            loanType = [LoanTapeWriter.loanTypes.get(assetType, 'Auto Loan') for assetType in tape.assetType.tolist()]
+            rows = zip(range(self.nRows + 1, self.nRows + len(tape) + 1), loanType, tape.face.tolist(), tape.rate.tolist(),
+                       tape.term.tolist(), tape.assetType.tolist(), tape.assetValue.tolist())
+            # Same precision as Loans.csv
+            self._file.write(''.join('%d,%s,%.5f,%.9f,%d,%s,%.5f\n' % row for row in rows))
+        else:
+            records = numpy.empty(len(tape), dtype=LoanTape.binaryDtype)
+            for header, attribute in LoanTape.headers.items():
+                records[header] = getattr(tape, attribute)
+            self._file.write(records.tobytes())
+        self.nRows += len(tape)
+
+    def close(self):
+        if self._file is None:
+            return
+        if self.format == '.npy':
+            # Now that the number of rows is known, write the real header in the space reserved for it
+            self._file.seek(0)
+            self._file.write(self._npyHeader(self.nRows))
+        self._file.close()
+        self._file = None
+
+    # INTERNAL METHOD: .npy version 1.0 header for a 1-D structured array of LoanTape.binaryDtype, padded to a fixed size
+    @classmethod
+    def _npyHeader(cls, nRows):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (numpy.dtype(LoanTape.binaryDtype).descr, nRows)
+        # magic string (6 bytes) + version (2 bytes) + header length (2 bytes) + header ending with a newline
+        header = header.ljust(cls._npyHeaderSize - 11) + '\n'
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+# Rows start to stop of a LoanTape
+def _slice(tape, start, stop):
+    return LoanTape(tape.term[start:stop], tape.rate[start:stop], tape.face[start:stop], tape.assetType[start:stop],
+                    tape.assetValue[start:stop])
+
+
+# 1 LoanTape with the rows of all the tapes, in order
+def _concatenate(tapes):
+    if len(tapes) == 1:
+        return tapes[0]
+    return LoanTape(*(numpy.concatenate([getattr(tape, name) for tape in tapes])
+                      for name in ('term', 'rate', 'face', 'assetType', 'assetValue')))
@@ -0,0 +1,97 @@
+'''
+PeriodStore class: columnar storage for the per-period properties of the Tranches and the LoanPool
+One preallocated numpy array per field (i.e. 'Interest due'), indexed by period, instead of a dict of dicts.
+Reading it still works like the old dict of dicts: store[period][field], store.items(), etc.
+'''
+
+import numpy
+from collections.abc import Mapping
+
+
+class PeriodStore(Mapping):
+    # fields: names of the properties recorded every period
+    # capacity: number of periods to preallocate. The store grows by itself if a period goes past it
+    def __init__(self, fields, capacity=16):
+        self.fields = list(fields)
+        # nan means "not recorded yet", so the views only show the fields that were recorded for a period
+        self.columns = {field: numpy.full(capacity, numpy.nan) for field in self.fields}
+        self.lastPeriod = -1
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {len(self.fields)} fields-{len(self)} periods'
+
+    @property
+    def capacity(self):
+        return len(self.columns[self.fields[0]])
+
+    # Method to make sure that the columns can hold at least capacity periods
+    def reserve(self, capacity):
+        if capacity > self.capacity:
+            for field, column in self.columns.items():
+                newColumn = numpy.full(capacity, numpy.nan)
+                newColumn[:len(column)] = column
+                self.columns[field] = newColumn
+
+    # Method to wipe all the records, keeping the allocated columns for the next simulation
+    def clear(self):
+        for column in self.columns.values():
+            column[:self.lastPeriod + 1] = numpy.nan
+        self.lastPeriod = -1
+
+    # Method to start recording a new period. Doubles the capacity if the period doesn't fit
+    def openPeriod(self, period):
+        if period >= self.capacity:
+            self.reserve(max(period + 1, 2 * self.capacity))
+        self.lastPeriod = max(self.lastPeriod, period)
+
+    # Methods to record and read 1 field for 1 period. value() rather than get(), which keeps the Mapping meaning
+    def set(self, field, period, value):
+        self.columns[field][period] = value
+
+    def value(self, field, period):
+        return float(self.columns[field][period])
+
+    def isRecorded(self, field, period):
+        return not numpy.isnan(self.columns[field][period])
+
+    # Method to record several fields at once for a period, from a dictionary
+    def record(self, period, values):
+        for field, value in values.items():
+            self.columns[field][period] = value
+
+    # Method to return the recorded values of a field as an array, from period 0 to the last period
+    def column(self, field):
+        return self.columns[field][:self.lastPeriod + 1]
+
+    ##### Read-only dict of dicts interface: period -> {field: value}
+    def __getitem__(self, period):
+        if not 0 <= period <= self.lastPeriod:
+            raise KeyError(period)
+        return PeriodView(self, period)
+
+    def __iter__(self):
+        return iter(range(self.lastPeriod + 1))
+
+    def __len__(self):
+        return self.lastPeriod + 1
+
+
+class PeriodView(Mapping):
+    # Read-only view of 1 period of a PeriodStore, works like the old {field: value} dictionary
+    def __init__(self, store, period):
+        self._store = store
+        self._period = period
+
+    def __getitem__(self, field):
+        if field not in self._store.columns or not self._store.isRecorded(field, self._period):
+            raise KeyError(field)
+        return self._store.value(field, self._period)
+
+    def __iter__(self):
+        return (field for field in self._store.fields if self._store.isRecorded(field, self._period))
+
+    def __len__(self):
+        return sum(1 for field in self)
+
+    def __repr__(self):
+        return repr(dict(self))
@@ -0,0 +1,83 @@
+'''
+PrepaymentModel classes: voluntary prepayment assumptions for the pool projection
+Every model returns the single monthly mortality (SMM: fraction of the balance prepaid in the period) of every loan
+as ONE (loans x periods) array, which LoanArrays applies to the whole amortization schedule in a few array operations
+'''
+
+import numpy
+
+
+class PrepaymentModel(object):
+    def __repr__(self):
+        return f'{type(self).__name__}'
+
+    def smm(self, loanArrays, nPeriods):
+        '''
+        :param loanArrays: LoanArrays of the pool
+        :param nPeriods: number of periods, starting at period 0
+        :return: (loans x periods) array of SMMs. Column index = period. Nothing is prepaid at period 0
+        '''
+        raise NotImplementedError('Derived PrepaymentModel classes must implement smm()')
+
+    # Monthly prepayment rate equivalent to an ANNUAL conditional prepayment rate
+    @staticmethod
+    def cprToSMM(cpr):
+        return 1 - (1 - numpy.asarray(cpr, dtype=float)) ** (1 / 12)
+
+
+class CPRPrepaymentModel(PrepaymentModel):
+    # cpr: constant ANNUAL conditional prepayment rate, i.e. 0.06 for 6 CPR
+    def __init__(self, cpr):
+        if not 0 <= cpr < 1:
+            raise ValueError(f'CPR {cpr} must be in [0, 1)')
+        self.cpr = cpr
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {self.cpr}'
+
+    def smm(self, loanArrays, nPeriods):
+        smm = numpy.full((len(loanArrays), nPeriods), float(PrepaymentModel.cprToSMM(self.cpr)))
+        smm[:, :1] = 0.
+        return smm
+
+
+class ABSPrepaymentModel(PrepaymentModel):
+    '''
+    ABS speed, the usual convention for auto loans: a constant percentage of the ORIGINAL number of loans prepays
+    every month, so SMM(age) = ABS / (1 - ABS * (age - 1)), which rises as the pool pays down
+    The speed can be ramped up linearly over the first rampPeriods months
+    '''
+    # speed: ABS speed as a fraction, i.e. 0.015 for 1.5 ABS. rampPeriods: number of months to reach full speed
+    def __init__(self, speed, rampPeriods=0):
+        if speed < 0:
+            raise ValueError(f'ABS speed {speed} must be positive')
+        self.speed = speed
+        self.rampPeriods = rampPeriods
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {self.speed}-{self.rampPeriods} ramp'
+
+    def smm(self, loanArrays, nPeriods):
+        age = numpy.arange(nPeriods, dtype=float)
+        speed = self.speed * numpy.minimum(age / self.rampPeriods, 1.) if self.rampPeriods else numpy.full(nPeriods, float(self.speed))
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            curve = numpy.where(age >= 1, speed / (1 - speed * (age - 1)), 0.)
+        # Past the point where all the original loans would have prepaid, everything left prepays
+        curve = numpy.where((curve < 0) | (curve > 1) | ~numpy.isfinite(curve), 1., curve)
+        curve[0] = 0.
+        return numpy.broadcast_to(curve, (len(loanArrays), nPeriods))
+
+
+class LoanLevelPrepaymentModel(PrepaymentModel):
+    # function: function(loanArrays, periods) returning the (loans x periods) SMMs, i.e. higher for higher rate loans
+    # periods is a (1 x periods) row so the function can broadcast against the (loans x 1) columns of loanArrays
+    def __init__(self, function):
+        self.function = function
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {getattr(self.function, "__name__", self.function)}'
+
+    def smm(self, loanArrays, nPeriods):
+        smm = numpy.broadcast_to(self.function(loanArrays, numpy.arange(nPeriods)[None, :]), (len(loanArrays), nPeriods)).copy()
+        smm[:, :1] = 0.
+        return numpy.clip(smm, 0., 1.)
@@ -0,0 +1,171 @@
+'''
+Profiler class: instrumentation of the hot paths with nestable named spans and counters
+Each span records its call count, total time and a sample of its durations (for the percentiles) on perf_counter_ns,
+under its full path, i.e. 'simulateWaterfallBatched/waterfall/interest pass'. Counters tally the work done (paths,
+periods, loans, defaults). The results go to a JSON or text report instead of stdout.
+When disabled, span() hands back 1 shared do-nothing context manager and count() returns at once, so the
+instrumentation can stay in the code of production runs. The module-level profiler is the one the package reports to
+'''
+
+import json, math, random, threading, time
+
+
+class _Span(object):
+    __slots__ = ('profiler', 'name', 'path', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        self.path = f'{stack[-1]}/{self.name}' if stack else self.name
+        stack.append(self.path)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter_ns() - self.start
+        self.profiler._stack().pop()
+        self.profiler._record(self.path, elapsed)
+
+
+class _NoSpan(object):
+    # Context manager handed out when the profiler is disabled: does nothing
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return None
+
+
+_noSpan = _NoSpan()
+
+
+class Profiler(object):
+    # enabled: False to skip all the measurements
+    # maxSamples: number of durations kept per span for the percentiles. Past it, a uniform sample is kept (reservoir)
+    def __init__(self, enabled=False, maxSamples=10000):
+        self.enabled = enabled
+        self.maxSamples = maxSamples
+        self._lock = threading.Lock()
+        # Each thread nests its own spans
+        self._local = threading.local()
+        self._random = random.Random(0)
+        self.reset()
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {"enabled" if self.enabled else "disabled"}-{len(self.spans)} spans-{len(self.counters)} counters'
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    # Forget all the spans and counters
+    def reset(self):
+        with self._lock:
+            # Full path of the span: {'calls', 'total', 'max', 'samples'}, times in ns
+            self.spans = {}
+            self.counters = {}
+
+    def span(self, name):
+        '''
+        Context manager timing the block it wraps: with profiler.span('interest pass'): ...
+        :param name: name of the span. Nested in any span already open in the same thread
+        :return: context manager
+        '''
+        return _Span(self, name) if self.enabled else _noSpan
+
+    def count(self, name, amount=1):
+        '''
+        Add to a counter, i.e. count('paths', 500)
+        :param name: name of the counter
+        :param amount: amount to add
+        :return: None
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # INTERNAL METHOD: stack of the full paths of the spans open in the current thread
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    # INTERNAL METHOD: fold 1 duration into the span's statistics
+    def _record(self, path, elapsed):
+        with self._lock:
+            span = self.spans.get(path)
+            if span is None:
+                span = self.spans[path] = {'calls': 0, 'total': 0, 'max': 0, 'samples': []}
+            span['calls'] += 1
+            span['total'] += elapsed
+            span['max'] = max(span['max'], elapsed)
+            if len(span['samples']) < self.maxSamples:
+                span['samples'].append(elapsed)
+            else:
+                index = self._random.randrange(span['calls'])
+                if index < self.maxSamples:
+                    span['samples'][index] = elapsed
+
+    def stats(self, percentiles=(50, 95, 99)):
+        '''
+        :param percentiles: percentiles of the durations to report
+        :return: dictionary with keys 'spans' (full path: {'calls', 'total', 'mean', 'max', 'p50', ...}, times in
+        seconds) and 'counters'
+        '''
+        with self._lock:
+            spans = {path: dict(span, samples=sorted(span['samples'])) for path, span in self.spans.items()}
+            counters = dict(self.counters)
+
+        report = {}
+        for path, span in spans.items():
+            samples = span['samples']
+            entry = {'calls': span['calls'], 'total': span['total'] / 1e9, 'mean': span['total'] / span['calls'] / 1e9,
+                     'max': span['max'] / 1e9}
+            for percentile in percentiles:
+                # Nearest-rank percentile of the sampled durations
+                rank = max(0, math.ceil(percentile / 100 * len(samples)) - 1)
+                entry[f'p{percentile}'] = samples[rank] / 1e9
+            report[path] = entry
+        return {'spans': report, 'counters': counters}
+
+    def report(self, fileName=None, format='text'):
+        '''
+        :param fileName: file to write the report to. Default is to only return it
+        :param format: 'text' for a table of the spans (nested ones indented) and the counters, or 'json'
+        :return: the report, as a string
+        '''
+        stats = self.stats()
+        if format == 'json':
+            output = json.dumps(stats, indent=2)
+        elif format == 'text':
+            lines = [f'{"Span":<50}{"Calls":>10}{"Total (s)":>12}{"Mean (ms)":>12}{"p50 (ms)":>12}{"p95 (ms)":>12}{"p99 (ms)":>12}']
+            # Sorted by path, so every span comes right under its parent
+            for path in sorted(stats['spans']):
+                span = stats['spans'][path]
+                name = '  ' * path.count('/') + path.rsplit('/', 1)[-1]
+                lines.append(f'{name:<50}{span["calls"]:>10}{span["total"]:>12.4f}{span["mean"] * 1e3:>12.4f}'
+                             f'{span["p50"] * 1e3:>12.4f}{span["p95"] * 1e3:>12.4f}{span["p99"] * 1e3:>12.4f}')
+            if stats['counters']:
+                lines.append('')
+                lines += [f'{name:<50}{amount:>10}' for name, amount in sorted(stats['counters'].items())]
+            output = '\n'.join(lines) + '\n'
+        else:
+            raise ValueError(f'Unknown report format "{format}". Options include: "text" or "json"')
+
+        if fileName is not None:
+            with open(fileName, 'w') as file:
+                file.write(output)
+        return output
+
+
+# Profiler of the package: disabled until profiler.enable() is called
+profiler = Profiler()
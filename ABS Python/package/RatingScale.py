@@ -0,0 +1,41 @@
+'''
+RatingScale class: maps a reduction in yield (RIY, in bps) to a letter rating
+The breakpoints are sorted once, and a rating is a binary search, for 1 RIY or a whole array of them
+'''
+
+import numpy
+
+
+class RatingScale(object):
+    # name: name of the scale, i.e. the rating agency
+    # ratings: letter ratings from best to worst
+    # breakpoints: RIY bounds in bps, 1 more than the ratings. Rating i covers breakpoints[i] <= RIY < breakpoints[i + 1]
+    def __init__(self, name, ratings, breakpoints):
+        if len(breakpoints) != len(ratings) + 1:
+            raise ValueError('A RatingScale needs exactly 1 more breakpoint than ratings. Please create new.')
+        if any(lower >= upper for lower, upper in zip(breakpoints, breakpoints[1:])):
+            raise ValueError('RatingScale breakpoints must be sorted in increasing order. Please create new.')
+
+        self.name = name
+        self.ratings = list(ratings)
+        self.breakpoints = numpy.array(breakpoints, dtype=float)
+        # Lookup table for the binary search: None below the first breakpoint and at/above the last one
+        self._lookup = numpy.array([None] + self.ratings + [None], dtype=object)
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {self.name}-{len(self.ratings)} ratings'
+
+    def rate(self, RIY):
+        '''
+        :param RIY: reduction in yield in bps. A number or an array of numbers
+        :return: the letter rating (None if the RIY is outside of the scale), or an array of them
+        '''
+        # Indexing the lookup table with a scalar position returns the letter itself, with an array it returns an array
+        return self._lookup[numpy.searchsorted(self.breakpoints, RIY, side='right')]
+
+
+# Appendix A scale. Caa/Ca go all the way to RIY of 999,999 bps in case IRR is lower than -100% because defaults happen too early
+moodysScale = RatingScale('Moody\'s',
+                          ['Aaa', 'Aa1', 'Aa2', 'Aa3', 'A1', 'A2', 'A3', 'Baa1', 'Baa2', 'Baa3', 'Ba1', 'Ba2', 'Ba3',
+                           'B1', 'B2', 'B3', 'Caa', 'Ca'],
+                          [0, 0.06, 0.67, 1.3, 2.7, 5.2, 8.9, 13, 19, 27, 46, 72, 106, 143, 183, 231, 311, 2500, 999999])
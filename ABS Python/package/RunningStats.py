@@ -0,0 +1,219 @@
+'''
+RunningStats class: mean, variance, min and max of a stream of values in O(1) memory
+Values are folded in as they come with Welford's update (or Chan's merge for a whole block at once),
+so a simulation can report standard errors and confidence intervals without keeping its paths
+ControlVariateStats class: same, with a control variate of known mean folded in alongside each value
+ReplicateStats class: independent replicates of a quasi-Monte Carlo estimate, whose spread gives the error bar
+'''
+
+import math, numpy
+from statistics import NormalDist
+
+
+class RunningStats(object):
+    # name: what the values are, i.e. 'RIY'. Use for outputting
+    def __init__(self, name=''):
+        self.name = name
+        self.count = 0
+        self.mean = 0.
+        # Sum of the squared differences to the mean
+        self.M2 = 0.
+        self.min = math.inf
+        self.max = -math.inf
+        # Number of values skipped because they were nan/None (i.e. the AL of a tranche that is not paid down)
+        self.missing = 0
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {self.name}-{self.count} values-{self.mean}+/-{self.standardError}'
+
+    # Method to add 1 value
+    def update(self, value):
+        if value is None or math.isnan(value):
+            self.missing += 1
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.M2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    # Method to add a whole array of values at once. nan values are skipped and counted as missing
+    def updateBatch(self, values):
+        values = numpy.asarray(values, dtype=float).reshape(-1)
+        valid = values[~numpy.isnan(values)]
+        self.missing += len(values) - len(valid)
+        if len(valid):
+            mean = float(valid.mean())
+            self._merge(len(valid), mean, float(((valid - mean) ** 2).sum()), float(valid.min()), float(valid.max()))
+
+    # Method to fold in another RunningStats, i.e. the tally of another chunk of paths
+    def merge(self, other):
+        self.missing += other.missing
+        if other.count:
+            self._merge(other.count, other.mean, other.M2, other.min, other.max)
+
+    # INTERNAL METHOD: Chan's parallel update of the count, mean and M2
+    def _merge(self, count, mean, M2, minimum, maximum):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.M2 += M2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+
+    # Sample variance. nan with fewer than 2 values
+    @property
+    def variance(self):
+        return self.M2 / (self.count - 1) if self.count > 1 else math.nan
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    # Standard error of the mean
+    @property
+    def standardError(self):
+        return self.std / math.sqrt(self.count) if self.count > 1 else math.nan
+
+    # Best estimate of the mean and its standard error
+    def estimate(self):
+        return self.mean, self.standardError
+
+    def confidenceInterval(self, confidence=0.95):
+        '''
+        :param confidence: probability that the interval holds the true mean, i.e. 0.95
+        :return: (low, high) normal-approximation confidence interval of the mean
+        '''
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        mean, standardError = self.estimate()
+        return mean - z * standardError, mean + z * standardError
+
+    # Dictionary of all the statistics, for outputting
+    def summary(self, confidence=0.95):
+        return {'count': self.count, 'missing': self.missing, 'mean': self.mean, 'std': self.std,
+                'standardError': self.standardError, 'confidenceInterval': self.confidenceInterval(confidence),
+                'min': self.min, 'max': self.max}
+
+
+class ControlVariateStats(RunningStats):
+    '''
+    Running statistics of values Y observed together with a control X whose exact mean is known.
+    The estimate is the regression-adjusted mean  mean(Y) - beta * (mean(X) - controlMean),  beta = Cov(X, Y) / Var(X),
+    whose variance is that of the residuals of Y on X: the better X tracks Y, the fewer paths are needed
+    mean, variance and standardError stay those of the raw values. Use estimate() for the adjusted ones
+    '''
+    # controlMean: exact expected value of the control
+    def __init__(self, name='', controlMean=0.):
+        super(ControlVariateStats, self).__init__(name)
+        self.controlMean = controlMean
+        self.controlMeanSample = 0.
+        # Sums of the squared differences of the controls, and of the cross products, to their means
+        self.controlM2 = 0.
+        self.crossM2 = 0.
+
+    def update(self, value, control=None):
+        self.updateBatch([value], None if control is None else [control])
+
+    def updateBatch(self, values, controls=None):
+        '''
+        :param values: array of values. nan values are skipped (with their controls) and counted as missing
+        :param controls: array of controls, 1 per value
+        :return: None
+        '''
+        if controls is None:
+            raise ValueError('ControlVariateStats needs 1 control per value. Please pass in the controls.')
+        values = numpy.asarray(values, dtype=float).reshape(-1)
+        controls = numpy.asarray(controls, dtype=float).reshape(-1)
+        if controls.shape != values.shape:
+            raise ValueError(f'{len(controls)} controls for {len(values)} values. Please pass in 1 control per value.')
+        valid = ~numpy.isnan(values)
+        self.missing += len(values) - int(valid.sum())
+        values, controls = values[valid], controls[valid]
+        if not len(values):
+            return
+        if numpy.isnan(controls).any():
+            raise ValueError('ControlVariateStats controls cannot be nan. Please pass in valid controls.')
+
+        mean, controlMean = float(values.mean()), float(controls.mean())
+        deviations, controlDeviations = values - mean, controls - controlMean
+        self._mergeMoments(len(values), mean, float(deviations @ deviations), float(values.min()), float(values.max()),
+                           controlMean, float(controlDeviations @ controlDeviations), float(deviations @ controlDeviations))
+
+    # Method to fold in another ControlVariateStats of the same control, i.e. the tally of another chunk of paths
+    def merge(self, other):
+        if not isinstance(other, ControlVariateStats) or other.controlMean != self.controlMean:
+            raise ValueError('Only a ControlVariateStats with the same controlMean can be merged in. Please create new.')
+        self.missing += other.missing
+        if other.count:
+            self._mergeMoments(other.count, other.mean, other.M2, other.min, other.max,
+                               other.controlMeanSample, other.controlM2, other.crossM2)
+
+    # INTERNAL METHOD: Chan's parallel update of the co-moments, before the counts and means move, then of the values
+    def _mergeMoments(self, count, mean, M2, minimum, maximum, controlMean, controlM2, crossM2):
+        total = self.count + count
+        delta, controlDelta = mean - self.mean, controlMean - self.controlMeanSample
+        self.controlMeanSample += controlDelta * count / total
+        self.controlM2 += controlM2 + controlDelta ** 2 * self.count * count / total
+        self.crossM2 += crossM2 + delta * controlDelta * self.count * count / total
+        self._merge(count, mean, M2, minimum, maximum)
+
+    # Regression coefficient of the values on the controls. 0 when the controls don't vary
+    @property
+    def beta(self):
+        return self.crossM2 / self.controlM2 if self.controlM2 > 0 else 0.
+
+    def estimate(self):
+        if self.count < 3:
+            return self.mean, self.standardError
+        adjusted = self.mean - self.beta * (self.controlMeanSample - self.controlMean)
+        # Variance of the residuals, with 1 degree of freedom lost to beta
+        residualM2 = max(self.M2 - self.beta * self.crossM2, 0.)
+        return adjusted, math.sqrt(residualM2 / (self.count - 2) / self.count)
+
+    def summary(self, confidence=0.95):
+        summary = super(ControlVariateStats, self).summary(confidence)
+        summary['adjustedMean'], summary['adjustedStandardError'] = self.estimate()
+        summary['beta'] = self.beta
+        return summary
+
+
+class ReplicateStats(RunningStats):
+    '''
+    Statistics of randomized quasi-Monte Carlo replicates: the paths of 1 replicate are not independent, so the standard
+    error comes from the spread of the replicates' estimates, not from the spread of the paths.
+    mean, variance, min and max stay those of all the values pooled. Use estimate() for the replicated ones
+    '''
+    # replicates: 1 RunningStats (or ControlVariateStats) per replicate, i.e. 1 per scrambled SobolSequence
+    def __init__(self, name='', replicates=()):
+        super(ReplicateStats, self).__init__(name)
+        self.replicates = list(replicates)
+
+    def updateBatch(self, values, controls=None, replicate=0):
+        '''
+        :param values: array of values of 1 replicate
+        :param controls: array of controls, 1 per value, if the replicates are ControlVariateStats
+        :param replicate: index of the replicate the values come from
+        :return: None
+        '''
+        if controls is None:
+            self.replicates[replicate].updateBatch(values)
+        else:
+            self.replicates[replicate].updateBatch(values, controls)
+        super(ReplicateStats, self).updateBatch(values)
+
+    def update(self, value, controls=None, replicate=0):
+        self.updateBatch([value], None if controls is None else [controls], replicate)
+
+    def estimate(self):
+        estimates = [replicate.estimate()[0] for replicate in self.replicates if replicate.count]
+        if len(estimates) < 2:
+            return self.mean, math.nan
+        return float(numpy.mean(estimates)), float(numpy.std(estimates, ddof=1) / math.sqrt(len(estimates)))
+
+    def summary(self, confidence=0.95):
+        summary = super(ReplicateStats, self).summary(confidence)
+        summary['replicatedMean'], summary['replicatedStandardError'] = self.estimate()
+        summary['replicates'] = len(self.replicates)
+        return summary
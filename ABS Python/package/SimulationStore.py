@@ -0,0 +1,160 @@
+'''
+SimulationStore class: memory-mapped cube of every path of a simulation, for audit and tail analysis
+The tranche fields are held as a (paths x periods x tranches x fields) numpy.memmap on disk, next to a
+(paths x periods x fields) cube of the pool fields and a .json sidecar describing them, so millions of paths can be
+kept without holding them in RAM, and the results can be reopened later without running the simulation again
+'''
+
+import json, os, numpy
+
+from package.Tranche import Tranche
+
+
+class SimulationStore(object):
+    # LoanPool properties stored for every path. The batched simulation doesn't track the pool Balance: it is left nan
+    poolFields = ['Principal', 'Interest', 'Total', 'Balance', 'Recoveries']
+
+    # fileName: base path of the store. The files are fileName + '.tranches.dat', '.pool.dat', '.horizon.dat' and '.json'
+    # metadata: dictionary read from the .json sidecar. Use create() or open() instead of calling this directly
+    # mode: numpy.memmap mode, 'r+' to fill the store, 'r' to read it
+    def __init__(self, fileName, metadata, mode='r+'):
+        self.fileName = fileName
+        self.metadata = metadata
+        self.mode = mode
+        nPaths, nPeriods = metadata['nPaths'], metadata['nPeriods']
+        self.trancheNames = metadata['trancheNames']
+        self.trancheFields = metadata['trancheFields']
+        self.poolFields = metadata['poolFields']
+
+        self.tranches = numpy.memmap(fileName + '.tranches.dat', dtype=float, mode=mode,
+                                     shape=(nPaths, nPeriods, len(self.trancheNames), len(self.trancheFields)))
+        self.pool = numpy.memmap(fileName + '.pool.dat', dtype=float, mode=mode, shape=(nPaths, nPeriods, len(self.poolFields)))
+        # Last period of each path. -1 until the path is recorded
+        self.horizon = numpy.memmap(fileName + '.horizon.dat', dtype=numpy.int64, mode=mode, shape=(nPaths,))
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {self.fileName}-{self.nPaths} paths-{self.nPeriods} periods-{len(self.trancheNames)} tranches'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def nPaths(self):
+        return self.metadata['nPaths']
+
+    @property
+    def nPeriods(self):
+        return self.metadata['nPeriods']
+
+    @classmethod
+    def create(cls, fileName, security, nPaths, sequential=True):
+        '''
+        Factory method to allocate an empty store on disk for the simulations of a StructuredSecurities object
+        :param fileName: base path of the store files
+        :param security: StructuredSecurities object. Gives the tranches and the longest possible waterfall
+        :param nPaths: number of paths to hold
+        :param sequential: principal payout distribution of the simulation, kept in the sidecar for reference
+        :return: SimulationStore object, open for writing. Pass it to the simulations as a writer (see record())
+        '''
+        loanPool = security.loanPool
+        # Every waterfall ends by the time the last loan is paid off, whatever the defaults
+        if loanPool.loanArrays is not None:
+            nPeriods = loanPool.loanArrays.schedule()['Payment'].shape[1]
+        else:
+            nPeriods = int(loanPool._lifetimes.max()) + 1
+        metadata = {'nPaths': int(nPaths), 'nPeriods': int(nPeriods), 'sequential': bool(sequential),
+                    'trancheNames': [str(tranche.subordination) for tranche in security],
+                    'trancheNotionals': [float(tranche.notional) for tranche in security],
+                    'trancheRates': [float(tranche.rate) for tranche in security],
+                    'trancheFields': list(Tranche.fields), 'poolFields': list(SimulationStore.poolFields)}
+
+        with open(fileName + '.json', 'w') as file:
+            json.dump(metadata, file, indent=2)
+        store = cls(fileName, metadata, mode='w+')
+        store.horizon[:] = -1
+        store.mode = 'r+'
+        return store
+
+    @classmethod
+    def open(cls, fileName, mode='r'):
+        '''
+        Factory method to reopen a store created earlier
+        :param fileName: base path of the store files
+        :param mode: 'r' to read only, 'r+' to keep filling it
+        :return: SimulationStore object
+        '''
+        if not os.path.exists(fileName + '.json'):
+            raise FileNotFoundError(f'No simulation store at {fileName}. Please create new.')
+        with open(fileName + '.json') as file:
+            metadata = json.load(file)
+        return cls(fileName, metadata, mode)
+
+    def flush(self):
+        if self.mode != 'r':
+            for cube in (self.tranches, self.pool, self.horizon):
+                cube.flush()
+
+    def close(self):
+        self.flush()
+        # Drop the maps so the files are released
+        self.tranches = self.pool = self.horizon = None
+
+    ##### Filling the store: same interface as the WaterfallWriter classes, so it can be passed in as a writer
+    def record(self, security, period, path=0):
+        '''
+        Store 1 period of 1 path, after doWaterfallSequential() has recorded it
+        :param security: StructuredSecurities object
+        :param period: period to store
+        :param path: simulation number = row of the store
+        :return: None
+        '''
+        for index, tranche in enumerate(security):
+            properties = tranche.properties[period]
+            self.tranches[path, period, index] = [properties[field] for field in self.trancheFields]
+        poolWaterfall = security.loanPool.properties[period]
+        self.pool[path, period] = [poolWaterfall.get(field, numpy.nan) for field in self.poolFields]
+        self.horizon[path] = period
+
+    def recordBatch(self, security, pool, waterfall, pathOffset=0):
+        '''
+        Store every path of a batched simulation block in place
+        :param security: StructuredSecurities object
+        :param pool: dictionary returned by poolCollectionsBatched()
+        :param waterfall: dictionary returned by doWaterfallBatched()
+        :param pathOffset: simulation number of the first path of the block = first row of the store
+        :return: None
+        '''
+        nPaths, nColumns = pool['Payment'].shape
+        rows = slice(pathOffset, pathOffset + nPaths)
+        nPeriods = min(nColumns, self.nPeriods)
+
+        for index, field in enumerate(self.trancheFields):
+            # (tranches x paths x periods) -> (paths x periods x tranches)
+            self.tranches[rows, :nPeriods, :, index] = waterfall[field][:, :, :nPeriods].transpose(1, 2, 0)
+
+        sources = {'Principal': pool['Principal'], 'Interest': pool['Payment'] - pool['Principal'],
+                   'Total': pool['Payment'], 'Recoveries': pool['Recoveries']}
+        for index, field in enumerate(self.poolFields):
+            self.pool[rows, :nPeriods, index] = sources[field][:, :nPeriods] if field in sources else numpy.nan
+        self.horizon[rows] = pool['Horizon']
+
+    ##### Reading the store
+    def trancheField(self, field, tranche=None):
+        '''
+        :param field: Tranche field, i.e. 'Notional balance'
+        :param tranche: subordination of the tranche, i.e. 'A'. Default is all the tranches
+        :return: (paths x periods) view of the field for the tranche, or (paths x periods x tranches) for all of them
+        '''
+        view = self.tranches[..., self.trancheFields.index(field)]
+        return view if tranche is None else view[..., self.trancheNames.index(str(tranche))]
+
+    def poolField(self, field):
+        # (paths x periods) view of a pool field, i.e. 'Recoveries'
+        return self.pool[..., self.poolFields.index(field)]
+
+    # Boolean array of the paths that have been recorded
+    def recorded(self):
+        return numpy.asarray(self.horizon) >= 0
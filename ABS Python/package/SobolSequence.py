@@ -0,0 +1,189 @@
+'''
+SobolSequence class: scrambled Sobol low-discrepancy points for quasi-Monte Carlo default scenarios
+A SobolSequence has the same random() method as numpy.random.Generator, so it can be passed wherever the default draws
+take an rng (i.e. LoanPool.sampleDefaults()): each path gets the next point of the sequence, 1 coordinate per loan,
+and the DefaultSampler turns it into default periods by inverse-CDF of the hazard schedule like any other uniforms.
+The points are scrambled (random linear matrix scrambling + random digital shift), so independent replicates of the
+same sequence give an unbiased estimate and an error bar, see replicates()
+'''
+
+import numpy
+
+# Primitive polynomials over GF(2), found as needed and shared by all the sequences. Bit k = coefficient of x^k
+_primitivePolynomials = []
+# Seed of the initial direction numbers: fixed, so the unscrambled sequence is always the same
+_directionSeed = 20211
+
+
+class SobolSequence(object):
+    # Bits of precision of each coordinate
+    bits = 32
+    # Coordinates past maxDimension are filled with pseudo-random numbers (padded quasi-Monte Carlo): the low-discrepancy
+    # coordinates go to the loans that matter most, see priority below
+    maxDimension = 1024
+
+    # dimension: number of coordinates of each point, i.e. number of loans in the pool
+    # seed: seed of the scrambling (and of the padding coordinates). Different seeds give independent replicates
+    # scramble: False for the raw Sobol points (deterministic, biased estimates: for testing)
+    # priority: order in which the coordinates get the Sobol dimensions, i.e. the loans from largest to smallest balance.
+    # Default is the order of the coordinates
+    def __init__(self, dimension, seed=None, scramble=True, priority=None):
+        self.dimension = dimension
+        self.scramble = scramble
+        self.priority = numpy.arange(dimension) if priority is None else numpy.asarray(priority)
+        if sorted(self.priority.tolist()) != list(range(dimension)):
+            raise ValueError(f'priority must be a permutation of the {dimension} coordinates')
+        self.rng = numpy.random.default_rng(seed)
+
+        self.nSobol = min(dimension, SobolSequence.maxDimension)
+        directions = _directionNumbers(self.nSobol, SobolSequence.bits)
+        self.shift = numpy.zeros(self.nSobol, dtype=numpy.uint64)
+        if scramble:
+            directions = self._scrambleDirections(directions)
+            self.shift = self.rng.integers(0, 2 ** SobolSequence.bits, self.nSobol, dtype=numpy.uint64)
+        self.directions = directions
+        self.reset()
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {self.dimension} dimensions-{self.index} points drawn-{"scrambled" if self.scramble else "raw"}'
+
+    # Go back to the first point of the sequence
+    def reset(self):
+        self.index = 0
+        # Last point drawn, before the digital shift: the next points are built from it by Gray code
+        self._last = numpy.zeros(self.nSobol, dtype=numpy.uint64)
+
+    @classmethod
+    def replicates(cls, dimension, nReplicates, seed=None, priority=None):
+        '''
+        Factory method for independent scrambles of the same Sobol sequence
+        :param dimension: number of coordinates of each point
+        :param nReplicates: number of replicates
+        :param seed: seed the replicates' seeds are spawned from
+        :param priority: see __init__
+        :return: list of nReplicates SobolSequence objects
+        '''
+        seedSequence = seed if isinstance(seed, numpy.random.SeedSequence) else numpy.random.SeedSequence(seed)
+        return [cls(dimension, child, True, priority) for child in seedSequence.spawn(nReplicates)]
+
+    def random(self, size=None):
+        '''
+        Next points of the sequence, like numpy.random.Generator.random()
+        :param size: shape of the output. The last axis is the dimension, the others are filled with consecutive points.
+        Default is 1 point
+        :return: float array of uniform [0, 1) numbers
+        '''
+        shape = (self.dimension,) if size is None else tuple(numpy.atleast_1d(size))
+        if shape[-1] != self.dimension:
+            raise ValueError(f'The last axis of {shape} must be the dimension of the sequence ({self.dimension})')
+        nPoints = int(numpy.prod(shape[:-1], dtype=numpy.int64))
+
+        # Gray code order: point n is point n - 1 with the direction number of the lowest set bit of n flipped in,
+        # so a whole block is 1 cumulative XOR
+        indices = numpy.arange(self.index, self.index + nPoints, dtype=numpy.int64)
+        if self.index + nPoints > 2 ** SobolSequence.bits:
+            raise ValueError(f'A SobolSequence has at most 2**{SobolSequence.bits} points')
+        changes = numpy.zeros((nPoints, self.nSobol), dtype=numpy.uint64)
+        positive = indices > 0
+        lowestBit = numpy.log2((indices[positive] & -indices[positive]).astype(float)).astype(numpy.int64)
+        changes[positive] = self.directions[lowestBit]
+        points = numpy.bitwise_xor.accumulate(changes, axis=0) ^ self._last
+        if nPoints:
+            self._last = points[-1].copy()
+        self.index += nPoints
+
+        uniforms = numpy.empty((nPoints, self.dimension))
+        uniforms[:, self.priority[:self.nSobol]] = (points ^ self.shift) * 2. ** -SobolSequence.bits
+        if self.dimension > self.nSobol:
+            uniforms[:, self.priority[self.nSobol:]] = self.rng.random((nPoints, self.dimension - self.nSobol))
+        return uniforms.reshape(shape)
+
+    # INTERNAL METHOD: random linear matrix scrambling. Each coordinate's digits are mixed by a random lower triangular
+    # binary matrix with a unit diagonal, which keeps the net structure of the points
+    def _scrambleDirections(self, directions):
+        bits = SobolSequence.bits
+        weights = numpy.uint64(1) << numpy.arange(bits - 1, -1, -1, dtype=numpy.uint64)
+        # Digit i (from the most significant) of every direction number: (direction numbers x dimensions x digits)
+        digits = ((directions[..., None] & weights) > 0).astype(numpy.int64)
+        matrices = numpy.tril(self.rng.integers(0, 2, (self.nSobol, bits, bits)), -1) + numpy.eye(bits, dtype=numpy.int64)
+        scrambled = numpy.einsum('dik,bdk->bdi', matrices, digits) & 1
+        return (scrambled.astype(numpy.uint64) * weights).sum(axis=2, dtype=numpy.uint64)
+
+
+# Direction numbers of the first nDimensions Sobol dimensions, as (bits x dimensions) integers
+def _directionNumbers(nDimensions, bits):
+    directions = numpy.zeros((bits, nDimensions), dtype=numpy.uint64)
+    # First dimension: van der Corput sequence
+    directions[:, 0] = [1 << (bits - 1 - k) for k in range(bits)]
+
+    for dimension, polynomial in enumerate(_primitive(nDimensions - 1), start=1):
+        degree = polynomial.bit_length() - 1
+        # Initial direction numbers: any odd m_k < 2**k works. Drawn at random (fixed seed) rather than tabulated
+        rng = numpy.random.default_rng([_directionSeed, dimension])
+        m = [int(rng.integers(0, 2 ** (k - 1))) * 2 + 1 for k in range(1, degree + 1)]
+        for k in range(degree, bits):
+            # m_k = m_{k-s} ^ 2**s m_{k-s} ^ sum of 2**i a_i m_{k-i}
+            value = m[k - degree] ^ (m[k - degree] << degree)
+            for i in range(1, degree):
+                if polynomial >> (degree - i) & 1:
+                    value ^= m[k - i] << i
+            m.append(value)
+        directions[:, dimension] = [m[k] << (bits - 1 - k) for k in range(bits)]
+    return directions
+
+
+# First n primitive polynomials over GF(2), by degree then value
+def _primitive(n):
+    candidate = _primitivePolynomials[-1] + 2 if _primitivePolynomials else 3
+    while len(_primitivePolynomials) < n:
+        degree = candidate.bit_length() - 1
+        # Polynomials with an even number of terms are divisible by x + 1
+        if (degree == 1 or bin(candidate).count('1') % 2) and _isPrimitive(candidate, degree):
+            _primitivePolynomials.append(candidate)
+        candidate += 2
+    return _primitivePolynomials[:n]
+
+
+# A polynomial of degree s is primitive if x has order exactly 2**s - 1 modulo it
+def _isPrimitive(polynomial, degree):
+    order = 2 ** degree - 1
+    if _powerOfX(order, polynomial, degree) != 1:
+        return False
+    return all(_powerOfX(order // factor, polynomial, degree) != 1 for factor in _primeFactors(order))
+
+
+# x**exponent modulo the polynomial, by square and multiply
+def _powerOfX(exponent, polynomial, degree):
+    result, base = 1, 2 if degree > 1 else 1
+    while exponent:
+        if exponent & 1:
+            result = _multiplyModulo(result, base, polynomial, degree)
+        base = _multiplyModulo(base, base, polynomial, degree)
+        exponent >>= 1
+    return result
+
+
+# Carry-less product of 2 polynomials, modulo the polynomial
+def _multiplyModulo(a, b, polynomial, degree):
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        b >>= 1
+        a <<= 1
+        if a >> degree & 1:
+            a ^= polynomial
+    return result
+
+
+def _primeFactors(n):
+    factors, factor = [], 2
+    while factor * factor <= n:
+        if n % factor == 0:
+            factors.append(factor)
+            while n % factor == 0:
+                n //= factor
+        factor += 1
+    if n > 1:
+        factors.append(n)
+    return factors
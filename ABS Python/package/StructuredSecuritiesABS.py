@@ -4,9 +4,15 @@ Monday, 6/15/2020: Get back
 StructuredSecurities class
 '''
 
-import logging, math
-from package.Tranche import StandardTranche
+import logging, math, numpy
+from concurrent.futures import ProcessPoolExecutor
+from package.Tranche import Tranche, StandardTranche
+from package.IRRSolver import annualIRR
 from package.LoanPool import LoanPool
+from package.WaterfallKernel import waterfallKernel
+from package.RunningStats import RunningStats, ControlVariateStats, ReplicateStats
+from package.Profiler import profiler
+from package.Decorators import profiled
 
 # This class is a composition of Tranche objects (similar to how LoanPool is a composition of Loans)
 class StructuredSecurities(object):
@@ -16,10 +22,14 @@ class StructuredSecurities(object):
         else:
             logging.error('StructuredSecurities object must have a loanPool parameter')
 
-        # trancheList: the internal list of underlying tranches the Structured Security has
-        # Factory method addTranche() below to append tranches to this list
+        # trancheList: the internal list of underlying tranches the Structured Security has, in order of seniority
+        # Factory method addTranche() below to add tranches to this list
         self.trancheList = []
 
+        # Persistent pool of worker processes used by simulateWaterfallParallel(). Created on first use
+        self._executor = None
+        self._executorWorkers = None
+
         self.reset()
 
 ##############################################
@@ -37,12 +47,21 @@ class StructuredSecurities(object):
         self.loanPool.reset()
         for tranche in self:
             tranche.reset()
+            # The loanPool knows the last period of the next waterfall, so the property columns never have to grow during it
+            tranche.properties.reserve(self.loanPool.horizon() + 1)
 
     # Method to turn the class into a generator that can loop through its tranches:
     def __iter__(self):
         for tranche in self.trancheList:
             yield tranche
 
+    # The worker processes can't be pickled, so leave them out when the object is sent to a worker
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_executorWorkers'] = None
+        return state
+
 
 
     def addTranche(self, trancheClass, percentNotional, rate, subordination):
@@ -51,7 +70,7 @@ class StructuredSecurities(object):
         :param trancheClass: StandardTranche, IOTrance, or POTrance
         :param percentNotional: percentage of the deal's notional the tranche has
         :param rate: rate of the tranche
-        :param subordination: is the tranche senior or subordinated? 'A' is senior, 'B' is subordinated
+        :param subordination: seniority of the tranche: 'A' is senior, 'B' is subordinated to 'A', 'C' to 'B', etc.
         :return: None
         '''
         # Instantiate the tranche
@@ -59,6 +78,9 @@ class StructuredSecurities(object):
         tranche.percentNotional = percentNotional
         # Append the tranche to the StructuredSecurities internal trancheList
         self.trancheList.append(tranche)
+        # Keep the tranches in order of seniority, so every waterfall pays them in that order. The sort is stable:
+        # tranches with the same subordination are paid in the order they were added
+        self.trancheList.sort(key=lambda tranche: tranche.subordination)
 
     def increaseTimePeriod(self):
         '''
@@ -72,117 +94,135 @@ class StructuredSecurities(object):
         self.period += 1
 
     # INTERNAL METHOD (only used by doWaterfallSequential) to loop through the tranches, in order of seniority, and make payments to the tranches
-    def makePayments(self, cashAmount, sequential):
+    def makePayments(self, cashAmount, sequential, cashflow=None):
         '''
         :param cashAmount:  total collections of the ABS available for payout
         (loanPool total payments + recoveries + previous period cash reserve) at the current period
         :param sequential: boolean value specifying principal payout distribution. Passed in by the doWaterfallSequential(sequential) method
+        :param cashflow: PoolPeriodCashflow of the loanPool for the current period. Computed here if not passed in
         :return: None
         '''
+        if cashflow is None:
+            cashflow = self.loanPool.periodCashflow(self.period)
 
         ##### Interest payments
+        with profiler.span('interest pass'):
+            for tranche in self:
+                # Interest payment is the LESSER between the interest due and the available cashAmount
+                # If balance is paid down to 0, interestDue is 0.
+                # Or if all cash has already been paid to senior tranche interest payment, interest for subordinated is 0
+                interestPayment = min(tranche.interestDue(), cashAmount)
+                # Make the interestPayment
+                tranche.makeInterestPayment(interestPayment)
+                # Subtract it from available cash amount
+                cashAmount -= interestPayment
+                # Recording shortfall code is at the bottom of makeInterestPayment() method in Tranche class
+                # Adding shortfall onto the next period interest due code is in the interestDue() method in Tranche class
+
+        ##### Principal payments
+        with profiler.span('principal pass'):
+            # BASELINE principalDue, aka principal due OF THE LOANPOOL for the SS object period
+            principalDue = cashflow.principal
+
+
+            # In this loop, principalDue refers to the TRANCHE's principal due
+            for tranche in self:
+                # Previous period's shortfall and balance, read once from the tranche's property columns
+                previousShortfall = tranche.properties.value('Principal shortfall', tranche.period - 1)
+                previousBalance = tranche.properties.value('Notional balance', tranche.period - 1)
 
-        for tranche in self:
-            # Interest payment is the LESSER between the interest due and the available cashAmount
-            # If balance is paid down to 0, interestDue is 0.
-            # Or if all cash has already been paid to senior tranche interest payment, interest for subordinated is 0
-            interestPayment = min(tranche.interestDue(), cashAmount)
-            # Make the interestPayment
-            tranche.makeInterestPayment(interestPayment)
-            # Subtract it from available cash amount
-            cashAmount -= interestPayment
-            # Recording shortfall code is at the bottom of makeInterestPayment() method in Tranche class
-            # Adding shortfall onto the next period interest due code is in the interestDue() method in Tranche class
-
-
-        # BASELINE principalDue, aka principal due OF THE LOANPOOL for the SS object period
-        principalDue = self.loanPool.totalPrincipalDue(self.period)
-
-
-        # In this loop, principalDue refers to the TRANCHE's principal due
-        for tranche in self:
-
-            # Sequential payout: Senior tranche gets all the principal due if cashAmount allows.
-            if sequential:
-                # Each tranche's principal due must add the previous period shortfall
-                principalDue += tranche.properties[tranche.period - 1]['Principal shortfall']
+                # Sequential payout: Senior tranche gets all the principal due if cashAmount allows.
+                if sequential:
+                    # Each tranche's principal due must add the previous period shortfall
+                    principalDue += previousShortfall
 
-            # Pro-rata payout: principal payments are proportional to each tranche's percentNotional
-            else:
-                # Principal due for the TRANCHE = total principal due of the LOANPOOL * percentNotional + any previous shortfall
-                principalDue = self.loanPool.totalPrincipalDue(self.period) * (tranche.notional / self.totalNotional)\
-                               + tranche.properties[tranche.period - 1]['Principal shortfall']
+                # Pro-rata payout: principal payments are proportional to each tranche's percentNotional
+                else:
+                    # Principal due for the TRANCHE = total principal due of the LOANPOOL * percentNotional + any previous shortfall
+                    principalDue = cashflow.principal * (tranche.notional / self.totalNotional)\
+                                   + previousShortfall
 
-            # Tranche principal payment = the minimum of principal due, available cashAmount, and balance for the PREVIOUS period
-            principalPayment = min(principalDue, cashAmount, tranche.properties[tranche.period - 1]['Notional balance'])
+                # Tranche principal payment = the minimum of principal due, available cashAmount, and balance for the PREVIOUS period
+                principalPayment = min(principalDue, cashAmount, previousBalance)
 
-            ##### Making payments, recording them, and reducing cash and principal due for each tranche
-            if principalPayment != tranche.properties[tranche.period - 1]['Notional balance']:
-                principalDue = cashAmount
-                principalPayment = cashAmount
-                # Record principal due in the tranche properties dictionary
-                tranche.properties[tranche.period]['Principal due'] = principalDue
+                ##### Making payments, recording them, and reducing cash and principal due for each tranche
+                if principalPayment != previousBalance:
+                    principalDue = cashAmount
+                    principalPayment = cashAmount
+                    # Record principal due in the tranche properties
+                    tranche.properties.set('Principal due', tranche.period, principalDue)
 
-            # SPECIAL CASE: If the tranche is paid off, principalDue is equal to the principal payment
-            if principalPayment == tranche.properties[tranche.period - 1]['Notional balance']:
-                tranche.properties[tranche.period]['Principal due'] = principalPayment
+                # SPECIAL CASE: If the tranche is paid off, principalDue is equal to the principal payment
+                if principalPayment == previousBalance:
+                    tranche.properties.set('Principal due', tranche.period, principalPayment)
 
-            # Record the principal payment and the notional balance in the tranche properties dict
-            tranche.makePrincipalPayment(principalPayment)
+                # Record the principal payment and the notional balance in the tranche properties
+                tranche.makePrincipalPayment(principalPayment)
 
-            # Record principal shortfall: max of 0 and difference between tranche due and tranche payment
-            principalShortfall = max(0, tranche.properties[tranche.period]['Principal due'] - principalPayment)
-            tranche.properties[tranche.period]['Principal shortfall'] = principalShortfall
+                # Record principal shortfall: max of 0 and difference between tranche due and tranche payment
+                principalShortfall = max(0, tranche.properties.value('Principal due', tranche.period) - principalPayment)
+                tranche.properties.set('Principal shortfall', tranche.period, principalShortfall)
 
-            # Reduce cash amount by the principal payment
-            cashAmount -= principalPayment
+                # Reduce cash amount by the principal payment
+                cashAmount -= principalPayment
 
-            # Record cash leftover after principal payments for each tranche
-            tranche.properties[tranche.period]['Cash reserve'] = cashAmount
+                # Record cash leftover after principal payments for each tranche
+                tranche.properties.set('Cash reserve', tranche.period, cashAmount)
 
-            # If a tranche has a principal shortfall, then the next tranches should not have any principal due for that period
-            if principalShortfall > 1:
-                principalDue = principalPayment
+                # If a tranche has a principal shortfall, then the next tranches should not have any principal due for that period
+                if principalShortfall > 1:
+                    principalDue = principalPayment
 
-            # Reduce principal due by the principal payment
-            principalDue -= principalPayment
+                # Reduce principal due by the principal payment
+                principalDue -= principalPayment
 
     # Method to do waterfalls for the SS object for each period until the underlying loanPool runs out of active loans
-    def doWaterfallSequential(self, sequential=True):
+    @profiled(name='waterfall')
+    def doWaterfallSequential(self, sequential=True, writers=(), path=0):
         '''
         :param sequential: specify principal payout distribution. True for sequential, False for prorata. Default is True
+        :param writers: WaterfallWriter objects (see WaterfallWriter.py) that each period is streamed to as soon as it is recorded,
+        or a SimulationStore (see SimulationStore.py) to keep every path on disk
+        :param path: simulation number passed to the writers
         :return: None
         '''
 
         self.period = 0
+        for writer in writers:
+            writer.record(self, 0, path)
 
-        # Evaluate to True until theres no active loan left
-        while self.loanPool.activeLoans(self.period):
+        # The loanPool knows up front when its last loan pays off or defaults, so loop until then instead of
+        # checking for active loans every period
+        for period in range(1, self.loanPool.horizon() + 1):
 
             # Increment period of self, and also all the tranches
             self.increaseTimePeriod()
-            # Check the loanPool for any default in that period, store the total recovery value, and record it in the properties dict
-            totalRecovery = self.loanPool.checkDefaultsReturnRecovery(self.period)
-            # Total collections for the period = total payments due from the loanPool + total recovery from the defaulted loans + cash reserve stored in the last tranche properties
-            totalCollections = self.loanPool.totalPaymentDue(self.period) + totalRecovery + self.trancheList[1].properties[self.period - 1]['Cash reserve']
+            with profiler.span('pool aggregation'):
+                # Check the loanPool for any default in that period and store the total recovery value
+                totalRecovery = self.loanPool.checkDefaultsReturnRecovery(self.period)
+                # All the loanPool totals for the period, computed once and shared by the payments and the Asset side waterfall
+                cashflow = self.loanPool.periodCashflow(self.period, totalRecovery)
+            # Total collections for the period = total payments due from the loanPool + total recovery from the defaulted loans + cash reserve stored in the last (most junior) tranche properties
+            totalCollections = cashflow.collections + self.trancheList[-1].properties.value('Cash reserve', self.period - 1)
             # Make the payments for the current period
-            self.makePayments(totalCollections, sequential)
-            # Record the payments on the Asset side using LoanPool's getWaterfall() method
-            self.loanPool.getWaterfall(self.period)
-            # Record the loanPool recoveries here
-            self.loanPool.properties[self.period]['Recoveries'] = totalRecovery
-
-        # Once the waterfall is done, initialize 2 tallies: 1 for RIY and 1 for AL so as to add them up in simulations
-        for tranche in self:
-            tranche.properties[tranche.period]['Total RIY'] = 0
-            tranche.properties[tranche.period]['Total AL'] = 0
-
-
-    def simulateWaterfallSequential(self, nSims, sequential=True):
+            self.makePayments(totalCollections, sequential, cashflow)
+            # Record the payments and the recoveries on the Asset side using LoanPool's getWaterfall() method
+            self.loanPool.getWaterfall(self.period, cashflow)
+            for writer in writers:
+                writer.record(self, self.period, path)
+
+        profiler.count('paths')
+        profiler.count('periods', self.period)
+        if profiler.enabled:
+            profiler.count('defaults', self.loanPool.defaultCount())
+
+    @profiled
+    def simulateWaterfallSequential(self, nSims, sequential=True, writers=()):
         '''
         Method to run the waterfall multiple times
         :param nSims: number of simulations to run
         :param sequential=True: specify principal payout distribution for the tranches
+        :param writers: WaterfallWriter or SimulationStore objects that every period of every simulation is streamed to
         :return: a dictionary with key = tranche, value = pairs-tuple (weighted RIY, weighted AL)
         '''
 
@@ -200,17 +240,18 @@ class StructuredSecurities(object):
 
         # doWaterfallSequential nSims times
         for nSim in range(nSims):
-            self.doWaterfallSequential(sequential)
+            self.doWaterfallSequential(sequential, writers, nSim)
 
             # After the iteration is done, add it onto the metrics tally in the dictionary
-            for tranche in self:
+            with profiler.span('metrics'):
+                for tranche in self:
 
-                # Add the iteration RIY to the metrics tally
-                metricsDict[tranche][f'Total RIY'] += tranche.RIY()[0]
+                    # Add the iteration RIY to the metrics tally
+                    metricsDict[tranche][f'Total RIY'] += Tranche.simulationRIY(tranche.rate, tranche.IRR())
 
-                # Only add the average life if the tranche is paid down
-                if tranche.AL() is not None:
-                    metricsDict[tranche][f'Total AL'] += tranche.AL()
+                    # Only add the average life if the tranche is paid down
+                    if tranche.AL() is not None:
+                        metricsDict[tranche][f'Total AL'] += tranche.AL()
 
             # Reset the ABS and the tranches to doWaterfallSequential all over again
             self.reset()
@@ -228,12 +269,426 @@ class StructuredSecurities(object):
 
         return dictTuple
 
-    def runMonteSequential(self, nSims, tolerance, sequential=True):
+    @profiled
+    def simulateWaterfallBatched(self, nSims, sequential=True, batchSize=500, seed=None, writers=(), sampling='random', nReplicates=8):
+        '''
+        Vectorized twin of simulateWaterfallSequential: simulates blocks of paths at once as (paths x periods) matrices
+        instead of running doWaterfallSequential, reset() and the object mutations path by path
+        :param nSims: number of simulations to run
+        :param sequential=True: specify principal payout distribution for the tranches
+        :param batchSize: number of paths simulated together. Bounds the memory used by the (paths x loans) default draws
+        :param seed: seed of the numpy random Generator. Default is the loanPool's Generator
+        :param writers: WaterfallWriter or SimulationStore objects that every block of paths is streamed to.
+        The memory used stays bounded by batchSize whatever nSims is
+        :param sampling: 'random' for pseudo-random default scenarios, 'sobol' for scrambled Sobol points (quasi-Monte Carlo)
+        :param nReplicates: number of independent Sobol scrambles the paths are split between
+        :return: a dictionary with key = tranche, value = pairs-tuple (weighted RIY, weighted AL)
+        '''
+
+        # Pools that can't be vectorized (i.e. mortgages with PMI) must go through the object model
+        if self.loanPool.loanArrays is None:
+            logging.warning('The loanPool cannot be vectorized. Running simulateWaterfallSequential instead')
+            return self.simulateWaterfallSequential(nSims, sequential, writers)
+
+        generators = self._scenarioGenerators(seed, sampling, nReplicates)
+        totalRIY = numpy.zeros(len(self.trancheList))
+        totalAL = numpy.zeros(len(self.trancheList))
+        # The paths are split evenly between the generators (only 1 unless sampling is 'sobol')
+        start = 0
+        for index, generator in enumerate(generators):
+            nPaths = nSims // len(generators) + (index < nSims % len(generators))
+            replicateRIY, replicateAL = self.simulateTotalsBatched(nPaths, generator, sequential, batchSize, writers=writers, pathOffset=start)
+            totalRIY += replicateRIY
+            totalAL += replicateAL
+            start += nPaths
+
+        dictTuple = {}
+        for index, tranche in enumerate(self):
+            dictTuple[tranche] = (float(totalRIY[index] / nSims), float(totalAL[index] / nSims))
+        return dictTuple
+
+    def simulateTotalsBatched(self, nSims, rng, sequential=True, batchSize=500, rates=None, writers=(), pathOffset=0):
+        '''
+        Run nSims batched paths and tally the metrics. Shared by simulateWaterfallBatched() and the parallel workers
+        :param nSims: number of simulations to run
+        :param rng: numpy random Generator (or SobolSequence) for the default draws
+        :param sequential: specify principal payout distribution for the tranches
+        :param batchSize: number of paths simulated together
+        :param rates: list of tranche rates to use instead of the tranches' own rates
+        :param writers: WaterfallWriter objects that every block of paths is streamed to
+        :param pathOffset: simulation number of the first path, for the writers
+        :return: 2 arrays with one entry per tranche: total RIY and total AL over all the paths
+        '''
+        totalRIY = numpy.zeros(len(self.trancheList))
+        totalAL = numpy.zeros(len(self.trancheList))
+
+        for start in range(0, nSims, batchSize):
+            nPaths = min(batchSize, nSims - start)
+            # Draw the defaults of every loan (or rep line) on every path of the block at once
+            defaults = self.loanPool.sampleDefaults(nPaths, rng)
+            pool = self.poolCollectionsBatched(defaults)
+            waterfall = self.doWaterfallBatched(pool, sequential, rates)
+            for writer in writers:
+                writer.recordBatch(self, pool, waterfall, pathOffset + start)
+            RIY, AL = self.batchMetrics(waterfall, rates)
+            totalRIY += RIY.sum(axis=1)
+            # Only add the average life if the tranche is paid down (nan otherwise)
+            totalAL += numpy.nansum(AL, axis=1)
+
+        return totalRIY, totalAL
+
+    def simulateWaterfallParallel(self, nSims, sequential=True, nWorkers=None, seed=None, chunkSize=250):
+        '''
+        Run the batched simulation in chunks spread over a persistent pool of worker processes
+        Every chunk gets its own random stream spawned from the seed, and the chunks are merged in order,
+        so the results for a given seed are identical whatever the number of workers
+        :param nSims: number of simulations to run
+        :param sequential=True: specify principal payout distribution for the tranches
+        :param nWorkers: number of worker processes. Default is the number of CPUs. 1 runs the chunks in this process
+        :param seed: int or numpy SeedSequence. Default is fresh entropy
+        :param chunkSize: number of paths per chunk
+        :return: a dictionary with key = tranche, value = pairs-tuple (weighted RIY, weighted AL)
+        '''
+        if self.loanPool.loanArrays is None:
+            logging.warning('The loanPool cannot be vectorized. Running simulateWaterfallSequential instead')
+            return self.simulateWaterfallSequential(nSims, sequential)
+
+        seedSequence = seed if isinstance(seed, numpy.random.SeedSequence) else numpy.random.SeedSequence(seed)
+        chunks = [min(chunkSize, nSims - start) for start in range(0, nSims, chunkSize)]
+        chunkSeeds = seedSequence.spawn(len(chunks))
+        # Pass the current rates along with every chunk, so the workers never use stale tranche rates
+        rates = [tranche.rate for tranche in self]
+
+        if nWorkers == 1:
+            results = [_simulateChunk(nPaths, chunkSeed, sequential, rates, self) for nPaths, chunkSeed in zip(chunks, chunkSeeds)]
+        else:
+            executor = self.startWorkers(nWorkers)
+            results = executor.map(_simulateChunk, chunks, chunkSeeds, [sequential] * len(chunks), [rates] * len(chunks))
+
+        # Merge the chunk tallies in chunk order
+        totalRIY = numpy.zeros(len(self.trancheList))
+        totalAL = numpy.zeros(len(self.trancheList))
+        for chunkRIY, chunkAL in results:
+            totalRIY += chunkRIY
+            totalAL += chunkAL
+
+        dictTuple = {}
+        for index, tranche in enumerate(self):
+            dictTuple[tranche] = (float(totalRIY[index] / nSims), float(totalAL[index] / nSims))
+        return dictTuple
+
+    def startWorkers(self, nWorkers=None):
+        '''
+        Start (or reuse) the persistent worker processes. Each worker receives a copy of the ABS once, when it starts
+        Call closeWorkers() after changing the loanPool or the tranches, so that the next call sends the new ABS
+        :param nWorkers: number of worker processes. Default is the number of CPUs
+        :return: the ProcessPoolExecutor
+        '''
+        if self._executor is None or self._executorWorkers != nWorkers:
+            self.closeWorkers()
+            self._executor = ProcessPoolExecutor(max_workers=nWorkers, initializer=_initWorker, initargs=(self,))
+            self._executorWorkers = nWorkers
+        return self._executor
+
+    def closeWorkers(self):
+        # Shut down the worker processes, if any
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+            self._executorWorkers = None
+
+    @profiled(name='pool aggregation')
+    def poolCollectionsBatched(self, defaultPeriods):
+        '''
+        Asset side of the waterfall for a block of paths, same rules as doWaterfallSequential and the LoanPool methods
+        :param defaultPeriods: (paths x loans) integer array of default periods,
+        or for rep lines, (paths x lines x periods) number of loans defaulting. See LoanPool.sampleDefaults()
+        :return: dictionary of (paths x periods) arrays with keys 'Payment', 'Principal', 'Recoveries',
+        and 'Horizon': the last period of each path, i.e. when the loanPool runs out of active loans
+        '''
+        if defaultPeriods.ndim == 3:
+            return self._poolCollectionsCounts(defaultPeriods)
+
+        loanArrays = self.loanPool.loanArrays
+        schedule = loanArrays.schedule()
+        nPaths = defaultPeriods.shape[0]
+        nColumns = schedule['Payment'].shape[1]
+
+        # A loan stops being active after it defaults or it is paid off, same as LoanPool.horizon()
+        horizon = numpy.minimum(defaultPeriods, loanArrays.lifetime()).max(axis=1)
+
+        payment = numpy.zeros((nPaths, nColumns))
+        principal = numpy.zeros((nPaths, nColumns))
+        for period in range(1, nColumns):
+            # Loans pay in a period only if they haven't defaulted yet. Matured loans (before the live slice) pay nothing
+            start = loanArrays.liveStart(period)
+            alive = (defaultPeriods[:, start:] > period).astype(float)
+            payment[:, period] = alive @ schedule['Payment'][start:, period]
+            principal[:, period] = alive @ schedule['Principal'][start:, period]
+
+        # Recoveries: 60% of the asset value at the period of default, for every default before the end of the path
+        recoveries = numpy.zeros((nPaths, nColumns))
+        paths, loans = numpy.nonzero(defaultPeriods <= horizon[:, None])
+        profiler.count('defaults', len(paths))
+        periods = defaultPeriods[paths, loans]
+        numpy.add.at(recoveries, (paths, periods), loanArrays.recoveryValue(periods, loans))
+
+        # Nothing gets collected after the end of each path
+        afterHorizon = numpy.arange(nColumns) > horizon[:, None]
+        for matrix in (payment, principal, recoveries):
+            matrix[afterHorizon] = 0.
+
+        return {'Payment': payment, 'Principal': principal, 'Recoveries': recoveries, 'Horizon': horizon}
+
+    # INTERNAL METHOD: poolCollectionsBatched() for rep lines, where part of a line can default
+    def _poolCollectionsCounts(self, defaultCounts):
+        loanArrays = self.loanPool.loanArrays
+        schedule = loanArrays.schedule()
+        nPaths, nLines, nColumns = defaultCounts.shape
+
+        count = loanArrays.count.astype(float)
+        lifetime = loanArrays.lifetime()
+        cumulative = numpy.cumsum(defaultCounts, axis=2, dtype=float)
+
+        # Last period of each path, same as LoanPool.horizon(): a line ends when it is paid off if any of its loans is
+        # still alive by then, otherwise when its last loan defaults (rare, so that case is looked up path by path)
+        defaultedBeforeEnd = cumulative[:, numpy.arange(nLines), numpy.maximum(lifetime - 1, 0)]
+        lineEnd = numpy.where(defaultedBeforeEnd < count, lifetime, 0)
+        for path, line in zip(*numpy.nonzero(defaultedBeforeEnd >= count)):
+            lineEnd[path, line] = numpy.searchsorted(cumulative[path, line], count[line], side='left')
+        horizon = lineEnd.max(axis=1)
+
+        # Fraction of each line still paying: loans defaulting IN a period don't pay in that period
+        # Nothing is paid at period 0, same as the loan by loan version
+        alive = cumulative
+        alive /= -count[:, None]
+        alive += 1.
+        payment = numpy.einsum('plt,lt->pt', alive, schedule['Payment'])
+        principal = numpy.einsum('plt,lt->pt', alive, schedule['Principal'])
+        payment[:, 0] = principal[:, 0] = 0.
+
+        # Recoveries: the defaulted fraction of each line's asset value at the period of default
+        periods = numpy.arange(nColumns)
+        lineRecovery = loanArrays.recoveryValue(periods[None, :]) / loanArrays.count[:, None]
+        recoveries = numpy.einsum('plt,lt->pt', defaultCounts, lineRecovery)
+        if profiler.enabled:
+            profiler.count('defaults', int((defaultCounts * (periods <= horizon[:, None, None])).sum()))
+
+        # Nothing gets collected after the end of each path
+        afterHorizon = periods > horizon[:, None]
+        for matrix in (payment, principal, recoveries):
+            matrix[afterHorizon] = 0.
+
+        return {'Payment': payment, 'Principal': principal, 'Recoveries': recoveries, 'Horizon': horizon}
+
+    @profiled(name='waterfall')
+    def doWaterfallBatched(self, pool, sequential=True, rates=None):
+        '''
+        Liabilities side of the waterfall for a block of paths: same rules as makePayments, run across all paths at once
+        for any number of tranches. See waterfallKernel()
+        :param pool: dictionary returned by poolCollectionsBatched()
+        :param sequential: specify principal payout distribution. True for sequential, False for prorata
+        :param rates: list of tranche rates to use instead of the tranches' own rates
+        :return: dictionary of (tranches x paths x periods) arrays with keys Tranche.fields ('Interest due',
+        'Interest payment', 'Interest shortfall', 'Principal due', 'Principal payment', 'Notional balance',
+        'Principal shortfall', 'Cash reserve'), and 'Horizon' from the pool
+        '''
+        if rates is None:
+            rates = [tranche.rate for tranche in self]
+        profiler.count('paths', len(pool['Horizon']))
+        if profiler.enabled:
+            profiler.count('periods', int(pool['Horizon'].sum()))
+        # The trancheList is already in order of seniority
+        return waterfallKernel(pool['Payment'] + pool['Recoveries'], pool['Principal'], pool['Horizon'],
+                               [tranche.notional for tranche in self], rates, sequential, totalNotional=self.totalNotional)
+
+    @profiled(name='metrics')
+    def batchMetrics(self, waterfall, rates=None, withIRR=False):
+        '''
+        RIY and AL of each tranche on each path of a doWaterfallBatched() result, same formulas as the Tranche class
+        :param waterfall: dictionary returned by doWaterfallBatched()
+        :param rates: list of tranche rates used in the waterfall. Default is the tranches' own rates
+        :param withIRR: True to also return the annual IRRs
+        :return: 2 (tranches x paths) arrays: RIY in bps, and AL (nan if the tranche is not paid down),
+        and the (tranches x paths) annual IRRs rounded like Tranche.IRR() if withIRR
+        '''
+        if rates is None:
+            rates = [tranche.rate for tranche in self]
+        nPaths, nColumns = waterfall['Principal payment'].shape[1:]
+        RIY = numpy.zeros((len(self.trancheList), nPaths))
+        AL = numpy.zeros((len(self.trancheList), nPaths))
+        IRRs = numpy.zeros((len(self.trancheList), nPaths))
+
+        for index, tranche in enumerate(self):
+            cashFlows = waterfall['Interest payment'][index] + waterfall['Principal payment'][index]
+            cashFlows[:, 0] = -tranche.notional
+            # IRR of all the paths in 1 call, warm started from the tranche coupon
+            IRR = annualIRR(cashFlows, rates[index])
+            # Rounded like Tranche.IRR(), then the same nan mapping and RIY as the object waterfall
+            IRRs[index] = Tranche.simulationIRR(numpy.round(IRR, 4))
+            RIY[index] = Tranche.simulationRIY(rates[index], IRRs[index])
+
+            # AL only if the tranche is paid down at the end of the path
+            finalBalance = waterfall['Notional balance'][index, numpy.arange(nPaths), waterfall['Horizon']]
+            weightedPayments = waterfall['Principal payment'][index] @ numpy.arange(nColumns)
+            AL[index] = numpy.where(finalBalance <= 0.001, weightedPayments / tranche.notional, numpy.nan)
+
+        if withIRR:
+            return RIY, AL, IRRs
+        return RIY, AL
+
+    @profiled
+    def simulateSummary(self, nSims, sequential=True, batchSize=500, seed=None):
+        '''
+        Summary-only simulation: the running statistics are updated as each path (or block of paths) finishes,
+        and nothing else is kept, so the memory used doesn't grow with nSims
+        :param nSims: number of simulations to run
+        :param sequential=True: specify principal payout distribution for the tranches
+        :param batchSize: number of paths simulated together when the loanPool can be vectorized
+        :param seed: seed of the numpy random Generator. Default is the loanPool's Generator
+        :return: a dictionary with key = tranche, value = dictionary of RunningStats with keys 'RIY', 'AL' and 'IRR',
+        and key 'Defaults': RunningStats of the number of loans defaulting during each waterfall.
+        The AL of the paths where a tranche is not paid down is counted in RunningStats.missing, like the weighted AL skips it
+        '''
+        summary = {tranche: {metric: RunningStats(f'{tranche.subordination} {metric}') for metric in ('RIY', 'AL', 'IRR')}
+                   for tranche in self}
+        summary['Defaults'] = RunningStats('Defaults')
+        rng = numpy.random.default_rng(seed) if seed is not None else self.loanPool.rng
+
+        # Pools that can't be vectorized (i.e. mortgages with PMI) go through the object model, 1 path at a time.
+        # The property columns are allocated once and wiped by reset(), so no history piles up
+        if self.loanPool.loanArrays is None:
+            self.loanPool.rng = rng
+            for nSim in range(nSims):
+                self.reset()
+                self.doWaterfallSequential(sequential)
+                for tranche in self:
+                    # Same nan mapping and RIY formula as batchMetrics()
+                    IRR = tranche.IRR()
+                    summary[tranche]['IRR'].update(Tranche.simulationIRR(IRR))
+                    summary[tranche]['RIY'].update(Tranche.simulationRIY(tranche.rate, IRR))
+                    summary[tranche]['AL'].update(tranche.AL())
+                summary['Defaults'].update(self.loanPool.defaultCount())
+            self.reset()
+            return summary
+
+        for start in range(0, nSims, batchSize):
+            defaults = self.loanPool.sampleDefaults(min(batchSize, nSims - start), rng)
+            pool = self.poolCollectionsBatched(defaults)
+            RIY, AL, IRR = self.batchMetrics(self.doWaterfallBatched(pool, sequential), withIRR=True)
+            for index, tranche in enumerate(self):
+                summary[tranche]['RIY'].updateBatch(RIY[index])
+                summary[tranche]['AL'].updateBatch(AL[index])
+                summary[tranche]['IRR'].updateBatch(IRR[index])
+
+            # Loans that default before the end of the waterfall, same as the recoveries
+            horizon = pool['Horizon']
+            if defaults.ndim == 3:
+                inWaterfall = numpy.arange(defaults.shape[2]) <= horizon[:, None, None]
+                summary['Defaults'].updateBatch((defaults * inWaterfall).sum(axis=(1, 2)))
+            else:
+                summary['Defaults'].updateBatch((defaults <= horizon[:, None]).sum(axis=1))
+
+        return summary
+
+    @profiled
+    def simulateToPrecision(self, targetError, sequential=True, batchSize=500, maxSims=100000, antithetic=False,
+                            controlVariate=False, seed=None, sampling='random', nReplicates=8):
+        '''
+        Simulate blocks of paths until the standard error of every tranche's mean RIY and AL is down to targetError,
+        or maxSims paths have been run, instead of guessing nSims up front
+        :param targetError: target standard error: 1 number for both metrics, or a dictionary {'RIY': bps, 'AL': periods}
+        :param sequential=True: specify principal payout distribution for the tranches
+        :param batchSize: number of paths simulated together. The standard errors are checked after each block
+        :param maxSims: budget: stop after this many paths even if the target is not reached
+        :param antithetic: True to draw the defaults in antithetic pairs. Each pair is averaged into 1 value, so the
+        standard error accounts for the pairs not being independent paths
+        :param controlVariate: True to adjust the means with the scheduled loss at default (see LoanPool.scheduledLossAtDefault()),
+        whose exact mean is known from the default-free schedule
+        :param seed: seed of the numpy random Generator (or of the Sobol scrambling). Default is the loanPool's Generator
+        :param sampling: 'random' for pseudo-random default scenarios, 'sobol' for scrambled Sobol points (quasi-Monte Carlo)
+        :param nReplicates: number of independent Sobol scrambles. Each round runs batchSize paths on every replicate,
+        and the standard error is the spread of the replicates' estimates
+        :return: a dictionary with key = tranche, value = dictionary of RunningStats (ControlVariateStats with controlVariate,
+        ReplicateStats with sobol sampling) with keys 'RIY' and 'AL': estimate() gives the mean and its standard error.
+        The AL counts 0 on the paths where the tranche is not paid down, like the weighted AL. Key 'Paths': number of paths run
+        '''
+        if self.loanPool.loanArrays is None:
+            raise TypeError('simulateToPrecision needs a loanPool that can be vectorized. Use simulateSummary instead.')
+        generators = self._scenarioGenerators(seed, sampling, nReplicates)
+        targets = targetError if isinstance(targetError, dict) else {'RIY': targetError, 'AL': targetError}
+        # Antithetic pairs must not be split across blocks
+        if antithetic and batchSize % 2:
+            batchSize += 1
+
+        controlMean = self.loanPool.expectedScheduledLossAtDefault() if controlVariate else None
+        def newStats(name):
+            return ControlVariateStats(name, controlMean) if controlVariate else RunningStats(name)
+        summary = {}
+        for tranche in self:
+            names = {metric: f'{tranche.subordination} {metric}' for metric in targets}
+            if sampling == 'sobol':
+                summary[tranche] = {metric: ReplicateStats(name, [newStats(f'{name} {replicate}') for replicate in range(nReplicates)])
+                                    for metric, name in names.items()}
+            else:
+                summary[tranche] = {metric: newStats(name) for metric, name in names.items()}
+
+        nPaths = 0
+        while nPaths < maxSims:
+            # 1 block per scenario generator: the standard errors are checked once all the replicates have moved on
+            for replicate, generator in enumerate(generators):
+                nBatch = min(batchSize, maxSims - nPaths)
+                if nBatch <= 0:
+                    break
+                defaults = self.loanPool.sampleDefaults(nBatch, generator, antithetic)
+                RIY, AL = self.batchMetrics(self.doWaterfallBatched(self.poolCollectionsBatched(defaults), sequential))
+                metrics = {'RIY': RIY, 'AL': numpy.nan_to_num(AL)}
+                controls = self.loanPool.scheduledLossAtDefault(defaults) if controlVariate else None
+                if antithetic and defaults.ndim == 2:
+                    # Average each pair. A last unpaired path is kept on its own
+                    pairs = numpy.arange(nBatch) // 2
+                    size = numpy.bincount(pairs)
+                    metrics = {metric: numpy.array([numpy.bincount(pairs, row) / size for row in values]) for metric, values in metrics.items()}
+                    controls = numpy.bincount(pairs, controls) / size if controlVariate else None
+
+                for index, tranche in enumerate(self):
+                    for metric in targets:
+                        stats = summary[tranche][metric]
+                        if sampling == 'sobol':
+                            stats.updateBatch(metrics[metric][index], controls, replicate)
+                        elif controlVariate:
+                            stats.updateBatch(metrics[metric][index], controls)
+                        else:
+                            stats.updateBatch(metrics[metric][index])
+                nPaths += nBatch
+
+            # Done when every tranche's standard error is on target
+            if all(summary[tranche][metric].estimate()[1] <= target for tranche in self for metric, target in targets.items()):
+                break
+        else:
+            logging.warning(f'simulateToPrecision: target standard error {targetError} not reached after {nPaths} paths')
+
+        summary['Paths'] = nPaths
+        return summary
+
+    # INTERNAL METHOD: default scenario generators of a run: the loanPool's (or a seeded) numpy Generator,
+    # or nReplicates scrambled Sobol sequences
+    def _scenarioGenerators(self, seed, sampling, nReplicates):
+        if sampling == 'random':
+            return [numpy.random.default_rng(seed) if seed is not None else self.loanPool.rng]
+        if sampling == 'sobol':
+            return self.loanPool.sobolReplicates(nReplicates, seed)
+        raise ValueError(f'Unknown sampling "{sampling}". Options include: "random" or "sobol"')
+
+    @profiled
+    def runMonteSequential(self, nSims, tolerance, sequential=True, nWorkers=None, seed=None):
         '''
         Method to do Monte Carlo simulation nSims times on the ABS
         :param nSims: the number of simulations we want to run
         :param tolerance: mechanism to specify when the Monte Carlo simulation is done: if the rates difference between each simulation is lower than tolerance, break
         :param sequential=True: specify principal payout distribution. Default is sequential
+        :param nWorkers: if passed in, every iteration runs simulateWaterfallParallel() on the same persistent worker processes
+        :param seed: seed for the parallel simulations. Each iteration gets its own stream spawned from it
         :return: a dictionary with key = tranche, value = 3-items-tuples (weighted RIY, weighted AL, fair rate)
         '''
 
@@ -241,17 +696,24 @@ class StructuredSecurities(object):
         According to advanced numerical methods:
         𝑛𝑒𝑤𝑇𝑟𝑎𝑛𝑐ℎ𝑒𝑅𝑎𝑡𝑒 = 𝑜𝑙𝑑𝑇𝑟𝑎𝑛𝑐ℎ𝑒𝑅𝑎𝑡𝑒 + 𝑐𝑜𝑒𝑓𝑓 ∗ (𝑦𝑖𝑒𝑙𝑑 − 𝑜𝑙𝑑𝑇𝑟𝑎𝑛𝑐ℎ𝑒𝑅𝑎𝑡𝑒)
         𝒘𝒉𝒆𝒓𝒆 𝑐𝑜𝑒𝑓𝑓 𝑖𝑠 1.2 𝑓𝑜𝑟 𝑇𝑟𝑎𝑛𝑐ℎ𝑒 𝐴 𝑎𝑛𝑑 0.8 𝑓𝑜𝑟 𝑇𝑟𝑎𝑛𝑐ℎ𝑒 𝐵
+        With more than 2 tranches, coeff goes evenly from 1.2 for the most senior to 0.8 for the most junior
         '''
         yieldsList = []
-        coefficientsList = [1.2, 0.8]
+        nTranches = len(self.trancheList)
+        coefficientsList = numpy.linspace(1.2, 0.8, nTranches).tolist()
 
         # Initialize ratesList with the original, arbitrary rate, which we'll later REFINE in the infinite loop
-        ratesList = [self.trancheList[0].rate, self.trancheList[1].rate]
+        ratesList = [tranche.rate for tranche in self]
+
+        seedSequence = seed if isinstance(seed, numpy.random.SeedSequence) else numpy.random.SeedSequence(seed)
 
         while True:
 
             # Run the Waterfall nSims times and save the tranches' AVERAGE metrics to a dictionary
-            metricsDict = self.simulateWaterfallSequential(nSims, sequential)
+            if nWorkers is not None:
+                metricsDict = self.simulateWaterfallParallel(nSims, sequential, nWorkers, seedSequence.spawn(1)[0])
+            else:
+                metricsDict = self.simulateWaterfallSequential(nSims, sequential)
 
             # Pass in those metrics into our calculateYield() function and append the yields to the yieldsList
             for tranche, metricsTuple in metricsDict.items():
@@ -260,8 +722,7 @@ class StructuredSecurities(object):
 
             # Tweak the tranche rate to reflect the new yield
             # Relaxation to speed up convergence
-            # Hardcoded 2 instead of len(self.trancheList) because our model only works with 2 tranches
-            for index in range(2):
+            for index in range(nTranches):
                 '''
                 Formula
                 𝑛𝑒𝑤𝑇𝑟𝑎𝑛𝑐ℎ𝑒𝑅𝑎𝑡𝑒 = 𝑜𝑙𝑑𝑇𝑟𝑎𝑛𝑐ℎ𝑒𝑅𝑎𝑡𝑒 + 𝑐𝑜𝑒𝑓𝑓 ∗ (𝑦𝑖𝑒𝑙𝑑 − 𝑜𝑙𝑑𝑇𝑟𝑎𝑛𝑐ℎ𝑒𝑅𝑎𝑡𝑒)
@@ -274,7 +735,7 @@ class StructuredSecurities(object):
                 # # Debug
                 # print(f'{index} old rate: {oldTrancheRate}, new rate: {newTrancheRate}, yieldsList: {yieldsList}')
 
-            'ratesList now holds 4 elements: oldTrancheRateA, oldTrancheRateB, newTrancheRateA, newTrancheRateB'
+            'ratesList now holds 2 rates per tranche: the old rates of all the tranches, then the new rates'
             # Calculate difference between the new tranche rate and the old tranche rate
             '''
             𝑑𝑖𝑓𝑓 =(𝑛𝐴 ∗ |𝑙𝑎𝑠𝑡𝐴𝑅𝑎𝑡𝑒 − 𝑛𝑒𝑤𝐴𝑅𝑎𝑡𝑒 / 𝑙𝑎𝑠𝑡𝐴𝑅𝑎𝑡𝑒 | + 𝑛𝐵 ∗ |𝑙𝑎𝑠𝑡𝐵𝑅𝑎𝑡𝑒 − 𝑛𝑒𝑤𝐵𝑅𝑎𝑡𝑒 / 𝑙𝑎𝑠𝑡𝐵𝑅𝑎𝑡𝑒 |) / 𝑁
@@ -286,12 +747,12 @@ class StructuredSecurities(object):
             # diffA = self.trancheList[0].notional * abs((ratesList[0] - ratesList[2])/ratesList[0]) / self.trancheList[0].notional
             # diffB = self.trancheList[1].notional * abs((ratesList[1] - ratesList[3])/ratesList[1]) / self.trancheList[1].notional
 
-            diff = (self.trancheList[0].notional * abs((ratesList[0] - ratesList[2])/ratesList[0])
-                    + self.trancheList[1].notional * abs((ratesList[1] - ratesList[3])/ratesList[1])) / self.totalNotional
+            diff = sum(tranche.notional * abs((ratesList[index] - ratesList[nTranches + index]) / ratesList[index])
+                       for index, tranche in enumerate(self)) / self.totalNotional
 
             # Pass the refined rates into the Tranches and try the simulation again
-            self.trancheList[0].rate = ratesList[2]
-            self.trancheList[1].rate = ratesList[3]
+            for index, tranche in enumerate(self):
+                tranche.rate = ratesList[nTranches + index]
 
             # # Debug
             # print(f'ratesList: {ratesList}, yieldsList: {yieldsList}')
@@ -303,15 +764,111 @@ class StructuredSecurities(object):
                     dictTuple[tranche] = (metricsTuple[0], metricsTuple[1], tranche.rate)
                 return dictTuple
 
-            # If it's not finished, remove the first 2 rates in the ratesList, and leave only the refined rates
+            # If it's not finished, remove the old rates from the ratesList, and leave only the refined rates
             # print(f'Rate A: {self.trancheList[0].rate}, Rate B: {self.trancheList[1].rate}, diffA: {diffA}, diffB: {diffB}')
-            del ratesList[0]
-            del ratesList[0]
+            del ratesList[:nTranches]
             # Empty the yieldsList as well
             yieldsList = []
 
 
 
+    @profiled
+    def runMonteCommonRandomNumbers(self, nSims, tolerance, sequential=True, initialRates=None, acceleration='secant',
+                                    seed=None, batchSize=500, maxIterations=100):
+        '''
+        Fair-rate solver with common random numbers: the default scenarios and the pool collections are simulated ONCE,
+        and each iteration only re-runs the liabilities waterfall with the new tranche rates.
+        Without resampling noise between iterations, a secant or Anderson update converges in a few iterations
+        :param nSims: the number of simulations (paths) to run
+        :param tolerance: same convergence test as runMonteSequential: notional-weighted relative change of the rates
+        :param sequential=True: specify principal payout distribution. Default is sequential
+        :param initialRates: optional warm-start rates: a list with one rate per tranche, or the dictionary returned by a previous run
+        :param acceleration: 'secant' (one secant per tranche), 'anderson' (Anderson mixing of all the tranches) or
+        'relaxation' (plain fixed-point iteration: newRate = yield)
+        :param seed: seed of the numpy random Generator. Default is the loanPool's Generator
+        :param batchSize: number of paths simulated together when building the pool collections
+        :param maxIterations: stop after this many iterations even if the tolerance is not reached
+        :return: a dictionary with key = tranche, value = 3-items-tuples (weighted RIY, weighted AL, fair rate)
+        '''
+        if acceleration not in ('secant', 'anderson', 'relaxation'):
+            raise ValueError(f'Unknown acceleration "{acceleration}". Options include: "secant", "anderson" or "relaxation"')
+
+        if self.loanPool.loanArrays is None:
+            logging.warning('The loanPool cannot be vectorized. Running runMonteSequential instead')
+            return self.runMonteSequential(nSims, tolerance, sequential)
+
+        # Starting rates: warm start from a previous run if given, else the tranches' own rates
+        if initialRates is None:
+            rates = numpy.array([tranche.rate for tranche in self])
+        elif isinstance(initialRates, dict):
+            rates = numpy.array([initialRates[tranche][-1] for tranche in self])
+        else:
+            rates = numpy.array(initialRates, dtype=float)
+
+        ##### Asset side: simulated once and shared by all the iterations, kept block by block
+        rng = numpy.random.default_rng(seed) if seed is not None else self.loanPool.rng
+        blocks = []
+        for start in range(0, nSims, batchSize):
+            defaults = self.loanPool.sampleDefaults(min(batchSize, nSims - start), rng)
+            blocks.append(self.poolCollectionsBatched(defaults))
+
+        # Fixed-point map: rates -> yields of the tranches given their weighted RIY and AL
+        # The waterfall runs 1 block at a time and only the per-tranche totals are kept, like simulateTotalsBatched()
+        def yieldsFor(rates):
+            totalRIY = numpy.zeros(len(rates))
+            totalAL = numpy.zeros(len(rates))
+            for pool in blocks:
+                RIY, AL = self.batchMetrics(self.doWaterfallBatched(pool, sequential, rates), rates)
+                totalRIY += RIY.sum(axis=1)
+                # Only add the average life if the tranche is paid down (nan otherwise)
+                totalAL += numpy.nansum(AL, axis=1)
+            weightedRIY = totalRIY / nSims
+            weightedAL = totalAL / nSims
+            yields = numpy.array([self.calculateYield(weightedRIY[index], weightedAL[index]) for index in range(len(rates))])
+            return yields, weightedRIY, weightedAL
+
+        notionals = numpy.array([tranche.notional for tranche in self])
+        ratesHistory, residualsHistory = [], []
+
+        for iteration in range(maxIterations):
+            yields, weightedRIY, weightedAL = yieldsFor(rates)
+            residuals = yields - rates
+            logging.info(f'Iteration {iteration}: rates {rates}, RIY {weightedRIY}, AL {weightedAL}')
+
+            if acceleration == 'secant' and ratesHistory:
+                # One secant per tranche on residual = yield - rate. Flat spots (RIY is rounded to whole bps) fall back to a fixed-point step
+                slope = residuals - residualsHistory[-1]
+                step = numpy.where(slope != 0, -residuals * (rates - ratesHistory[-1]) / numpy.where(slope != 0, slope, 1), residuals)
+                newRates = rates + step
+            elif acceleration == 'anderson' and ratesHistory:
+                # Anderson mixing: combine the last few fixed-point steps to cancel their residuals as much as possible
+                memory = min(len(ratesHistory), 5)
+                deltaResiduals = numpy.diff(numpy.array(residualsHistory[-memory:] + [residuals]), axis=0).T
+                deltaYields = numpy.diff(numpy.array([r + f for r, f in zip(ratesHistory[-memory:] + [rates], residualsHistory[-memory:] + [residuals])]), axis=0).T
+                gamma = numpy.linalg.lstsq(deltaResiduals, residuals, rcond=None)[0]
+                newRates = yields - deltaYields @ gamma
+            else:
+                newRates = yields
+
+            ratesHistory.append(rates)
+            residualsHistory.append(residuals)
+
+            # Same convergence test as runMonteSequential, for any number of tranches
+            diff = (notionals * numpy.abs((rates - newRates) / rates)).sum() / self.totalNotional
+            rates = newRates
+            if diff < tolerance:
+                break
+        else:
+            logging.warning(f'runMonteCommonRandomNumbers did not converge in {maxIterations} iterations')
+
+        # Pass the fair rates into the tranches, and report the metrics at those rates
+        yields, weightedRIY, weightedAL = yieldsFor(rates)
+        dictTuple = {}
+        for index, tranche in enumerate(self):
+            tranche.rate = float(rates[index])
+            dictTuple[tranche] = (float(weightedRIY[index]), float(weightedAL[index]), tranche.rate)
+        return dictTuple
+
     def calculateYield(self, RIY, AL):
         '''
         Method to find the yield of the ABS based on the passed in RIY and AL, based on a pre-existing yield curve model
@@ -329,3 +886,20 @@ class StructuredSecurities(object):
 
         numerator = 7 / (1 + .08 * (math.e ** (-0.19 * AL / 12))) + 0.19 * math.sqrt(AL * RIY * 100 / 12)
         return numerator / 100
+
+
+##############################################
+# Worker process functions for simulateWaterfallParallel(). Must be module-level so they can be pickled
+
+# Copy of the ABS held by each worker process, sent once by the ProcessPoolExecutor initializer
+_workerSecurity = None
+
+def _initWorker(security):
+    global _workerSecurity
+    _workerSecurity = security
+
+def _simulateChunk(nPaths, chunkSeed, sequential, rates, security=None):
+    # Simulate 1 chunk of paths with its own random stream. security is only passed in when running in-process
+    if security is None:
+        security = _workerSecurity
+    return security.simulateTotalsBatched(nPaths, numpy.random.default_rng(chunkSeed), sequential, rates=rates)
@@ -5,10 +5,20 @@ Tranche class
 '''
 
 import logging, numpy
+from package.RatingScale import moodysScale
+from package.IRRSolver import solveIRR
+from package.PeriodStore import PeriodStore
 'NOTE: The classes will not be using private members. We are all adults here. Dont access the forbidden fruit.'
 
 # Abstract base class. No methods. Set up for attributes and argument validation
 class Tranche(object):
+    # Rating scale used by RIY(). Can be swapped for another agency's scale on the class or on a single tranche
+    ratingScale = moodysScale
+
+    # Properties recorded for each period, one column each in the PeriodStore
+    fields = ['Interest due', 'Interest payment', 'Interest shortfall', 'Principal due', 'Principal payment',
+              'Notional balance', 'Principal shortfall', 'Cash reserve']
+
     # totalNotional: the value of the tranche
     # rate: the interest rate of the tranche
     # subordination: seniority/cash flow priority of the tranche. 'A' for senior, 'B' for subordinated. Use for outputting
@@ -26,6 +36,11 @@ class Tranche(object):
 
         self.subordination = subordination
 
+        # properties attribute: columnar store of the tranche's properties (principal payment, interest payment, totalNotional balance, etc.)
+        # for each PERIOD. Reads like a dict of dicts: self.properties[period][field]
+        # Allocated once here; reset() only wipes it
+        self.properties = PeriodStore(Tranche.fields)
+
         # True __init__ function
         self.reset()
 
@@ -40,23 +55,13 @@ class Tranche(object):
         # Create an attribute to store the totalNotional balance for the current period, because many calculations are dependent on it
         self.currentNotionalBalance = self.notional
 
-        # properties attribute: dict of dicts, to store the tranche's corresponding properties (principal payment, interest payment, totalNotional balance, etc.) for each PERIOD (key)
-        self.properties = {self.period: {}}
-        # Initialize the tranche's properties to 0
-        self.properties[self.period]['Interest due'] = 0
-        self.properties[self.period]['Interest payment'] = 0
-        self.properties[self.period]['Interest shortfall'] = 0
-
-        self.properties[self.period]['Principal due'] = 0
-        self.properties[self.period]['Principal payment'] = 0
-        self.properties[self.period]['Notional balance'] = self.currentNotionalBalance
-        self.properties[self.period]['Principal shortfall'] = 0
-
-        # Quick fix so that TotalCollections in 13MAIN work
-        self.properties[-1] = {}
-        self.properties[-1]['Cash reserve'] = 0
-
-        self.properties[self.period]['Cash reserve'] = 0
+        # Wipe the records of the previous simulation and initialize the tranche's properties to 0
+        self.properties.clear()
+        self.properties.openPeriod(self.period)
+        self.properties.record(self.period, {'Interest due': 0, 'Interest payment': 0, 'Interest shortfall': 0,
+                                             'Principal due': 0, 'Principal payment': 0,
+                                             'Notional balance': self.currentNotionalBalance, 'Principal shortfall': 0,
+                                             'Cash reserve': 0})
 
 
     def __repr__(self):
@@ -69,38 +74,46 @@ class Tranche(object):
 
     # Method to return the IRR of a tranche
     def IRR(self):
-        # Loop through all the periods and store the inflows to the list
-        cashFlows = [-self.notional]
-        # Derived classes will have a properties attribute to track cashflows
-        # Loop through period 1 to the last period that the tranche has on record
-        for period in range(1, self.period + 1):
-            cashFlows.append(self.properties[period]['Principal payment'] + self.properties[period]['Interest payment'])
-        # Return the IRR, multiplied by 12 to annualize
-        return round(numpy.irr(cashFlows) * 12, 4)
+        # Inflows of period 1 to the last period that the tranche has on record, straight from the property columns
+        cashFlows = self.properties.column('Principal payment') + self.properties.column('Interest payment')
+        # Period 0: the tranche is bought at its notional amount
+        cashFlows[0] = -self.notional
+        # Return the IRR, multiplied by 12 to annualize. Warm start the solver from the tranche's monthly coupon
+        return round(Tranche.calcIRR(cashFlows, self.rate / 12) * 12, 4)
+
+    # Class-level method to find the periodic IRR of a list of cash flows, starting at period 0
+    # Delegates to the vectorized IRR engine (numpy.irr was removed from numpy 1.20). nan if there is none
+    @classmethod
+    def calcIRR(cls, cashFlows, guess=None):
+        return float(solveIRR(cashFlows, guess)[0])
 
 ##############################################
     ##### RIY: Reduction in yield: tranche rate less the annual IRR.
     # RIY specifies how much the investor lost out on => Maximum = 100% + tranche rate
     # used to give a letter rating to the security. The smaller the better for the investor
 
-    def RIY(self):
-        # Quoted in bps. Round to a whole number and multiply by 100 for numpy.arange to work
-        RIY = round((self.rate - self.IRR()) * 10000, 0) * 100
-
-        # ratingDict of appendix A
-        ratingDict = {'Aaa': numpy.arange(0, 6), 'Aa1': numpy.arange(6, 67), 'Aa2': numpy.arange(67, 130),
-                'Aa3': numpy.arange(130, 270),
-                'A1': numpy.arange(270, 520), 'A2': numpy.arange(520, 890), 'A3': numpy.arange(890, 1300),
-                'Baa1': numpy.arange(1300, 1900), 'Baa2': numpy.arange(1900, 2700)
-            , 'Baa3': numpy.arange(2700, 4600), 'Ba1': numpy.arange(4600, 7200), 'Ba2': numpy.arange(7200, 10600),
-                'Ba3': numpy.arange(10600, 14300), 'B1': numpy.arange(14300, 18300)
-            , 'B2': numpy.arange(18300, 23100), 'B3': numpy.arange(23100, 31100), 'Caa': numpy.arange(31100, 250000),
-                'Ca': numpy.arange(250000,
-                                   99999900)}  # in case IRR is lower than -100% because defaults happen too early
-        # give the RIY a letter grade
-        for letterGrade in ratingDict:
-            if int(RIY) in ratingDict[letterGrade]:
-                return int(RIY / 100), letterGrade
+    def RIY(self, ratingScale=None):
+        # Quoted in bps, rounded to a whole number
+        RIY = round((self.rate - self.IRR()) * 10000, 0)
+
+        # give the RIY a letter grade with a binary search on the rating scale (Appendix A by default)
+        letterGrade = (ratingScale or self.ratingScale).rate(RIY)
+        if letterGrade is not None:
+            return int(RIY), letterGrade
+
+    # Annual IRR used in the simulation metrics: no IRR at all (nan) means that the tranche got nothing back,
+    # so it counts as a total loss (-100% a month). Works on 1 IRR or an array of them
+    @staticmethod
+    def simulationIRR(IRR):
+        IRR = numpy.where(numpy.isnan(IRR), -12., IRR)
+        return float(IRR) if IRR.ndim == 0 else IRR
+
+    # RIY in bps used in the simulation metrics, from the tranche rate and the annual IRR(s). Unlike RIY(), it is
+    # defined for any IRR: negative RIYs and nan IRRs (see simulationIRR()) have no rating but still count
+    @classmethod
+    def simulationRIY(cls, rate, IRR):
+        RIY = numpy.round((rate - cls.simulationIRR(IRR)) * 10000)
+        return float(RIY) if RIY.ndim == 0 else RIY
 
 ##############################################
     ##### AL: Average life: average time that each dollar of a tranche's unpaid principal remains unpaid
@@ -112,13 +125,11 @@ class Tranche(object):
     def AL(self):
 
         # if at the final period, balance is zero, which means it's paid off, use the formula
-        if self.properties[self.period]['Notional balance'] <= 0.001:
+        if self.properties.value('Notional balance', self.period) <= 0.001:
             # Formula: inner sumproduct of the time period numbers (0, 1, 2, 3, etc.) and the principal payments,
             # divided by the initial principal.
-            sum = 0
-            for i in range(self.period + 1):
-                sum += i * self.properties[i]['Principal payment']
-            return sum / self.notional
+            principalPayments = self.properties.column('Principal payment')
+            return float(numpy.arange(len(principalPayments)) @ principalPayments) / self.notional
 
         # if not, return None
         else:
@@ -142,15 +153,15 @@ class StandardTranche(Tranche):
     def increaseTimePeriod(self):
 
         # A period cant be blank, so raise an error if principal/interest payments are not yet recorded before trying to increase the period
-        if 'Principal payment' not in self.properties[self.period]:
+        if not self.properties.isRecorded('Principal payment', self.period):
             raise Exception('Principal payment has not been recorded for this period yet. Record before incrementing period')
-        if 'Interest payment' not in self.properties[self.period]:
+        if not self.properties.isRecorded('Interest payment', self.period):
             raise Exception('Interest payment has not been recorded for this period yet. Record before incrementing period')
 
-        # Increment time period by 1, and add it as a new key to the properties dictionary
-        # The value will be a dictionary that contains all the info (principal/interest payment, etc.) for the corresponding period
+        # Increment time period by 1, and open it in the properties store
+        # It will hold all the info (principal/interest payment, etc.) for the corresponding period
         self.period += 1
-        self.properties[self.period] = {}
+        self.properties.openPeriod(self.period)
 
 ##############################################
     # Method to RECORD the PRINCIPAL PAYMENT for the current OBJECT time period, using a dict
@@ -158,17 +169,17 @@ class StandardTranche(Tranche):
     def makePrincipalPayment(self, principalPayment):
 
         # If the tranche's principal payment for the current period has already been recorded, raise an Exception
-        if 'Principal payment' in self.properties[self.period]:
+        if self.properties.isRecorded('Principal payment', self.period):
             raise Exception(f'Principal payment for period {self.period} has already been recorded')
 
         # If its not recorded yet, record the principal payment and call the notionalBalance() method to update the currentNotionalBalance for the current period
-        self.properties[self.period]['Principal payment'] = principalPayment
-        self.properties[self.period]['Notional balance'] = self.notionalBalance()
+        self.properties.set('Principal payment', self.period, principalPayment)
+        self.properties.set('Notional balance', self.period, self.notionalBalance())
 
         # If the tranche's notional for the current period is paid down to 0, tranche has no more principal payment due
         # => Record everything as 0
         if self.currentNotionalBalance <= 0.001:
-            self.properties[self.period]['Principal due'] = principalPayment
+            self.properties.set('Principal due', self.period, principalPayment)
 
         # Principal shortfall recording and adding to next period will be done in the StructuredSecurities makePayments() method,
         # Because we cant find principal due here, it's only found in the SS object with the underlying loanPool
@@ -179,22 +190,18 @@ class StandardTranche(Tranche):
     def makeInterestPayment(self, interestPayment):
 
         # If the tranche's interest payment for the current period has already been recorded, raise an Exception
-        if 'Interest payment' in self.properties[self.period]:
+        if self.properties.isRecorded('Interest payment', self.period):
             raise Exception(f'Interest payment for period {self.period} has already been recorded')
 
-        # Or if the interest due for the current period is 0, record everything as 0
         # Find interest due for the current period by calling the object-level method interestDue(), defined below
-        if self.interestDue() <= 0.001:
-            self.properties[self.period]['Interest due'] = 0
-            self.properties[self.period]['Interest payment'] = 0
-            self.properties[self.period]['Interest shortfall'] = 0
+        interestDue = self.interestDue()
 
-        # If there's no problem, record the interest payment and interest due for the current period
-        self.properties[self.period]['Interest due'] = self.interestDue()
-        self.properties[self.period]['Interest payment'] = interestPayment
+        # Record the interest payment and interest due for the current period
+        self.properties.set('Interest due', self.period, interestDue)
+        self.properties.set('Interest payment', self.period, interestPayment)
 
         # Interest shortfall = max of 0 and difference b/w interest due and interest payment
-        self.properties[self.period]['Interest shortfall'] = max(0, self.interestDue() - interestPayment)
+        self.properties.set('Interest shortfall', self.period, max(0, interestDue - interestPayment))
 
 ##############################################
     # principalDue formula will be in the StructuredSecurities class makePayments() method
@@ -204,7 +211,7 @@ class StandardTranche(Tranche):
     # Method to return the amount of interest due for the current time period
     # Formula: totalNotional balance of the previous time period * rate + interest shortfalls in the previous period
     def interestDue(self):
-        self.currentInterestDue = self.properties[self.period - 1]['Notional balance'] * self.rate/12 + self.properties[self.period - 1]['Interest shortfall']
+        self.currentInterestDue = self.properties.value('Notional balance', self.period - 1) * self.rate/12 + self.properties.value('Interest shortfall', self.period - 1)
         return self.currentInterestDue
 
 ##############################################
@@ -212,7 +219,7 @@ class StandardTranche(Tranche):
     # Because its for the object's current period, no parameters are needed
     def notionalBalance(self):
         # Formula: totalNotional of previous period - principal payment of current period
-        self.currentNotionalBalance = self.properties[self.period - 1]['Notional balance'] - self.properties[self.period]['Principal payment']
+        self.currentNotionalBalance = self.properties.value('Notional balance', self.period - 1) - self.properties.value('Principal payment', self.period)
         return self.currentNotionalBalance
 
 
@@ -0,0 +1,98 @@
+'''
+Liabilities waterfall kernel for any number of tranches
+Same payment rules as StructuredSecurities.makePayments, run for a block of paths at once: every tranche field
+(interest due/paid/shortfall, principal due/paid/shortfall, balances and cash reserve) comes out as a
+(tranches x paths x periods) array, so the cost is 1 vectorized step per tranche per period, whatever the number of paths
+'''
+
+import numpy
+
+from package.Tranche import Tranche
+from package.Profiler import profiler
+
+
+def waterfallKernel(collections, principal, horizon, notionals, rates, sequential=True, totalNotional=None):
+    '''
+    :param collections: (paths x periods) cash collected from the pool each period (payments + recoveries)
+    :param principal: (paths x periods) principal due by the pool each period
+    :param horizon: (paths) last period of each path. Nothing happens to a path after it
+    :param notionals: notional of each tranche, in order of seniority (like trancheList, which addTranche() keeps sorted)
+    :param rates: ANNUAL coupon of each tranche
+    :param sequential: specify principal payout distribution. True for sequential, False for prorata
+    :param totalNotional: notional the pro-rata shares are taken of. Default is the sum of the notionals
+    :return: dictionary of (tranches x paths x periods) arrays, in the order of the tranches, with keys
+    Tranche.fields ('Interest due', 'Interest payment', ..., 'Cash reserve'), and 'Horizon'.
+    'Cash reserve' is the cash left after each tranche's principal payment: the last tranche's is carried to the next period
+    '''
+    collections = numpy.asarray(collections, dtype=float)
+    principal = numpy.asarray(principal, dtype=float)
+    horizon = numpy.asarray(horizon)
+    notionals = numpy.asarray(notionals, dtype=float)
+    rates = numpy.asarray(rates, dtype=float)
+    nPaths, nColumns = collections.shape
+    nTranches = len(notionals)
+    if len(rates) != nTranches:
+        raise ValueError('The waterfall needs 1 rate per tranche.')
+    if totalNotional is None:
+        totalNotional = notionals.sum()
+
+    # Every field starts at period 0 like Tranche.reset(): all 0, except the balance
+    # Filled as (tranches x periods x paths), so each step writes a contiguous row, and returned as (tranches x paths x periods) views
+    waterfall = {field: numpy.zeros((nTranches, nColumns, nPaths)) for field in Tranche.fields}
+    waterfall['Notional balance'][:, 0] = notionals[:, None]
+
+    # State of each tranche at the previous period, one value per path
+    balance = numpy.repeat(notionals[:, None], nPaths, axis=1)
+    interestShortfall = numpy.zeros((nTranches, nPaths))
+    principalShortfall = numpy.zeros((nTranches, nPaths))
+    cashReserve = numpy.zeros(nPaths)
+
+    for period in range(1, int(horizon.max(initial=0)) + 1):
+        # Paths that have already run out of active loans are left untouched
+        active = period <= horizon
+        cashAmount = collections[:, period] + cashReserve
+
+        ##### Interest payments, in order of seniority
+        with profiler.span('interest pass'):
+            for index in range(nTranches):
+                interestDue = balance[index] * rates[index] / 12 + interestShortfall[index]
+                payment = numpy.where(active, numpy.minimum(interestDue, cashAmount), 0.)
+                interestShortfall[index] = numpy.where(active, numpy.maximum(0, interestDue - payment), interestShortfall[index])
+                waterfall['Interest due'][index, period] = numpy.where(active, interestDue, 0.)
+                waterfall['Interest payment'][index, period] = payment
+                waterfall['Interest shortfall'][index, period] = numpy.where(active, interestShortfall[index], 0.)
+                cashAmount = cashAmount - payment
+
+        ##### Principal payments, in order of seniority
+        with profiler.span('principal pass'):
+            poolPrincipalDue = principal[:, period]
+            principalDue = poolPrincipalDue
+            for index in range(nTranches):
+                if sequential:
+                    principalDue = principalDue + principalShortfall[index]
+                else:
+                    principalDue = poolPrincipalDue * (notionals[index] / totalNotional) + principalShortfall[index]
+
+                # Same rule as makePayments: the tranche is paid off if it can be, otherwise it takes all the cash left
+                payment = numpy.minimum(numpy.minimum(principalDue, cashAmount), balance[index])
+                paidOff = payment == balance[index]
+                payment = numpy.where(paidOff, payment, cashAmount)
+                principalDue = numpy.where(paidOff, principalDue, cashAmount)
+                payment = numpy.where(active, payment, 0.)
+
+                # The tranche's principal due always ends up equal to its payment, so there is no principal shortfall
+                principalShortfall[index] = numpy.where(active, 0., principalShortfall[index])
+                balance[index] = balance[index] - payment
+                cashAmount = cashAmount - payment
+                waterfall['Principal due'][index, period] = payment
+                waterfall['Principal payment'][index, period] = payment
+                waterfall['Notional balance'][index, period] = balance[index]
+                waterfall['Cash reserve'][index, period] = numpy.where(active, cashAmount, 0.)
+                principalDue = principalDue - payment
+
+        # Cash left after the last tranche goes to the cash reserve for the next period
+        cashReserve = numpy.where(active, cashAmount, cashReserve)
+
+    waterfall = {field: matrix.transpose(0, 2, 1) for field, matrix in waterfall.items()}
+    waterfall['Horizon'] = horizon
+    return waterfall
@@ -0,0 +1,198 @@
+'''
+WaterfallWriter classes: export the asset (LoanPool) and liability (Tranche) waterfalls to .csv, .npy or .npz files
+The header is built from the tranche list, and rows are streamed to the file as the periods (or blocks of paths) are
+produced, so exporting every path of a large simulation never holds more than 1 block in memory
+'''
+
+import io, os, struct, zipfile, numpy
+
+from package.Tranche import Tranche
+
+
+class WaterfallWriter(object):
+    # Number of bytes reserved for the .npy header, rewritten with the final shape when the file is closed
+    _npyHeaderSize = 128
+
+    # fileName: path of the output file. The format comes from the extension: .csv, .npy (values only) or .npz
+    # (arrays 'values' and 'columns'). Binary files hold float64 values, 1 row per period (per path)
+    # columns: names of the columns. indexColumns: number of leading columns that are integers (i.e. Path, Period)
+    # compress: True to deflate the .npz file
+    def __init__(self, fileName, columns, indexColumns=1, compress=False):
+        self.fileName = fileName
+        self.columns = list(columns)
+        self.indexColumns = indexColumns
+        self.compress = compress
+        self.nRows = 0
+
+        self.format = os.path.splitext(fileName)[1].lower()
+        if self.format == '.csv':
+            self._file = open(fileName, 'w')
+            self._file.write(','.join(self.columns) + '\n')
+        elif self.format in ('.npy', '.npz'):
+            # .npz files are streamed to a temporary .npy first, then stored in the archive on close()
+            self._valuesName = fileName if self.format == '.npy' else fileName + '.values.tmp.npy'
+            self._file = open(self._valuesName, 'wb')
+            self._file.write(self._npyHeader((0, len(self.columns))))
+        else:
+            raise ValueError(f'Unknown waterfall file format "{self.format}". Options include: ".csv", ".npy" or ".npz"')
+
+    def __repr__(self):
+        return f'{type(self).__name__}: {self.fileName}-{len(self.columns)} columns-{self.nRows} rows'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def writeRows(self, rows):
+        '''
+        Append rows to the file
+        :param rows: (rows x columns) array-like, in the order of self.columns
+        :return: None
+        '''
+        rows = numpy.asarray(rows, dtype=float).reshape(-1, len(self.columns))
+        if self.format == '.csv':
+            # Index columns as integers, values as str(float), like the main programs used to write them
+            index = rows[:, :self.indexColumns].astype(numpy.int64).tolist()
+            values = rows[:, self.indexColumns:].tolist()
+            self._file.write(''.join(','.join(map(str, rowIndex + rowValues)) + '\n' for rowIndex, rowValues in zip(index, values)))
+        else:
+            self._file.write(numpy.ascontiguousarray(rows, dtype='<f8').tobytes())
+        self.nRows += len(rows)
+
+    def close(self):
+        if self._file is None:
+            return
+        if self.format != '.csv':
+            # Now that the number of rows is known, write the real header in the space reserved for it
+            self._file.seek(0)
+            self._file.write(self._npyHeader((self.nRows, len(self.columns))))
+        self._file.close()
+        self._file = None
+
+        if self.format == '.npz':
+            columns = io.BytesIO()
+            numpy.save(columns, numpy.array(self.columns))
+            with zipfile.ZipFile(self.fileName, 'w', zipfile.ZIP_DEFLATED if self.compress else zipfile.ZIP_STORED, allowZip64=True) as archive:
+                archive.write(self._valuesName, 'values.npy')
+                archive.writestr('columns.npy', columns.getvalue())
+            os.remove(self._valuesName)
+
+    # INTERNAL METHOD: .npy version 1.0 header for a float64 C-order array, padded to a fixed size
+    @classmethod
+    def _npyHeader(cls, shape):
+        header = "{'descr': '<f8', 'fortran_order': False, 'shape': %r, }" % (tuple(shape),)
+        # magic string (6 bytes) + version (2 bytes) + header length (2 bytes) + header ending with a newline
+        header = header.ljust(cls._npyHeaderSize - 11) + '\n'
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+    # INTERNAL METHOD: (path, period) pairs of every period from 0 to the horizon of each path of a batch
+    @staticmethod
+    def _batchIndex(horizon, nColumns):
+        return numpy.nonzero(numpy.arange(nColumns) <= numpy.asarray(horizon)[:, None])
+
+
+class AssetWaterfallWriter(WaterfallWriter):
+    # LoanPool properties written by default, same columns as the main programs' AssetWaterfall.csv
+    defaultFields = ['Principal', 'Interest', 'Total', 'Balance']
+
+    # fields: LoanPool properties to write. paths: True to add a leading Path column (i.e. to export simulations)
+    def __init__(self, fileName, fields=None, paths=False, compress=False):
+        self.fields = list(fields) if fields is not None else list(AssetWaterfallWriter.defaultFields)
+        self.paths = paths
+        index = ['Path', 'Period'] if paths else ['Period']
+        super(AssetWaterfallWriter, self).__init__(fileName, index + self.fields, len(index), compress)
+
+    def record(self, security, period, path=0):
+        '''
+        Write 1 period of the asset waterfall, after doWaterfallSequential() has recorded it
+        :param security: StructuredSecurities object
+        :param period: period to write
+        :param path: simulation number, for the Path column
+        :return: None
+        '''
+        waterfall = security.loanPool.properties[period]
+        row = ([path, period] if self.paths else [period]) + [waterfall[field] for field in self.fields]
+        self.writeRows([row])
+
+    def recordBatch(self, security, pool, waterfall, pathOffset=0):
+        '''
+        Write every period of every path of a batched simulation block
+        :param security: StructuredSecurities object
+        :param pool: dictionary returned by poolCollectionsBatched()
+        :param waterfall: dictionary returned by doWaterfallBatched()
+        :param pathOffset: simulation number of the first path of the block
+        :return: None
+        '''
+        # The batched pool only has the cash flows: its Balance isn't tracked path by path
+        sources = {'Principal': pool['Principal'], 'Interest': pool['Payment'] - pool['Principal'],
+                   'Total': pool['Payment'], 'Recoveries': pool['Recoveries']}
+        missing = [field for field in self.fields if field not in sources]
+        if missing:
+            raise ValueError(f'Batched simulations cannot export {missing}. Options include: {list(sources)}')
+
+        paths, periods = self._batchIndex(pool['Horizon'], pool['Payment'].shape[1])
+        columns = ([paths + pathOffset, periods] if self.paths else [periods]) + [sources[field][paths, periods] for field in self.fields]
+        self.writeRows(numpy.column_stack(columns))
+
+
+class LiabilityWaterfallWriter(WaterfallWriter):
+    # trancheList: tranches of the StructuredSecurities, in order of seniority. Each one gets a column per field,
+    # named after its subordination, i.e. 'A Interest due'
+    # fields: Tranche properties to write. Default is all of them (Tranche.fields)
+    # collections: True to add the pool's Recoveries and Collections (payments + recoveries + last period's cash reserve) columns,
+    # 'scheduled' to add a Collections column of the payments due by the loans still active instead (totalPaymentDue(),
+    # object waterfalls only), False for none
+    # paths: True to add a leading Path column (i.e. to export simulations)
+    def __init__(self, fileName, trancheList, fields=None, collections=True, paths=False, compress=False):
+        self.fields = list(fields) if fields is not None else list(Tranche.fields)
+        self.nTranches = len(trancheList)
+        self.collections = collections
+        self.paths = paths
+        index = ['Path', 'Period'] if paths else ['Period']
+        poolColumns = ['Collections'] if collections == 'scheduled' else ['Recoveries', 'Collections'] if collections else []
+        trancheColumns = [f'{tranche.subordination} {field}' for tranche in trancheList for field in self.fields]
+        super(LiabilityWaterfallWriter, self).__init__(fileName, index + poolColumns + trancheColumns, len(index), compress)
+
+    def record(self, security, period, path=0):
+        '''
+        Write 1 period of the liability waterfall, after doWaterfallSequential() has recorded it
+        :param security: StructuredSecurities object
+        :param period: period to write
+        :param path: simulation number, for the Path column
+        :return: None
+        '''
+        row = [path, period] if self.paths else [period]
+        if self.collections == 'scheduled':
+            row += [security.loanPool.totalPaymentDue(period)]
+        elif self.collections:
+            poolWaterfall = security.loanPool.properties[period]
+            # The cash reserve left by the most junior tranche is collected again in the next period
+            reserve = security.trancheList[-1].properties[period - 1]['Cash reserve'] if period else 0
+            row += [poolWaterfall['Recoveries'], poolWaterfall['Total'] + poolWaterfall['Recoveries'] + reserve]
+        for tranche in security.trancheList:
+            properties = tranche.properties[period]
+            row += [properties[field] for field in self.fields]
+        self.writeRows([row])
+
+    def recordBatch(self, security, pool, waterfall, pathOffset=0):
+        '''
+        Write every period of every path of a batched simulation block
+        :param security: StructuredSecurities object
+        :param pool: dictionary returned by poolCollectionsBatched()
+        :param waterfall: dictionary returned by doWaterfallBatched()
+        :param pathOffset: simulation number of the first path of the block
+        :return: None
+        '''
+        paths, periods = self._batchIndex(pool['Horizon'], pool['Payment'].shape[1])
+        columns = [paths + pathOffset, periods] if self.paths else [periods]
+        if self.collections == 'scheduled':
+            raise ValueError('Batched simulations do not track the scheduled payments due of each path. Options include: collections=True or False')
+        if self.collections:
+            reserve = numpy.zeros(pool['Payment'].shape)
+            reserve[:, 1:] = waterfall['Cash reserve'][-1, :, :-1]
+            columns += [pool['Recoveries'][paths, periods], (pool['Payment'] + pool['Recoveries'] + reserve)[paths, periods]]
+        for index in range(self.nTranches):
+            columns += [waterfall[field][index][paths, periods] for field in self.fields]
+        self.writeRows(numpy.column_stack(columns))